@@ -0,0 +1,3 @@
+from pelicansage.commands import main
+
+main()
@@ -0,0 +1,181 @@
+"""
+Portable export and import of evaluated results.
+
+The results stored by a FileManager are bound to its row ids and image
+directory.  export_results writes the sources, code blocks and results,
+including images, into a single zip archive in which results are keyed by
+the chain hash of their block (see chain_hashes) instead of row ids.
+import_results merges such an archive into another store: sources it does
+not know are added with their blocks, and every unevaluated block whose
+chain hash is in the archive receives the archived results.  A build
+starting from the merged store only evaluates what changed since.
+"""
+
+import json
+import logging
+import os
+import zipfile
+from collections import defaultdict
+
+from .managefiles import CodeBlock, DataSrc, StreamResult, FileResult, ErrorResult, chain_hashes
+
+logger = logging.getLogger(__name__)
+
+ARCHIVE_FORMAT = 1
+
+MANIFEST = 'manifest.json'
+
+
+def _archive_file(chain, file_name):
+    return 'files/%s/%s' % (chain, file_name)
+
+
+def _is_file_name(name):
+    # Result files are written below the directory of their block, a name
+    # from an archive must not reach out of it
+    return (isinstance(name, str) and name not in ('', '.', '..') and
+            os.path.basename(name) == name and '/' not in name and '\\' not in name)
+
+
+def _sources(manager):
+    """
+    Returns a list of (src, blocks ordered by order, chain hashes).
+    """
+    blocks = defaultdict(list)
+    for block in manager.query(CodeBlock).all():
+        blocks[block.src_id].append(block)
+
+    sources = []
+    for src in manager.query(DataSrc).order_by(DataSrc.src):
+        src_blocks = sorted(blocks.get(src.id, []), key=lambda x: x.order)
+        if src_blocks:
+            sources.append((src, src_blocks, chain_hashes(src_blocks)))
+
+    return sources
+
+
+def export_results(manager, path):
+    """
+    Writes every source, code block and evaluated result of manager to the
+    zip archive at path and returns the number of blocks with results.
+    """
+    results = {}
+    manifest_sources = []
+
+    streams = defaultdict(list)
+    for result in manager.query(StreamResult).order_by(StreamResult.id):
+        streams[result.code_id].append({'order': result.order, 'mimetype': result.mimetype,
+                                        'result': result.result})
+
+    errors = defaultdict(list)
+    for result in manager.query(ErrorResult).order_by(ErrorResult.id):
+        errors[result.code_id].append({'order': result.order, 'ename': result.ename,
+                                       'evalue': result.evalue, 'traceback': result.traceback})
+
+    files = defaultdict(list)
+    for result in manager.query(FileResult).order_by(FileResult.id):
+        files[result.code_id].append(result)
+
+    with zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED) as archive:
+        for src, blocks, chains in _sources(manager):
+            manifest_sources.append({'src': src.src,
+                                     'blocks': [{'order': block.order,
+                                                 'user_id': block.user_id,
+                                                 'content': block.content,
+                                                 'language': block.language,
+                                                 'platform': block.platform,
+                                                 'timeout': block.timeout,
+                                                 'chain': chain}
+                                                for block, chain in zip(blocks, chains)]})
+
+            for block, chain in zip(blocks, chains):
+                if block.last_evaluated is None or chain in results:
+                    continue
+
+                entry = {'streams': streams.get(block.id, []),
+                         'errors': errors.get(block.id, []),
+                         'files': []}
+
+                for result in files.get(block.id, []):
+                    location = manager.file_location(block.id, result.file_name)
+                    if location is None or not os.path.exists(location):
+                        logger.warning("Image %s of block %d in %s is missing, not exported.",
+                                       result.file_name, block.order, src.src)
+                        continue
+
+                    archive.write(location, _archive_file(chain, result.file_name))
+                    entry['files'].append({'order': result.order, 'mimetype': result.mimetype,
+                                           'file_name': result.file_name})
+
+                results[chain] = entry
+
+        archive.writestr(MANIFEST, json.dumps({'format': ARCHIVE_FORMAT,
+                                               'sources': manifest_sources,
+                                               'results': results}))
+
+    return len(results)
+
+
+def import_results(manager, path, overwrite=False):
+    """
+    Merges the archive at path into manager and returns the number of
+    blocks which received results.  Blocks which are already evaluated
+    keep their results unless overwrite is set.
+    """
+    with zipfile.ZipFile(path) as archive:
+        manifest = json.loads(archive.read(MANIFEST).decode('utf-8'))
+
+        if manifest.get('format') != ARCHIVE_FORMAT:
+            raise ValueError("Unsupported result archive format %r in %s" % (manifest.get('format'), path))
+
+        results = manifest['results']
+
+        for chain, entry in results.items():
+            for result in entry['files']:
+                if not _is_file_name(result['file_name']):
+                    raise ValueError("Invalid result file name %r in %s" % (result['file_name'], path))
+
+        known = set(src for (src,) in manager.query(DataSrc.src))
+
+        for source in manifest['sources']:
+            if source['src'] in known:
+                continue
+
+            for block in source['blocks']:
+                manager.create_code(block['content'], source['src'], block['order'],
+                                    user_id=block['user_id'], language=block['language'],
+                                    platform=block['platform'], timeout=block.get('timeout'))
+
+        imported = 0
+        touched = set()
+
+        for src, blocks, chains in _sources(manager):
+            for block, chain in zip(blocks, chains):
+                if chain not in results or (block.last_evaluated is not None and not overwrite):
+                    continue
+
+                manager.delete_results([block.id])
+
+                entry = results[chain]
+
+                for result in entry['streams']:
+                    manager.create_result(block.id, result['result'], result['order'], result['mimetype'])
+
+                for result in entry['errors']:
+                    manager.create_error(block.id, result['ename'], result['evalue'],
+                                         result['traceback'], result['order'])
+
+                for result in entry['files']:
+                    raw = archive.read(_archive_file(chain, result['file_name']))
+                    manager.save_file(block.id, raw, result['file_name'], result['order'], result['mimetype'])
+
+                manager.timestamp_code(block.id)
+                touched.add(src.src)
+                imported += 1
+
+    for src in sorted(touched):
+        manager.compute_permalink(src)
+
+    manager.commit()
+
+    return imported
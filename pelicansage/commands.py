@@ -0,0 +1,258 @@
+"""
+Command line interface, run as ``python -m pelicansage <command>``.
+
+The result store is located through the SAGE settings of a pelican
+configuration file (-s) and can be overridden with --db / --files.
+
+    python -m pelicansage export -s pelicanconf.py results.zip
+    python -m pelicansage import -s pelicanconf.py results.zip
+    python -m pelicansage worker -s pelicanconf.py
+    python -m pelicansage watch -s pelicanconf.py
+    python -m pelicansage gc -s pelicanconf.py
+    python -m pelicansage plan -s pelicanconf.py --workers 8
+"""
+
+from __future__ import print_function
+
+import argparse
+import logging
+import os
+import sys
+from types import SimpleNamespace
+
+logger = logging.getLogger(__name__)
+
+
+def load_site(path=None):
+    """
+    Returns the pelican settings read from the configuration file at path,
+    the defaults if path is None, and the plugin settings derived from them.
+    """
+    from pelican.settings import read_settings
+
+    from . import pelicansage as plugin
+
+    settings = read_settings(path)
+    plugin.process_settings(SimpleNamespace(settings=settings), settings.get('SAGE'))
+
+    # The content directory of the site, as the plugin sees it
+    return settings, dict(plugin._SAGE_SETTINGS, PATH=plugin._CONTENT_PATH)
+
+
+def load_settings(path=None):
+    """
+    Returns the plugin settings derived from the pelican configuration
+    file at path, the defaults if path is None.
+    """
+    return load_site(path)[1]
+
+
+def open_manager(args, settings=None):
+    from .managefiles import FileManager
+
+    settings = settings or load_settings(args.settings)
+
+    db_path = args.db or settings['DB_PATH']
+    base_path = args.files or settings['FILE_BASE_PATH']
+
+    if db_path == ':memory:':
+        raise SystemExit("The result store is in memory, set SAGE['DB_PATH'] or pass --db.")
+
+    return FileManager(location=db_path, base_path=base_path, codec=settings['BLOB_CODEC'])
+
+
+def export_command(args):
+    from .cache import export_results
+
+    count = export_results(open_manager(args), args.archive)
+    print('Exported results of %d blocks to %s' % (count, args.archive))
+
+
+def import_command(args):
+    from .cache import import_results
+
+    count = import_results(open_manager(args), args.archive, overwrite=args.overwrite)
+    print('Imported results of %d blocks from %s' % (count, args.archive))
+
+
+def worker_command(args):
+    from . import pelicansage as plugin
+    from .workqueue import open_work_queue, run_worker
+
+    settings = load_settings(args.settings)
+
+    config = dict(settings['WORK_QUEUE'] or {})
+    if args.queue:
+        config['path'] = args.queue
+    if args.backend:
+        config['backend'] = args.backend
+
+    if not config.get('path'):
+        raise SystemExit("No work queue, set SAGE['WORK_QUEUE'] or pass --queue.")
+
+    count = run_worker(open_work_queue(config), plugin._create_clients,
+                       retries=settings['RETRIES'], backoff=settings['RETRY_BACKOFF'],
+                       checkpoints=settings['CHECKPOINT_PATH'], poll=float(config.get('poll', 0.5)),
+                       idle_timeout=args.idle_timeout, timeout=settings['BLOCK_TIMEOUT'],
+                       on_timeout=settings['ON_TIMEOUT'])
+    print('Evaluated %d work units' % (count,))
+
+
+def gc_command(args):
+    settings = load_settings(args.settings)
+    manager = open_manager(args, settings)
+
+    collected = manager.collect_garbage(content_path=settings['PATH'],
+                                        checkpoints=settings['CHECKPOINT_PATH'],
+                                        raw_path=os.path.join(settings['OUTPUT_PATH'], 'raw'),
+                                        vacuum=not args.no_vacuum)
+
+    print('Removed %(sources)d sources, %(blocks)d blocks, %(results)d results, %(references)d references, '
+          '%(blobs)d blobs, %(image_dirs)d image directories, %(raw_files)d raw snippets and '
+          '%(checkpoints)d checkpoints' % collected)
+    print('Reclaimed %d bytes of database and %d bytes of files' % (collected['db_bytes'], collected['file_bytes']))
+
+
+def plan_command(args):
+    import shutil
+    import tempfile
+
+    from . import pelicansage as plugin
+    from .evaluation import plan
+    from .managefiles import FileManager
+    from .report import format_plan
+
+    site, settings = load_site(args.settings)
+    workers = args.workers or settings['MAX_WORKERS']
+
+    # Blocks are read into a copy of the store, evaluating them would
+    # change it.  Without a base path no image is touched either.
+    workdir = tempfile.mkdtemp()
+    try:
+        if args.db or settings['DB_PATH'] != ':memory:':
+            stored = open_manager(args, settings)
+            if os.path.exists(stored.location):
+                shutil.copyfile(stored.location, os.path.join(workdir, 'content.db'))
+            stored._engine.dispose()
+
+        manager = FileManager(location=workdir, codec=settings['BLOB_CODEC'])
+
+        if not args.stored:
+            _read_content(site, manager)
+
+        # Sources the build would evaluate, following DRAFTS and WRITE_SELECTED
+        plugin._WRITE_SELECTED = plugin._write_selected(SimpleNamespace(settings=site))
+        planned, wall_time = plan(manager, workers, plugin.evaluation_sources())
+        manager._engine.dispose()
+    finally:
+        shutil.rmtree(workdir)
+
+    print(format_plan(planned, wall_time, workers))
+
+
+def _read_content(site, manager):
+    """
+    Records the code blocks of the rst sources of site in manager, as the
+    first pass of a build does.
+    """
+    from pelican.generators import Generator
+    from pelican.readers import RstReader
+
+    from . import pelicansage as plugin
+
+    # The directives record the blocks they read in the plugin store
+    plugin.register()
+    plugin._FILE_MANAGER = manager
+
+    generator = Generator(context=site.copy(), settings=site, path=site['PATH'],
+                          theme=site['THEME'], output_path=site['OUTPUT_PATH'])
+    rst_reader = RstReader(site)
+
+    for f in plugin.content_files(generator):
+        if not f.endswith('.rst'):
+            continue
+        try:
+            plugin.ingest(os.path.join(site['PATH'], f), rst_reader)
+        except Exception:
+            logger.exception("Could not read %s", f)
+
+    manager.commit()
+
+
+def watch_command(args):
+    from pelican.settings import read_settings
+
+    from .watch import watch
+
+    # The rebuilds and their timings are the output of the command
+    if not args.verbose:
+        logging.getLogger('pelicansage.watch').setLevel(logging.INFO)
+
+    watch(read_settings(args.settings), interval=args.interval)
+
+
+def add_store_arguments(parser):
+    parser.add_argument('-s', '--settings', help='pelican configuration file')
+    parser.add_argument('--db', help='directory of the result database (default: SAGE DB_PATH)')
+    parser.add_argument('--files', help='directory of the result images (default: SAGE FILE_BASE_PATH)')
+
+
+def create_parser():
+    parser = argparse.ArgumentParser(prog='pelicansage', description='Manage the pelicansage result store.')
+    parser.add_argument('-v', '--verbose', action='store_true')
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.required = True
+
+    export_parser = subparsers.add_parser('export', help='export the evaluated results into an archive')
+    add_store_arguments(export_parser)
+    export_parser.add_argument('archive')
+    export_parser.set_defaults(func=export_command)
+
+    import_parser = subparsers.add_parser('import', help='merge the results of an archive into the store')
+    add_store_arguments(import_parser)
+    import_parser.add_argument('archive')
+    import_parser.add_argument('--overwrite', action='store_true',
+                               help='replace the results of blocks which are already evaluated')
+    import_parser.set_defaults(func=import_command)
+
+    worker_parser = subparsers.add_parser('worker', help='evaluate the sources published to a work queue')
+    worker_parser.add_argument('-s', '--settings', help='pelican configuration file')
+    worker_parser.add_argument('--queue', help='work queue path (default: SAGE WORK_QUEUE)')
+    worker_parser.add_argument('--backend', choices=('sqlite', 'directory'),
+                               help='work queue backend (default: sqlite for .db/.sqlite paths)')
+    worker_parser.add_argument('--idle-timeout', type=float, default=None,
+                               help='exit after waiting this many seconds for work (default: never)')
+    worker_parser.set_defaults(func=worker_command)
+
+    gc_parser = subparsers.add_parser('gc', help='delete what the content no longer reaches and compact the store')
+    add_store_arguments(gc_parser)
+    gc_parser.add_argument('--no-vacuum', action='store_true', help='do not compact the database file')
+    gc_parser.set_defaults(func=gc_command)
+
+    plan_parser = subparsers.add_parser('plan', help='list the blocks a build would evaluate and estimate its time')
+    add_store_arguments(plan_parser)
+    plan_parser.add_argument('--workers', type=int, default=None,
+                             help='concurrent workers to estimate the wall time for (default: SAGE MAX_WORKERS)')
+    plan_parser.add_argument('--stored', action='store_true',
+                             help='plan from the stored blocks without reading the content')
+    plan_parser.set_defaults(func=plan_command)
+
+    watch_parser = subparsers.add_parser('watch', help='build the site and rebuild it when its content changes')
+    watch_parser.add_argument('-s', '--settings', help='pelican configuration file')
+    watch_parser.add_argument('--interval', type=float, default=0.5,
+                              help='seconds between checks for changes (default: 0.5)')
+    watch_parser.set_defaults(func=watch_command)
+
+    return parser
+
+
+def main(argv=None):
+    args = create_parser().parse_args(argv)
+
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.WARNING)
+
+    args.func(args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,29 @@
+"""
+Constants shared by the plugin, kept free of heavy imports so they can be
+used without loading the database layer.
+"""
+
+
+class ResultTypes:
+    Image, Stream, Error = range(3)
+    ALL_STR = ('image', 'stream', 'error')
+    ALL_NUM = [x for x in range(3)]
+
+
+LanguagesStrEnum = ('python',
+                   'sage',
+                   'haskell',
+                   'scala',
+                   'java',
+                   'groovy',
+                   'kotlin',
+                   'clojure',
+                   'r',
+                   'octave',
+                   'maxima',
+                   'gap',
+                   'gp')
+
+# Languages a Sage cell server evaluates through the Sage interface of the
+# same name, e.g. r.eval(code)
+SAGE_INTERFACES = ('r', 'octave', 'maxima', 'gap', 'gp')
@@ -0,0 +1,548 @@
+"""
+Evaluation of the collected code blocks against the configured cell servers.
+
+Each source file is evaluated sequentially in its own namespace by a
+CellWorker thread, while separate sources are evaluated concurrently.
+Results are passed back to the calling thread through a queue so all
+database access stays on a single thread.
+"""
+
+import logging
+import os
+import time
+import timeit
+from collections import namedtuple, defaultdict
+from queue import Queue
+from threading import Thread
+from uuid import uuid4
+
+from .constants import LanguagesStrEnum, ResultTypes
+from .managefiles import CodeBlock, DataSrc, chain_hashes
+from .pelicansageio import create_directory_tree
+from .scheduler import SourceGraph, estimate_costs, simulate
+from .tracing import get_tracer
+from .util import CellResult, SageError
+
+logger = logging.getLogger(__name__)
+
+_TRACER = get_tracer()
+
+# A detached copy of a CodeBlock which can be safely handed to a worker thread,
+# timeout is the deadline of the block in seconds, if it has its own
+BlockTask = namedtuple('BlockTask', 'id src order content language platform evaluated chain timeout',
+                       defaults=(None,))
+
+# Languages whose namespaces can be checkpointed by a supporting client
+CHECKPOINT_LANGUAGES = ('python', 'sage')
+
+# Seconds between the warnings logged while no work queue results arrive
+QUEUE_WARNING_INTERVAL = 60.0
+
+
+def create_tasks(code_blocks):
+    code_blocks = sorted(code_blocks, key=lambda x: x.order)
+
+    return [BlockTask(block.id, block.src.src, block.order, block.content,
+                      block.language, block.platform, block.last_evaluated is not None, chain,
+                      block.timeout)
+            for block, chain in zip(code_blocks, chain_hashes(code_blocks))]
+
+
+def route_of(block, cell):
+    """
+    Returns the key of the client in cell evaluating block, a dedicated
+    (platform, language) route if there is one, otherwise the platform.
+    """
+    route = (block.platform, block.language)
+    if route in cell:
+        return route
+
+    if block.platform in cell:
+        return block.platform
+
+    return None
+
+
+class CellWorker(Thread):
+    """
+    Evaluates the blocks of a single source in order.
+
+    Each block is evaluated by the client of its route, see route_of.  The
+    results of every block are put on the queue as (src, result) as soon
+    as the block completes, followed by (src, None) once the source is
+    finished.  Blocks which were evaluated by a previous build are replayed
+    silently to rebuild the namespace.  When a client fails, only that client
+    is re-established, the blocks of its route before the failing one are
+    replayed silently and evaluation resumes at the failing block.
+
+    If a checkpoint directory is given and the source runs on a single
+    client supporting checkpoints, the namespace is saved after each block
+    keyed by its chain hash.  Rebuilding a namespace then restores the
+    nearest checkpoint and only replays the blocks after it.
+
+    A warm cell already evaluated the source in a previous build, the
+    blocks evaluated then are skipped instead of replayed.  The clients are
+    cleaned up when the source is finished unless cleanup is False.
+
+    A block running longer than its own timeout, or timeout seconds if it
+    has none, is interrupted and a TimeoutError is recorded as its last
+    result.  With on_timeout 'continue' the following blocks are evaluated
+    as usual, with 'skip' they are not evaluated and record an error
+    instead.
+    """
+
+    def __init__(self, queue, blocks, cell, queued=None, retries=1, backoff=1.0, checkpoints=None,
+                 warm=False, cleanup=True, timeout=None, on_timeout='continue'):
+        self.__queue = queue
+        self.__blocks = blocks
+        self.__cell = cell
+        self.__queued = timeit.default_timer() if queued is None else queued
+        self.__retries = retries
+        self.__backoff = backoff
+        self.__routes = [route_of(block, cell) for block in blocks]
+        self.__checkpoints = checkpoints if self._can_checkpoint() else None
+        self.__warm = warm
+        self.__cleanup = cleanup
+        self.__timeout = timeout
+        self.__on_timeout = on_timeout
+        self.failed = False
+        Thread.__init__(self)
+
+    def _can_checkpoint(self):
+        routes = set(self.__routes)
+
+        if len(routes) != 1 or None in routes:
+            return False
+
+        cell = self.__cell[routes.pop()]
+
+        return (cell.supports_checkpoints and
+                all(block.language in CHECKPOINT_LANGUAGES for block in self.__blocks))
+
+    def _checkpoint_path(self, block):
+        return os.path.join(self.__checkpoints, block.chain + '.pkl')
+
+    def _save_checkpoint(self, cell, block):
+        if self.__checkpoints is None:
+            return
+
+        path = self._checkpoint_path(block)
+        if os.path.exists(path):
+            return
+
+        if not cell.checkpoint(path):
+            logger.info("Namespace of %s can not be checkpointed after block %d, disabling checkpoints.",
+                        block.src, block.order)
+            self.__checkpoints = None
+
+    def _restore_checkpoint(self, cell, indx):
+        """
+        Restores the nearest checkpoint before block indx and returns the
+        index of the first block which still needs to be replayed.
+        """
+        if self.__checkpoints is None:
+            return 0
+
+        for nearest in range(indx - 1, -1, -1):
+            path = self._checkpoint_path(self.__blocks[nearest])
+            if not os.path.exists(path):
+                continue
+
+            if cell.restore(path):
+                logger.info("Restored checkpoint of %s after block %d.",
+                            self.__blocks[nearest].src, self.__blocks[nearest].order)
+                return nearest + 1
+
+            logger.warning("Could not restore checkpoint %s, replaying.", path)
+            cell.reset()
+            break
+
+        return 0
+
+    def run(self):
+        src = self.__blocks[0].src
+
+        logger.info("Evaluating %d blocks in %s", len(self.__blocks), src)
+        try:
+            with _TRACER.span('evaluate source', 'source', src=src, blocks=len(self.__blocks)):
+                self.execute_blocks()
+            logger.info("Evaluation complete on %s.", src)
+        except:
+            self.failed = True
+            logger.exception("Evaluation failed on %s.", src)
+        finally:
+            for cell in (self.__cell.values() if self.__cleanup else ()):
+                try:
+                    cell.cleanup()
+                except:
+                    logger.debug("Could not clean up cell for %s", src, exc_info=True)
+
+            self.__queue.put((src, None))
+
+    def _check(self, indx, block):
+        if block.language not in LanguagesStrEnum:
+            logger.error("%s is not a supported language.", block.language.upper())
+            return False
+
+        if self.__routes[indx] is None:
+            logger.error("%s not an available platform (try configuring url parameters in config file).",
+                         block.platform.upper())
+            return False
+
+        return True
+
+    def execute_blocks(self):
+        start = 0
+
+        # A warm namespace already holds the blocks evaluated before
+        if self.__checkpoints is not None and not self.__warm:
+            # Skip as much of the already evaluated prefix as possible
+            evaluated = 0
+            while evaluated < len(self.__blocks) and self.__blocks[evaluated].evaluated:
+                evaluated += 1
+
+            if evaluated:
+                start = self._restore_checkpoint(self.__cell[self.__routes[0]], evaluated)
+
+        for indx, block in enumerate(self.__blocks[start:], start):
+            if not self._check(indx, block):
+                continue
+
+            cell = self.__cell[self.__routes[indx]]
+            timed_out = False
+
+            if block.evaluated:
+                # Results are already stored, only rebuild the namespace
+                if not self.__warm:
+                    self._execute(indx, block, silent=True)
+                    timed_out = cell.timed_out
+            else:
+                resp_results, stats = self._execute(indx, block)
+                timed_out = cell.timed_out
+
+                self.__queue.put((block.src, (block.id, resp_results, stats)))
+
+            if timed_out:
+                logger.warning("Block %d of %s timed out after %g seconds.",
+                               block.order, block.src, self._timeout(block))
+                if self.__on_timeout == 'skip':
+                    self._skip(indx)
+                    return
+                # The namespace is incomplete, do not checkpoint it
+                continue
+
+            self._save_checkpoint(cell, block)
+
+    def _timeout(self, block):
+        return self.__timeout if block.timeout is None else block.timeout
+
+    def _skip(self, indx):
+        """
+        Records an error for every unevaluated block after block indx.
+        """
+        timed_out = self.__blocks[indx]
+
+        for block in self.__blocks[indx + 1:]:
+            if block.evaluated:
+                continue
+            error = SageError('Skipped', 'Not evaluated, block %d timed out' % (timed_out.order + 1,), '')
+            self.__queue.put((block.src, (block.id, [CellResult(ResultTypes.Error, 0, error,
+                                                                'text/x-python-traceback')], {})))
+
+    def _replay(self, indx):
+        route = self.__routes[indx]
+        cell = self.__cell[route]
+
+        start = self._restore_checkpoint(cell, indx)
+
+        for block, block_route in zip(self.__blocks[start:indx], self.__routes[start:indx]):
+            if block_route == route and block.language in LanguagesStrEnum:
+                cell.execute_request(block.content, silent=True, timeout=self._timeout(block))
+
+    def _execute(self, indx, block, silent=False):
+        cell = self.__cell[self.__routes[indx]]
+
+        attempt = 0
+        replay = False
+
+        while True:
+            try:
+                if replay:
+                    logger.info("Replaying %d blocks of %s", indx, block.src)
+                    self._replay(indx)
+                    replay = False
+
+                # Time from dispatching the source until this block started
+                queue_wait = timeit.default_timer() - self.__queued
+
+                with _TRACER.span('evaluate block', 'block', src=block.src, order=block.order,
+                                  silent=silent, attempt=attempt):
+                    response = cell.execute_request(block.content, silent=silent, timeout=self._timeout(block))
+                break
+            except Exception:
+                if attempt >= self.__retries:
+                    raise
+
+                attempt += 1
+                logger.warning("Error evaluating block %d of %s, retrying (%d of %d).",
+                               block.order, block.src, attempt, self.__retries, exc_info=True)
+                cell.reset()
+                time.sleep(self.__backoff * 2 ** (attempt - 1))
+                replay = True
+
+        if silent:
+            return [], None
+
+        resp_results = cell.get_results_from_response(response)
+
+        stats = dict(cell.stats)
+        stats['queue_wait'] = queue_wait
+        stats['images'] = len([r for r in resp_results
+                               if r.result_type == ResultTypes.Image or r.mimetype.startswith('image/')])
+
+        return resp_results, stats
+
+
+def pending_tasks(manager, sources=None):
+    """
+    Returns the tasks of every source with unevaluated code blocks, by
+    source, restricted to sources when given, and the references between
+    sources.
+    """
+    blocks, refs = manager.get_unevaluated_codeblocks()
+
+    pending = dict((tasks[0].src, tasks) for tasks in
+                   (create_tasks(code_blocks) for code_blocks in blocks if code_blocks)
+                   if sources is None or tasks[0].src in sources)
+
+    return pending, refs
+
+
+PlannedBlock = namedtuple('PlannedBlock', 'src order action estimate')
+
+
+def plan(manager, max_workers=4, sources=None):
+    """
+    Returns what evaluate would do without contacting any client: a list
+    of PlannedBlock, in dispatch order, whose action is 'run' for blocks
+    which are evaluated, 'replay' for evaluated blocks which are run again
+    silently to rebuild the namespace, 'cached' for blocks of sources
+    which are not evaluated at all and 'skipped' for unevaluated blocks of
+    sources not in sources, and the estimated wall time with max_workers
+    concurrent workers.
+    """
+    pending, refs = pending_tasks(manager, sources)
+
+    costs, estimates = estimate_costs(pending, manager.get_block_durations())
+    references = [(ref.src1.src, ref.src2.src) for ref in refs]
+
+    wall_time, started = simulate(SourceGraph(sorted(pending), references, costs), max_workers)
+
+    planned = []
+    for src in sorted(pending, key=lambda src: (started[src], src)):
+        for task in pending[src]:
+            planned.append(PlannedBlock(src, task.order, 'replay' if task.evaluated else 'run',
+                                        estimates[(src, task.order)]))
+
+    query = manager.query(DataSrc.src, CodeBlock.order, CodeBlock.last_evaluated)\
+                   .join(CodeBlock, CodeBlock.src_id == DataSrc.id)
+    for src, order, last_evaluated in sorted(query, key=lambda row: row[:2]):
+        if src not in pending:
+            skipped = last_evaluated is None and sources is not None and src not in sources
+            planned.append(PlannedBlock(src, order, 'skipped' if skipped else 'cached', 0.0))
+
+    return planned, wall_time
+
+
+def close_clients(cell):
+    for client in cell.values():
+        try:
+            client.cleanup()
+        except:
+            logger.debug("Could not clean up client %s", client, exc_info=True)
+
+
+def store_result(manager, code_id, cell_results, stats):
+    """
+    Writes the results of a single evaluated block to the database.
+    """
+    for result in cell_results:
+        if result.result_type == ResultTypes.Error:
+            manager.create_error(code_id,
+                                 result.data.ename,
+                                 result.data.evalue,
+                                 result.data.traceback,
+                                 result.order)
+        elif result.result_type == ResultTypes.Image and isinstance(result.data, bytes):
+            file_name = '%s_%s.%s' % (result.order, uuid4().hex, result.mimetype.split('/')[-1])
+            manager.save_file(code_id, result.data, file_name, result.order, result.mimetype)
+        elif result.result_type == ResultTypes.Image:
+            file_name = os.path.basename(result.data)
+            manager.create_file(code_id, result.data, file_name, result.order, result.mimetype)
+        else:
+            manager.create_result(code_id, result.data, result.order, result.mimetype)
+
+    manager.timestamp_code(code_id)
+    manager.record_stats(code_id, **stats)
+    manager.commit()
+
+
+def evaluate(manager, create_clients, max_workers=4, retries=1, backoff=1.0, checkpoints=None,
+             limits=None, work_queue=None, poll=0.5, kernels=None, timeout=None, on_timeout='continue',
+             sources=None, queue_timeout=None):
+    """
+    Evaluates every source with unevaluated code blocks, only those in
+    sources when given.
+
+    create_clients is called once per source and returns a dictionary
+    of platform name, or (platform, language) route, to client.  limits
+    optionally maps routes to the number of sources which may use the
+    route at the same time.  At most max_workers sources are
+    evaluated at the same time.  A failing block is retried up to retries
+    times, waiting backoff seconds before the first retry and doubling the
+    wait for each further one.  Namespace checkpoints are kept in the
+    checkpoints directory when it is given.
+
+    With a work_queue (see workqueue.py) sources are published as work
+    units instead of being evaluated here, and the results posted by the
+    workers are collected every poll seconds.  max_workers does not apply,
+    the number of running workers bounds the concurrency.  While no results
+    arrive a warning naming the pending sources is logged every
+    QUEUE_WARNING_INTERVAL seconds, after queue_timeout seconds the
+    remaining sources are given up and left unevaluated.
+
+    kernels, a dictionary of source to clients, keeps the clients of each
+    source alive across calls.  A source evaluated again reuses its warm
+    clients and only runs its unevaluated blocks, on top of the namespace
+    left by the previous evaluation.
+
+    Blocks without a timeout of their own may run for timeout seconds,
+    on_timeout decides what happens to the rest of their source, see
+    CellWorker.
+    """
+    if checkpoints is not None:
+        create_directory_tree(checkpoints)
+
+    pending, refs = pending_tasks(manager, sources)
+
+    if not pending:
+        return
+
+    # Sources are dispatched once every source they reference is evaluated,
+    # the longest first
+    costs, _ = estimate_costs(pending, manager.get_block_durations())
+    graph = SourceGraph(sorted(pending), [(ref.src1.src, ref.src2.src) for ref in refs], costs)
+
+    logger.info("Evaluating %d sources, estimated %.1f seconds of evaluation.", len(pending), sum(costs.values()))
+
+    queue = Queue()
+    queued = timeit.default_timer()
+    running = 0
+
+    limits = limits or {}
+    in_use = defaultdict(int)
+    routes = {}
+
+    def limited_routes(src):
+        used = set()
+        for task in pending[src]:
+            if (task.platform, task.language) in limits:
+                used.add((task.platform, task.language))
+            elif task.platform in limits:
+                used.add(task.platform)
+        return used
+
+    def has_capacity(src):
+        return all(in_use[route] < max(1, limits[route]) for route in limited_routes(src))
+
+    # Work units published to work_queue, by source
+    units = {}
+    # Blocks whose results are stored, a unit claimed again after its
+    # lease expired posts the results of its blocks a second time
+    stored = set()
+
+    # Workers evaluating warm kernels, by source
+    workers = {}
+
+    def dispatch(src):
+        tasks = pending.pop(src)
+        if work_queue is None and kernels is not None:
+            warm = src in kernels
+            if not warm:
+                kernels[src] = create_clients()
+            workers[src] = CellWorker(queue, tasks, kernels[src], queued, retries, backoff, checkpoints,
+                                      warm=warm, cleanup=False, timeout=timeout, on_timeout=on_timeout)
+            workers[src].start()
+        elif work_queue is None:
+            CellWorker(queue, tasks, create_clients(), queued, retries, backoff, checkpoints,
+                       timeout=timeout, on_timeout=on_timeout).start()
+        else:
+            units[src] = work_queue.publish(src, tasks)
+
+    def next_results():
+        if work_queue is None:
+            return [queue.get()]
+
+        waiting = warned = timeit.default_timer()
+        while True:
+            collected = work_queue.collect(units.values())
+            if collected:
+                return collected
+
+            now = timeit.default_timer()
+            if queue_timeout is not None and now - waiting >= queue_timeout:
+                return None
+            if now - warned >= QUEUE_WARNING_INTERVAL:
+                logger.warning("No results from the work queue for %.0f seconds, waiting for %s.",
+                               now - waiting, ', '.join(sorted(units)))
+                warned = now
+            time.sleep(poll)
+
+    while graph.has_ready() or running:
+        while work_queue is not None or running < max(1, max_workers):
+            # Sources whose routes are saturated do not hold up the others
+            src = graph.pop_ready(has_capacity)
+            if src is None:
+                break
+
+            routes[src] = limited_routes(src)
+            for route in routes[src]:
+                in_use[route] += 1
+
+            dispatch(src)
+            running += 1
+
+        if not running:
+            break
+
+        collected = next_results()
+        if collected is None:
+            remaining = sorted(set(units) | set(pending))
+            logger.error("No results from the work queue for %g seconds, %d sources are left unevaluated: %s.",
+                         queue_timeout, len(remaining), ', '.join(remaining))
+            for unit in units.values():
+                work_queue.remove(unit)
+            break
+
+        for src, result in collected:
+            if src not in routes:
+                # Posted by a worker whose lease expired
+                continue
+
+            if result is None:
+                running -= 1
+                for route in routes.pop(src):
+                    in_use[route] -= 1
+                with _TRACER.span('permalink', 'db', src=src):
+                    manager.compute_permalink(src)
+                    manager.commit()
+                if src in units:
+                    work_queue.remove(units.pop(src))
+                if src in workers and workers.pop(src).failed:
+                    # The namespace is in an unknown state, start over next time
+                    close_clients(kernels.pop(src))
+                graph.complete(src)
+            elif result[0] not in stored:
+                stored.add(result[0])
+                with _TRACER.span('store result', 'db', src=src):
+                    store_result(manager, *result)
@@ -1,25 +1,25 @@
 from sqlite3 import IntegrityError
 
 import sqlalchemy
-from sqlalchemy import Table, Column, Integer, String, ForeignKey, Enum
+from sqlalchemy import Table, Column, Integer, String, ForeignKey, Enum, Float, LargeBinary
 from sqlalchemy.types import DateTime
-from sqlalchemy.orm import sessionmaker, relationship, mapper
+from sqlalchemy.orm import sessionmaker, relationship, mapper, deferred
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.engine.reflection import Inspector
 
 from .pelicansageio import pelicansageio
+from .constants import ResultTypes, LanguagesStrEnum
 
 import zlib
 import base64
+import hashlib
+import os
 import sys
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
 
 from uuid import uuid4
 
-class ResultTypes:
-    Image, Stream, Error = range(3)
-    ALL_STR = ('image', 'stream', 'error')
-    ALL_NUM = [x for x in range(3)]
-
 Base = declarative_base()
 
 MimeType = Enum('text/plain',
@@ -28,26 +28,89 @@ MimeType = Enum('text/plain',
                 'text/x-python-traceback',
                 'image/png')
 
-LanguagesStrEnum = ('python',
-                   'sage',
-                   'haskell',
-                   'scala',
-                   'java',
-                   'groovy',
-                   'kotlin',
-                   'clojure',
-                   'r',
-                   'octave',
-                   'maxima',
-                   'gap',
-                   'gp')
-
 Platforms = Enum('sage', 'ipython', 'ihaskell', 'ipynb')
 
 FileTypes = Enum('rst', 'ipynb', 'json')
 
 Languages = Enum(*LanguagesStrEnum)
 
+def chain_hashes(code_blocks):
+    """
+    Returns a hash for every block, in order, identifying the block
+    together with all blocks evaluated before it in the same namespace.
+    """
+    hashes = []
+    previous = ''
+
+    for block in code_blocks:
+        chain = '\0'.join((previous, block.platform or '', block.language or '', block.content or ''))
+        previous = hashlib.sha1(chain.encode('utf-8')).hexdigest()
+        hashes.append(previous)
+
+    return hashes
+
+def content_hash(content):
+    """
+    Returns the hash identifying the content of a code block.
+    """
+    return hashlib.sha1((content or '').encode('utf-8')).hexdigest()
+
+
+def gen_permalink(content):
+
+    if sys.version_info[0] > 2:
+        content = bytes(content, 'UTF-8')
+
+    permalink = base64.urlsafe_b64encode(zlib.compress(content))
+
+    if sys.version_info[0] > 2:
+        permalink = permalink.decode('UTF-8')
+
+    return permalink
+
+
+# Sources larger than this many characters have their permalinks compressed
+# concurrently, zlib releases the GIL while compressing.
+PERMALINK_POOL_THRESHOLD = 1 << 16
+
+# Result payloads shorter than this many bytes are stored uncompressed
+BLOB_COMPRESS_THRESHOLD = 128
+
+BLOB_CODECS = ('zlib', 'zstd')
+
+
+def compress_payload(text, codec='zlib'):
+    """
+    Returns the codec used and the compressed UTF-8 encoding of text.
+    """
+    raw = text.encode('utf-8')
+
+    if len(raw) < BLOB_COMPRESS_THRESHOLD:
+        return 'raw', raw
+
+    if codec == 'zstd':
+        import zstandard
+        return codec, zstandard.ZstdCompressor().compress(raw)
+
+    return 'zlib', zlib.compress(raw)
+
+
+def decompress_payload(codec, payload):
+    if codec == 'raw':
+        raw = payload
+    elif codec == 'zlib':
+        raw = zlib.decompress(payload)
+    elif codec == 'zstd':
+        import zstandard
+        raw = zstandard.ZstdDecompressor().decompress(payload)
+    else:
+        raise ValueError("Unknown result blob codec %r" % (codec,))
+
+    return raw.decode('utf-8')
+
+
+PERMALINK_SEPARATOR = "\npretty_print(html('<br/><hr/><br/>'))\n#" + '-'*40 + "\n"
+
 class BaseMixin(object):
     @property
     def data(self):
@@ -76,6 +139,15 @@ class DataSrc(Base, BaseMixin):
     src = Column(String, unique=True)
     permalink = Column(String)
     filetype = Column(FileTypes, default='rst')
+    # Hash over the content hashes of the blocks, and the one the
+    # permalink was generated from
+    content_hash = Column(String)
+    permalink_hash = Column(String)
+    # Fingerprint of the rendered results the cached page was read with
+    result_fingerprint = Column(String)
+    # Pelican status of the source and the output its page is saved as
+    status = Column(String)
+    output = Column(String)
     
     code_blocks = relationship('CodeBlock', backref='DataSrc',
                                 cascade='save-update, merge, delete')
@@ -95,6 +167,12 @@ class CodeBlock(Base, BaseMixin):
     permalink = Column(String)
     language = Column(Languages)
     platform = Column(Platforms)
+    content_hash = Column(String)
+    permalink_hash = Column(String)
+    # Seconds the block may run, the BLOCK_TIMEOUT setting if None
+    timeout = Column(Float)
+    # Seconds the block was given, its timeout or the BLOCK_TIMEOUT setting
+    deadline = Column(Float)
 
     src = relationship('DataSrc', backref='DataSrc')
     stream_results = relationship('StreamResult', backref='CodeBlock',
@@ -109,14 +187,40 @@ class CodeBlock(Base, BaseMixin):
         return sorted(self.stream_results + self.file_results + self.error_results,
                       key = lambda x : x.order)
 
+class ResultBlob(Base, BaseMixin):
+    """
+    A compressed result payload, stored once however many results share
+    it.  refs counts the results referencing the blob, blobs which are no
+    longer referenced are kept for reuse until garbage collection.
+    """
+    __tablename__ = 'ResultBlob'
+    id = Column(Integer, primary_key=True)
+    hash = Column(String, unique=True)
+    codec = Column(String)
+    size = Column(Integer)
+    refs = Column(Integer, default=0)
+    payload = deferred(Column(LargeBinary))
+
+    @property
+    def text(self):
+        return decompress_payload(self.codec, self.payload)
+
 class StreamResult(Base, BaseMixin):
     __tablename__ = 'StreamResult'
     id = Column(Integer, primary_key=True)
-    result = Column(String, nullable=True)
+    # Payload of results stored before ResultBlob, moved on opening
+    _result = deferred(Column('result', String, nullable=True))
+    blob_id = Column(Integer, ForeignKey('ResultBlob.id'))
     code_id = Column(Integer, ForeignKey('CodeBlock.id'), nullable=False)
     order = Column(Integer)
     mimetype = Column(MimeType)
 
+    blob = relationship('ResultBlob')
+
+    @property
+    def result(self):
+        return self._result if self.blob is None else self.blob.text
+
     @property
     def data(self):
         return self.result
@@ -138,16 +242,48 @@ class ErrorResult(Base, BaseMixin):
     order = Column(Integer)
     ename = Column(String)
     evalue = Column(String)
-    traceback = Column(String)
+    _traceback = deferred(Column('traceback', String))
+    traceback_blob_id = Column(Integer, ForeignKey('ResultBlob.id'))
     code_id = Column(Integer, ForeignKey('CodeBlock.id'), nullable=False)
     type = ResultTypes.Error
     mimetype = 'text/x-python-traceback'
 
+    traceback_blob = relationship('ResultBlob')
+
+    @property
+    def traceback(self):
+        return self._traceback if self.traceback_blob is None else self.traceback_blob.text
+
+class BlockStats(Base, BaseMixin):
+    __tablename__ = 'BlockStats'
+    id = Column(Integer, primary_key=True)
+    code_id = Column(Integer, ForeignKey('CodeBlock.id'), nullable=False)
+    src_id = Column(Integer, ForeignKey('DataSrc.id'))
+    order = Column(Integer)
+    evaluated = Column(DateTime)
+    queue_wait = Column(Float, default=0.0)
+    setup_time = Column(Float, default=0.0)
+    exec_time = Column(Float, default=0.0)
+    output_bytes = Column(Integer, default=0)
+    iopub_messages = Column(Integer, default=0)
+    images = Column(Integer, default=0)
+    endpoint = Column(String)
+
+    src = relationship('DataSrc')
+
 class FileManager(object):
 
-    def __init__(self, location=None, base_path=None, db_name=None, io=None, echo_sql=False):
+    def __init__(self, location=None, base_path=None, db_name=None, io=None, echo_sql=False, codec='zlib'):
         self.io = pelicansageio if io is None else io
 
+        if codec not in BLOB_CODECS:
+            raise ValueError("Result blob codec must be one of %s, not %r" % (', '.join(BLOB_CODECS), codec))
+        if codec == 'zstd':
+            # Fail early rather than on the first stored result
+            import zstandard
+
+        self._codec = codec
+
         # Throw away results after each computation of pelican pages
         if location and location != ':memory:':
             self.location = self.io.join(location, 'content.db' if db_name is None else db_name)
@@ -170,17 +306,108 @@ class FileManager(object):
 
         insp = Inspector.from_engine(self._engine)
 
-        if 'CodeBlock' in insp.get_table_names():
-            return
+        existing = 'CodeBlock' in insp.get_table_names()
 
+        # Always create missing tables, databases persisted by an older
+        # version may not have all of them.
         Base.metadata.create_all(self._engine)
 
+        if existing:
+            self._add_missing_columns(insp)
+            self._migrate_payloads()
+            return
+
         self._session.add(EvaluationType(name='STATIC'))
         self._session.add(EvaluationType(name='DYNAMIC'))
         self._session.add(EvaluationType(name='CLIENT'))
         
         self._session.commit()
 
+    def _add_missing_columns(self, insp):
+        """
+        Adds columns introduced after a persisted database was created,
+        create_all only creates missing tables.
+        """
+        for table in Base.metadata.sorted_tables:
+            columns = set(c['name'] for c in insp.get_columns(table.name))
+
+            for column in table.columns:
+                if column.name in columns:
+                    continue
+
+                column_type = column.type.compile(dialect=self._engine.dialect)
+                with self._engine.begin() as connection:
+                    connection.execute(sqlalchemy.text('ALTER TABLE "%s" ADD COLUMN "%s" %s' %
+                                                       (table.name, column.name, column_type)))
+
+    def _migrate_payloads(self, batch=500):
+        """
+        Moves the payloads of results stored before ResultBlob into blobs.
+        """
+        for table, payload, blob_id in ((StreamResult, StreamResult._result, StreamResult.blob_id),
+                                        (ErrorResult, ErrorResult._traceback, ErrorResult.traceback_blob_id)):
+            while True:
+                rows = self._session.query(table.id, payload).filter(blob_id == None, payload != None)\
+                                    .limit(batch).all()
+                if not rows:
+                    break
+
+                for row_id, text in rows:
+                    self._session.query(table).filter(table.id == row_id)\
+                                 .update({blob_id: self._store_blob(text), payload: None},
+                                         synchronize_session=False)
+
+                self._session.commit()
+
+    def _store_blob(self, text):
+        """
+        Returns the id of the blob holding text, adding a reference to it.
+        """
+        if text is None:
+            return None
+
+        digest = content_hash(text)
+
+        blob = self._session.query(ResultBlob).filter_by(hash=digest).first()
+
+        if blob is None:
+            codec, payload = compress_payload(text, self._codec)
+            blob = ResultBlob(hash=digest, codec=codec, size=len(text.encode('utf-8')), refs=0, payload=payload)
+            self._session.add(blob)
+
+        blob.refs += 1
+        self._session.flush()
+
+        return blob.id
+
+    def delete_results(self, code_ids):
+        """
+        Deletes the results of the code blocks code_ids and releases the
+        blobs they reference.
+        """
+        code_ids = list(code_ids)
+        if not code_ids:
+            return
+
+        released = Counter()
+        for blob_id in (StreamResult.blob_id, ErrorResult.traceback_blob_id):
+            released.update(row_blob_id for (row_blob_id,) in
+                            self._session.query(blob_id).filter(blob_id.class_.code_id.in_(code_ids))
+                            if row_blob_id is not None)
+
+        for blob_id, count in released.items():
+            self._session.query(ResultBlob).filter(ResultBlob.id == blob_id)\
+                         .update({ResultBlob.refs: ResultBlob.refs - count}, synchronize_session=False)
+
+        for table in (StreamResult, ErrorResult, FileResult):
+            self._session.query(table).filter(table.code_id.in_(code_ids)).delete()
+
+    def query(self, *entities):
+        """
+        Returns a read query over entities, e.g. columns of the models.
+        """
+        return self._session.query(*entities)
+
     def commit(self):
         self._session.commit()
     
@@ -236,6 +463,72 @@ class FileManager(object):
 
         return src_ref_obj
 
+    def _reachable(self, srcs, upstream=False):
+        edges = {}
+        for src1, src2 in self._session.query(SrcReference.src_id1, SrcReference.src_id2):
+            if upstream:
+                edges.setdefault(src1, set()).add(src2)
+            else:
+                edges.setdefault(src2, set()).add(src1)
+
+        names = dict(self._session.query(DataSrc.id, DataSrc.src))
+        ids = dict((name, src_id) for src_id, name in names.items())
+
+        found = set()
+        todo = [ids[src] for src in srcs if src in ids]
+        while todo:
+            for src_id in edges.get(todo.pop(), ()):
+                if names[src_id] not in found:
+                    found.add(names[src_id])
+                    todo.append(src_id)
+
+        return found - set(srcs)
+
+    def get_referencing_sources(self, srcs):
+        """
+        Returns the sources embedding results of any of srcs, directly or
+        through other sources.
+        """
+        return self._reachable(srcs)
+
+    def get_referenced_sources(self, srcs):
+        """
+        Returns the sources whose results any of srcs embed, directly or
+        through other sources.
+        """
+        return self._reachable(srcs, upstream=True)
+
+    def set_status(self, src, status):
+        """
+        Records the Pelican status (published, draft, hidden, ...) of src,
+        sources without code blocks are not stored.
+        """
+        self._session.query(DataSrc).filter_by(src=src).update({DataSrc.status: status},
+                                                               synchronize_session=False)
+
+    def get_statuses(self):
+        """
+        Returns the recorded status of every source, None if unknown.
+        """
+        return dict(self._session.query(DataSrc.src, DataSrc.status))
+
+    def record_outputs(self, outputs):
+        """
+        Records the outputs the pages of sources are saved as, outputs maps
+        output paths relative to the output directory to sources.
+        """
+        ids = dict(self._session.query(DataSrc.src, DataSrc.id))
+        self._session.bulk_update_mappings(DataSrc, [{'id': ids[src], 'output': output}
+                                                     for output, src in outputs.items() if src in ids])
+        self._session.commit()
+
+    def get_output_sources(self, outputs):
+        """
+        Returns the sources whose pages are saved as any of outputs, by
+        output.  Outputs no stored source was saved as are left out.
+        """
+        return dict(self._session.query(DataSrc.output, DataSrc.src).filter(DataSrc.output.in_(list(outputs))))
+
     def create_src(self, src):
         src_obj = self._session.query(DataSrc).filter_by(src=src).first()
 
@@ -250,40 +543,85 @@ class FileManager(object):
 
         return src_obj
 
+    def _block_hash(self, block):
+        if block.content_hash is None:
+            # Blocks stored before content hashes were introduced
+            block.content_hash = content_hash(block.content)
+            self._session.add(block)
+        return block.content_hash
+
     def compute_permalink(self, src):
+        """
+        Generates the permalinks of src and its code blocks, only those
+        whose content changed since their permalink was generated are
+        regenerated.
+        """
         src_obj = self.create_src(src)
 
-        blocks = src_obj.code_blocks
+        blocks = sorted(src_obj.code_blocks, key=lambda x: x.order)
 
         if len(blocks) == 0:
             return
 
-        code = ''
-        code += ("\npretty_print(html('<br/><hr/><br/>'))\n#" + '-'*40 + "\n").join([block.content for block in blocks])
+        src_hash = content_hash('\0'.join(self._block_hash(block) for block in blocks))
+        src_obj.content_hash = src_hash
+
+        stale = [block for block in blocks
+                 if block.permalink is None or block.permalink_hash != block.content_hash]
 
-        def gen_permalink(content):
+        contents = [block.content for block in stale]
 
-            if sys.version_info[0] > 2:
-                content = bytes(content, 'UTF-8')
+        if src_obj.permalink is None or src_obj.permalink_hash != src_hash:
+            contents.append(PERMALINK_SEPARATOR.join([block.content for block in blocks]))
 
-            permalink = base64.urlsafe_b64encode(zlib.compress(content))
+        if not contents:
+            return
 
-            if sys.version_info[0] > 2:
-                permalink = permalink.decode('UTF-8')
+        if sum(len(content) for content in contents) > PERMALINK_POOL_THRESHOLD and len(contents) > 1:
+            # Scoped to the batch, the threads do not outlive the call
+            with ThreadPoolExecutor() as pool:
+                permalinks = list(pool.map(gen_permalink, contents))
+        else:
+            permalinks = [gen_permalink(content) for content in contents]
 
-            return permalink
+        for block, permalink in zip(stale, permalinks):
+            block.permalink = permalink
+            block.permalink_hash = block.content_hash
+            self._session.add(block)
 
-        src_obj.permalink = gen_permalink(code)
+        if len(permalinks) > len(stale):
+            src_obj.permalink = permalinks[-1]
+            src_obj.permalink_hash = src_hash
 
         self._session.add(src_obj)
 
-        for block in blocks:
-            block.permalink = gen_permalink(block.content)
-            self._session.add(block)
-
         self._session.flush()
 
-    def create_code(self, code, src, order, user_id=None, language='sage', platform='sage'):
+    def _delete_results_from(self, block):
+        """
+        Deletes the results and files of block and of every block after
+        it in its source, returns those blocks.
+        """
+        code_blocks_in_src = self._session.query(CodeBlock).filter(CodeBlock.src_id == block.src_id,
+                                                                   CodeBlock.order >= block.order).all()
+
+        for code_obj in code_blocks_in_src:
+            if self._base_path is not None:
+                self.io.delete_directory(self.io.join(self._base_path, str(code_obj.id)))
+
+        self.delete_results(code_obj.id for code_obj in code_blocks_in_src)
+
+        return code_blocks_in_src
+
+    def _timed_out(self, block):
+        return self._session.query(ErrorResult).filter(ErrorResult.code_id == block.id,
+                                                       ErrorResult.ename == 'TimeoutError').first() is not None
+
+    def create_code(self, code, src, order, user_id=None, language='sage', platform='sage', timeout=None,
+                    default_timeout=None):
+        code_hash = content_hash(code)
+        deadline = default_timeout if timeout is None else timeout
+
         # check for an exisiting user id
 
         if user_id is not None:
@@ -311,24 +649,15 @@ class FileManager(object):
                               language=language,
                               platform=platform,
                               user_id=user_id,
-                              order=order)
-        elif fetch.content != code:
-
-            # We will need to regenerate results for this source file
-            code_blocks_in_src = self._session.query(CodeBlock).filter(CodeBlock.src_id == fetch.src_id).all()
-
-            for code_obj in code_blocks_in_src:
+                              order=order,
+                              content_hash=code_hash,
+                              timeout=timeout,
+                              deadline=deadline)
+        elif self._block_hash(fetch) != code_hash:
 
-                code_id = code_obj.id
-
-                if self._base_path is not None:
-                    file_location_path = self.io.join(self._base_path, str(code_id))
-                    self.io.delete_directory(file_location_path)
-
-                for table in (StreamResult, ErrorResult, FileResult):
-                    query = self._session.query(table).filter(table.code_id==code_id)
-
-                    query.delete()
+            # We will need to regenerate results for this block and every
+            # block after it, the results of earlier blocks are still valid.
+            self._delete_results_from(fetch)
 
             # get all id's for the source
 
@@ -340,9 +669,20 @@ class FileManager(object):
             self._session.commit()
             
             fetch.content=code
+            fetch.content_hash = code_hash
             fetch.user_id = user_id
             fetch.last_evaluated = None
 
+        elif fetch.deadline != deadline and self._timed_out(fetch):
+            # The block ran out of time, it and the blocks after it (which
+            # ran without it or were skipped) get another chance
+            for code_obj in self._delete_results_from(fetch):
+                code_obj.last_evaluated = None
+
+        # A new deadline applies from the next evaluation on
+        fetch.timeout = timeout
+        fetch.deadline = deadline
+
         self._session.add(fetch)
         self._session.flush()
         self._session.commit()
@@ -390,7 +730,8 @@ class FileManager(object):
 
     def create_result(self, code_id, result_text, order=None, mimetype='text/plain'):
 
-        result = StreamResult(result=result_text, code_id=code_id, order=order, mimetype=mimetype)
+        result = StreamResult(blob_id=self._store_blob(result_text), code_id=code_id, order=order,
+                              mimetype=mimetype)
 
         self._session.add(result)
         self._session.flush()#self._session.commit()
@@ -404,6 +745,16 @@ class FileManager(object):
 
         return code_obj.stream_results
 
+    def file_location(self, code_id, file_name):
+        """
+        Returns the path a file result of code_id is stored at, or None if
+        files are not stored.
+        """
+        if self._base_path is None:
+            return None
+
+        return self.io.join(self._base_path, str(code_id), file_name)
+
     def save_file(self, code_id, raw, file_name, order=None, mimetype=None):
         file_location = None
 
@@ -412,7 +763,8 @@ class FileManager(object):
             self.io.create_directory_tree(file_location_path)
             file_location = self.io.join(file_location_path, file_name)
 
-        self.io.save_data_to_file(raw, file_location)
+        if file_location is not None:
+            self.io.save_data_to_file(raw, file_location)
 
         file_result = FileResult(code_id=code_id,
                                  file_name=file_name,
@@ -459,7 +811,265 @@ class FileManager(object):
         error_result = ErrorResult(code_id=code_id,
                                    ename=ename,
                                    evalue=evalue,
-                                   traceback=traceback,
+                                   traceback_blob_id=self._store_blob(traceback),
                                    order=order)
         self._session.add(error_result)
         self._session.flush()#self._session.commit()
+
+    def record_stats(self, code_id, timestamp=None, **stats):
+        """
+        Stores the execution statistics of a single code block evaluation.
+        """
+        code_obj = self._session.query(CodeBlock).filter_by(id=code_id).first()
+
+        block_stats = BlockStats(code_id=code_id,
+                                 src_id=None if code_obj is None else code_obj.src_id,
+                                 order=None if code_obj is None else code_obj.order,
+                                 evaluated=self.io.datetime.now() if timestamp is None else timestamp,
+                                 **stats)
+
+        self._session.add(block_stats)
+        self._session.flush()#self._session.commit()
+
+        return block_stats
+
+    def get_stats(self, since=None):
+        """
+        Returns the recorded block statistics, optionally only those
+        recorded after the datetime since.
+        """
+        query = self._session.query(BlockStats)
+
+        if since is not None:
+            query = query.filter(BlockStats.evaluated >= since)
+
+        return query.order_by(BlockStats.id).all()
+
+    def get_block_durations(self):
+        """
+        Returns the duration, setup and execution, of the most recent
+        evaluation of every block by (src, order).
+        """
+        durations = {}
+
+        for src, order, setup_time, exec_time in self._session.query(DataSrc.src, BlockStats.order,
+                                                                     BlockStats.setup_time,
+                                                                     BlockStats.exec_time)\
+                                                              .join(DataSrc, BlockStats.src_id == DataSrc.id)\
+                                                              .order_by(BlockStats.id):
+            durations[(src, order)] = (setup_time or 0.0) + (exec_time or 0.0)
+
+        return durations
+
+    def result_fingerprints(self, salt=''):
+        """
+        Returns a fingerprint of the results every source renders, its own
+        and those of the sources it embeds results of, directly or through
+        other sources.  salt stands for whatever else the rendering depends
+        on.
+        """
+        parts = dict((src_id, []) for src_id, in self._session.query(DataSrc.id))
+
+        for src_id, order, permalink in self._session.query(CodeBlock.src_id, CodeBlock.order,
+                                                            CodeBlock.permalink):
+            parts[src_id].append('block %s %s' % (order, permalink))
+
+        for src_id, block, order, mimetype, blob in self._session.query(CodeBlock.src_id, CodeBlock.order,
+                                                                        StreamResult.order, StreamResult.mimetype,
+                                                                        ResultBlob.hash)\
+                                                                 .join(StreamResult, StreamResult.code_id == CodeBlock.id)\
+                                                                 .outerjoin(ResultBlob, StreamResult.blob_id == ResultBlob.id):
+            parts[src_id].append('stream %s %s %s %s' % (block, order, mimetype, blob))
+
+        for src_id, block, order, mimetype, file_name in self._session.query(CodeBlock.src_id, CodeBlock.order,
+                                                                             FileResult.order, FileResult.mimetype,
+                                                                             FileResult.file_name)\
+                                                                      .join(FileResult, FileResult.code_id == CodeBlock.id):
+            parts[src_id].append('file %s %s %s %s' % (block, order, mimetype, file_name))
+
+        for src_id, block, order, ename, evalue, blob in self._session.query(CodeBlock.src_id, CodeBlock.order,
+                                                                             ErrorResult.order, ErrorResult.ename,
+                                                                             ErrorResult.evalue, ResultBlob.hash)\
+                                                                      .join(ErrorResult, ErrorResult.code_id == CodeBlock.id)\
+                                                                      .outerjoin(ResultBlob,
+                                                                                 ErrorResult.traceback_blob_id == ResultBlob.id):
+            parts[src_id].append('error %s %s %s %s' % (block, order, content_hash('%s\0%s' % (ename, evalue)), blob))
+
+        own = dict((src_id, content_hash('\n'.join(sorted(lines)))) for src_id, lines in parts.items())
+
+        upstream = {}
+        for src1, src2 in self._session.query(SrcReference.src_id1, SrcReference.src_id2):
+            upstream.setdefault(src1, set()).add(src2)
+
+        fingerprints = {}
+        for src_id, src in self._session.query(DataSrc.id, DataSrc.src):
+            reached = set([src_id])
+            todo = [src_id]
+            while todo:
+                for up in upstream.get(todo.pop(), ()):
+                    if up not in reached and up in own:
+                        reached.add(up)
+                        todo.append(up)
+
+            fingerprints[src] = content_hash(salt + ''.join(own[x] for x in [src_id] + sorted(reached - set([src_id]))))
+
+        return fingerprints
+
+    def changed_fingerprints(self, fingerprints):
+        """
+        Returns the sources whose fingerprint differs from the one stored by
+        store_fingerprints.
+        """
+        stored = dict(self._session.query(DataSrc.src, DataSrc.result_fingerprint))
+        return set(src for src, fingerprint in fingerprints.items() if stored.get(src) != fingerprint)
+
+    def store_fingerprints(self, fingerprints):
+        self._session.bulk_update_mappings(DataSrc, [{'id': src_id, 'result_fingerprint': fingerprints[src]}
+                                                     for src_id, src in self._session.query(DataSrc.id, DataSrc.src)
+                                                     if src in fingerprints])
+        self._session.commit()
+
+    def delete_references(self, src):
+        """
+        Deletes the references from src, they are recorded again when the
+        source is read.
+        """
+        src_obj = self._session.query(DataSrc).filter_by(src=src).first()
+        if src_obj is not None:
+            self._session.query(SrcReference).filter(SrcReference.src_id1 == src_obj.id).delete()
+
+    def collect_garbage(self, content_path=None, checkpoints=None, raw_path=None, vacuum=True):
+        """
+        Deletes what the current content can no longer reach and returns a
+        dictionary counting what was deleted, together with the bytes
+        reclaimed in the database (db_bytes) and on disk (file_bytes).
+
+        Sources whose file is missing from the content_path directory are
+        dropped with their blocks, results, statistics and references.
+        Results, statistics and references left without a block or source,
+        unreferenced result blobs, image directories (and raw snippets in
+        raw_path) of blocks which do not exist and checkpoints in the
+        checkpoints directory which no block chain can restore are deleted.
+        Sources are only dropped when content_path is given.
+        """
+        collected = dict((name, 0) for name in ('sources', 'blocks', 'results', 'references', 'blobs',
+                                                'image_dirs', 'raw_files', 'checkpoints',
+                                                'db_bytes', 'file_bytes'))
+
+        db_size = self._database_size()
+
+        if content_path is not None:
+            if not os.path.isdir(content_path):
+                raise ValueError("Content directory %s does not exist." % (content_path,))
+
+            sources = self._session.query(DataSrc.id, DataSrc.src).all()
+            missing = [src_id for src_id, src in sources if not os.path.exists(content_path + src)]
+
+            if missing and len(missing) == len(sources):
+                raise ValueError("None of the %d sources exist in %s, refusing to drop them all." %
+                                 (len(sources), content_path))
+
+            if missing:
+                code_ids = [code_id for (code_id,) in
+                            self._session.query(CodeBlock.id).filter(CodeBlock.src_id.in_(missing))]
+
+                self.delete_results(code_ids)
+                self._session.query(CodeBlock).filter(CodeBlock.src_id.in_(missing))\
+                             .delete(synchronize_session=False)
+                self._session.query(DataSrc).filter(DataSrc.id.in_(missing)).delete(synchronize_session=False)
+
+                collected['sources'] = len(missing)
+                collected['blocks'] = len(code_ids)
+
+        src_ids = self._session.query(DataSrc.id)
+        code_ids = self._session.query(CodeBlock.id)
+
+        # Blocks of sources deleted without them
+        orphans = [code_id for (code_id,) in self._session.query(CodeBlock.id)
+                   .filter(~CodeBlock.src_id.in_(src_ids))]
+        self.delete_results(orphans)
+        collected['blocks'] += self._session.query(CodeBlock).filter(CodeBlock.id.in_(orphans))\
+                                            .delete(synchronize_session=False)
+
+        for table in (StreamResult, ErrorResult, FileResult):
+            collected['results'] += self._session.query(table).filter(~table.code_id.in_(code_ids))\
+                                                 .delete(synchronize_session=False)
+
+        self._session.query(BlockStats).filter(~BlockStats.code_id.in_(code_ids))\
+                     .delete(synchronize_session=False)
+
+        collected['references'] = self._session.query(SrcReference)\
+                                      .filter(~SrcReference.src_id1.in_(src_ids) |
+                                              ~SrcReference.src_id2.in_(src_ids))\
+                                      .delete(synchronize_session=False)
+
+        # Recount the references, they are only a hint for reuse
+        refs = Counter()
+        for blob_id in (StreamResult.blob_id, ErrorResult.traceback_blob_id):
+            refs.update(dict(self._session.query(blob_id, sqlalchemy.func.count())
+                             .filter(blob_id != None).group_by(blob_id)))
+
+        for blob_id, count in self._session.query(ResultBlob.id, ResultBlob.refs):
+            if refs[blob_id] == 0:
+                self._session.query(ResultBlob).filter(ResultBlob.id == blob_id).delete(synchronize_session=False)
+                collected['blobs'] += 1
+            elif refs[blob_id] != count:
+                self._session.query(ResultBlob).filter(ResultBlob.id == blob_id)\
+                             .update({ResultBlob.refs: refs[blob_id]}, synchronize_session=False)
+
+        self._session.commit()
+
+        live = set(str(code_id) for (code_id,) in code_ids)
+
+        if self._base_path is not None and os.path.isdir(self._base_path):
+            for name in os.listdir(self._base_path):
+                path = self.io.join(self._base_path, name)
+                if name.isdigit() and name not in live and os.path.isdir(path):
+                    collected['file_bytes'] += _path_size(path)
+                    self.io.delete_directory(path)
+                    collected['image_dirs'] += 1
+
+        if raw_path is not None and os.path.isdir(raw_path):
+            # <code id>.txt and the full outputs <code id>-<result id>.txt
+            for name in os.listdir(raw_path):
+                code_id = name.split('.')[0].split('-')[0]
+                if name.endswith('.txt') and code_id.isdigit() and code_id not in live:
+                    path = self.io.join(raw_path, name)
+                    collected['file_bytes'] += _path_size(path)
+                    os.remove(path)
+                    collected['raw_files'] += 1
+
+        if checkpoints is not None and os.path.isdir(checkpoints):
+            blocks = {}
+            for block in self._session.query(CodeBlock).order_by(CodeBlock.order):
+                blocks.setdefault(block.src_id, []).append(block)
+            chains = set(chain for src_blocks in blocks.values() for chain in chain_hashes(src_blocks))
+
+            for name in os.listdir(checkpoints):
+                if name.endswith('.pkl') and name[:-len('.pkl')] not in chains:
+                    path = self.io.join(checkpoints, name)
+                    collected['file_bytes'] += _path_size(path)
+                    os.remove(path)
+                    collected['checkpoints'] += 1
+
+        if vacuum and self.location != ':memory:':
+            with self._engine.connect() as connection:
+                connection.execution_options(isolation_level='AUTOCOMMIT')\
+                          .execute(sqlalchemy.text('VACUUM'))
+
+        collected['db_bytes'] = max(0, db_size - self._database_size())
+
+        return collected
+
+    def _database_size(self):
+        if self.location == ':memory:' or not os.path.exists(self.location):
+            return 0
+        return os.path.getsize(self.location)
+
+
+def _path_size(path):
+    if not os.path.isdir(path):
+        return os.path.getsize(path)
+
+    return sum(os.path.getsize(os.path.join(root, name))
+               for root, _, files in os.walk(path) for name in files)
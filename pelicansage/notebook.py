@@ -5,34 +5,52 @@ import re
 from collections.__init__ import defaultdict
 from uuid import uuid4
 
-import nbformat as notebookformat
-from nbconvert import HTMLExporter
-from nbconvert.preprocessors import ExtractOutputPreprocessor
-from traitlets import Set
-from traitlets.config import Config
-
-from pelicansage.managefiles import ResultTypes
+from pelicansage.constants import ResultTypes
 from pelicansage.util import CellResult as CR, combine_results
 
 import logging
 
 logger = logging.getLogger(__name__)
 
-class ExtractAllOutputPreprocessor(ExtractOutputPreprocessor):
-    extract_output_types = Set(
-        {'image/png',
-         'image/jpeg',
-         'image/svg+xml',
-         'application/pdf',
-         'text/html',
-         'text/plain'}
-    ).tag(config=True)
+_html_ipynb_output_exporter = None
+
+
+def _extract_all_output_preprocessor():
+    # nbconvert is slow to import, only define the preprocessor when needed
+    from nbconvert.preprocessors import ExtractOutputPreprocessor
+    from traitlets import Set
+
+    class ExtractAllOutputPreprocessor(ExtractOutputPreprocessor):
+        extract_output_types = Set(
+            {'image/png',
+             'image/jpeg',
+             'image/svg+xml',
+             'application/pdf',
+             'text/html',
+             'text/plain'}
+        ).tag(config=True)
+
+    return ExtractAllOutputPreprocessor
+
+
+def html_ipynb_output_exporter():
+    """
+    Returns the exporter extracting all notebook outputs, created on first use.
+    """
+    global _html_ipynb_output_exporter
 
+    if _html_ipynb_output_exporter is None:
+        from nbconvert import HTMLExporter
+        from traitlets.config import Config
+
+        c = Config()
+        c.HTMLExporter.preprocessors = [_extract_all_output_preprocessor()]
+
+        _html_ipynb_output_exporter = HTMLExporter(config=c)
+
+    return _html_ipynb_output_exporter
 
-c = Config()
-c.HTMLExporter.preprocessors = ['pelicansage.notebook.ExtractAllOutputPreprocessor']
 
-html_ipynb_output_exporter = HTMLExporter(config=c)
 BASE_USER_ID_COMMENT = r'\s*id\s*:\s*(.*)$'
 HASKELL_USER_ID_COMMENT = re.compile(r'\s*--' + BASE_USER_ID_COMMENT)
 PYTHON_USER_ID_COMMENT = re.compile(r'\s*#' + BASE_USER_ID_COMMENT)
@@ -197,8 +215,10 @@ def process_ipynb(manager, path, content_path, output_path):
 
         manager.io.copy_file(path, src_output)
 
+        import nbformat as notebookformat
+
         notebook = notebookformat.reads(content, as_version=4)
-        _, outputs = html_ipynb_output_exporter.from_notebook_node(notebook)
+        _, outputs = html_ipynb_output_exporter().from_notebook_node(notebook)
         outputs = outputs['outputs']
 
         cell_order = 0
@@ -239,6 +259,27 @@ def process_ipynb(manager, path, content_path, output_path):
         logger.exception('Could not process {} ipython notebook.'.format(path))
 
 
+def read_ipynb_metadata(path):
+    """
+    Returns the Pelican metadata of the notebook at path, with lower case
+    keys, as the ipynb readers take it: the 'Key: value' lines of the
+    .nbdata file next to the notebook, or else the notebook metadata.
+    """
+    nbdata = os.path.splitext(path)[0] + '.nbdata'
+    if os.path.exists(nbdata):
+        metadata = {}
+        with open(nbdata, 'r', encoding='utf-8') as f:
+            for line in f:
+                key, sep, value = line.partition(':')
+                if sep and key.strip():
+                    metadata[key.strip().lower()] = value.strip()
+        return metadata
+
+    with open(path, 'r', encoding='utf-8') as f:
+        metadata = json.load(f).get('metadata', {})
+    return dict((key.lower(), value) for key, value in metadata.items())
+
+
 def process_ipynb_user_id(language, code_block_lines):
     if len(code_block_lines) > 0 and language.lower() in ('haskell', 'scala', 'python'):
         # scan to the first non-empty line
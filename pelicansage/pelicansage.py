@@ -2,10 +2,8 @@ from __future__ import unicode_literals, print_function
 
 import logging
 import os
-import timeit
 from collections import defaultdict
-from queue import Queue, Empty
-from threading import Thread
+from datetime import datetime
 
 from docutils import nodes
 from docutils.parsers.rst import directives, Directive
@@ -14,26 +12,59 @@ from docutils.parsers.rst.directives.images import Image
 from pelican import signals
 from pelican.readers import RstReader
 
-from pelicansage.notebook import process_ipynb
-from .managefiles import FileManager, LanguagesStrEnum
 from .pelicansageio import create_directory_tree
-from .managefiles import ResultTypes
-from pelicansage.slides import SlidesGenerator
+from .constants import ResultTypes, SAGE_INTERFACES
+from .util import truncate_output
+from .tracing import get_tracer, NULL_SPAN
+
+# The notebook, database, kernel client and slides modules pull in slow
+# dependencies (nbconvert, sqlalchemy, websocket, hovercraft), they are
+# imported when first needed so they do not slow down every pelican run.
 
 logger = logging.getLogger(__name__)
 from traceback import format_exc
 
-try:
-    from ansi2html import Ansi2HTMLConverter
 
-    ansi_converter = lambda x: Ansi2HTMLConverter().convert(x, full=False)
-except ImportError:
-    ansi_converter = lambda x: str(x)
+def ansi_converter(x):
+    try:
+        from ansi2html import Ansi2HTMLConverter
+    except ImportError:
+        return str(x)
+
+    return Ansi2HTMLConverter().convert(x, full=False)
 
 _SAGE_SETTINGS = {}
 
 _FILE_MANAGER = None
 
+_BUILD_STARTED = None
+
+# Read-only view of the code blocks and results used by the second pass
+_SNAPSHOT = None
+
+_TRACER = get_tracer()
+
+# Spans of the second pass and of the source it is currently reading
+_RENDER_SPAN = NULL_SPAN
+_RENDER_SOURCE_SPAN = NULL_SPAN
+
+# State kept between the builds of watch mode (see watch.py).  The clients
+# of every evaluated source, None outside of watch mode.
+_KERNELS = None
+# The source of every output file written by the last build
+_OUTPUT_SOURCES = {}
+# Sources read and written again by the current build, None for all
+_SELECTED = None
+# Outputs requested by the WRITE_SELECTED setting, relative to the output
+# directory, None for all
+_WRITE_SELECTED = None
+
+# Result fingerprints of the sources when content caching is on, stored
+# once the build is finalized, and the paths whose cached pages are stale
+# because their results changed
+_FINGERPRINTS = None
+_CHANGED = set()
+
 _last_dole = 0
 
 
@@ -48,6 +79,144 @@ def dole_out():
     return next_cell
 
 
+def _notebook_client(url, kernel_name=None):
+    from .sagecell import IPythonNotebookClient, JupyterServerClient
+
+    if _SAGE_SETTINGS['JUPYTER_API'] == 'legacy':
+        return IPythonNotebookClient(url, kernel_name=kernel_name)
+
+    return JupyterServerClient(url, kernel_name=kernel_name, token=_SAGE_SETTINGS['JUPYTER_TOKEN'])
+
+
+def _create_clients():
+    from .sagecell import SageCell, LocalKernelClient
+
+    cell = {}
+
+    if _SAGE_SETTINGS['CELL_URL']:
+        cell['sage'] = SageCell(dole_out())
+
+    if _SAGE_SETTINGS['IPYTHON_URL']:
+        cell['ipython'] = _notebook_client(_SAGE_SETTINGS['IPYTHON_URL'])
+
+    if _SAGE_SETTINGS['IHASKELL_URL']:
+        cell['ihaskell'] = _notebook_client(_SAGE_SETTINGS['IHASKELL_URL'])
+
+    # Platforms evaluated by kernels on this machine instead of a server
+    for platform, kernel_name in _SAGE_SETTINGS['LOCAL_KERNELS'].items():
+        cell[platform] = LocalKernelClient(kernel_name, timeout=_SAGE_SETTINGS['LOCAL_TIMEOUT'])
+
+    # Dedicated kernels for single languages of a platform
+    for (platform, language), route in _SAGE_SETTINGS['ROUTES'].items():
+        if route.get('url'):
+            if platform == 'sage':
+                cell[(platform, language)] = SageCell(route['url'], language=language)
+            else:
+                cell[(platform, language)] = _notebook_client(route['url'], kernel_name=route.get('kernel'))
+        elif route.get('kernel'):
+            cell[(platform, language)] = LocalKernelClient(route['kernel'], timeout=_SAGE_SETTINGS['LOCAL_TIMEOUT'])
+        else:
+            logger.error("Route %s:%s needs a url or a kernel.", platform, language)
+
+    return cell
+
+
+def _route_limits():
+    return dict((route, config['max_workers']) for route, config in _SAGE_SETTINGS['ROUTES'].items()
+                if config.get('max_workers'))
+
+
+def _parse_routes(routes):
+    # Keys are either (platform, language) tuples or 'platform:language'.
+    # A sage route with a url runs its language on that Sage cell server,
+    # through the Sage interface of the language (r, gap, ...) or as Sage
+    # code, there is no kernel to choose there.
+    parsed = {}
+    for key, route in routes.items():
+        if not isinstance(key, tuple):
+            key = tuple(key.split(':', 1))
+        platform, language = key[0].lower(), key[1].lower()
+
+        if platform == 'sage' and route.get('url'):
+            if route.get('kernel'):
+                raise ValueError("Route sage:%s has a url, a Sage cell server does not take a kernel." % (language,))
+            if language not in ('sage', 'python') + SAGE_INTERFACES:
+                raise ValueError("Route sage:%s has a url, a Sage cell server cannot run %s." % (language, language))
+
+        parsed[(platform, language)] = dict(route)
+    return parsed
+
+
+def _parse_truncate(truncate):
+    # e.g. {'lines': 100, 'keep': 'tail'} or {'bytes': 10000}
+    if not truncate:
+        return None
+
+    parsed = {'lines': truncate.get('lines'),
+              'bytes': truncate.get('bytes'),
+              'keep': truncate.get('keep', 'head')}
+
+    if parsed['keep'] not in ('head', 'tail'):
+        raise ValueError("TRUNCATE keep must be 'head' or 'tail', not %r" % (parsed['keep'],))
+
+    return parsed
+
+
+def _parse_jupyter_api(api):
+    # 'server' for the kernels / sessions API of Jupyter Server, 'legacy'
+    # for the notebooks API of IPython notebook servers
+    api = api.lower()
+    if api not in ('server', 'legacy'):
+        raise ValueError("JUPYTER_API must be 'server' or 'legacy', not %r" % (api,))
+    return api
+
+
+def _parse_on_timeout(on_timeout):
+    # 'continue' evaluates the rest of the source after a block timed out,
+    # 'skip' records an error for the rest of its blocks instead
+    on_timeout = on_timeout.lower()
+    if on_timeout not in ('continue', 'skip'):
+        raise ValueError("ON_TIMEOUT must be 'continue' or 'skip', not %r" % (on_timeout,))
+    return on_timeout
+
+
+def _parse_drafts(drafts):
+    # 'evaluate' drafts like published sources, 'skip' never evaluates
+    # them, 'lazy' only when selected or embedded by an evaluated source
+    drafts = drafts.lower()
+    if drafts not in ('evaluate', 'skip', 'lazy'):
+        raise ValueError("DRAFTS must be 'evaluate', 'skip' or 'lazy', not %r" % (drafts,))
+    return drafts
+
+
+def _parse_work_queue(work_queue, transform_path):
+    # A path, or e.g. {'path': '/shared/queue', 'backend': 'directory', 'lease': 60, 'poll': 0.5,
+    # 'timeout': 600}, timeout being the seconds the build waits without
+    # results before leaving the remaining sources unevaluated
+    if not work_queue:
+        return None
+
+    if not isinstance(work_queue, dict):
+        work_queue = {'path': work_queue}
+
+    parsed = dict(work_queue)
+    parsed['path'] = transform_path(parsed['path'])
+    if parsed.get('timeout') is not None:
+        parsed['timeout'] = float(parsed['timeout'])
+
+    if parsed.get('backend') not in (None, 'sqlite', 'directory'):
+        raise ValueError("WORK_QUEUE backend must be 'sqlite' or 'directory', not %r" % (parsed['backend'],))
+
+    return parsed
+
+
+def _open_work_queue():
+    if _SAGE_SETTINGS['WORK_QUEUE'] is None:
+        return None
+
+    from .workqueue import open_work_queue
+    return open_work_queue(_SAGE_SETTINGS['WORK_QUEUE'])
+
 
 # One sage cell instance per source file.
 
@@ -70,106 +239,387 @@ _CONTENT_PATH = None
 _PREPROCESSING_DONE = False
 
 
-class CellWorker(Thread):
-    def __init__(self, queue, blocks, cell):
-        self.__queue = queue
-        self.__blocks = blocks
-        self.__cell = cell
-        Thread.__init__(self)
-
-    def run(self):
-        logger.info("Evaluating %d blocks in %s", len(self.__blocks), self.__blocks[0].src.src)
-        try:
-            results = self.execute_blocks()
-        except:
-            logger.exception("Error in executing code blocks, retrying once.")
-            for cell in self.__cell.values():
-                cell.reset()
-
-            results = self.execute_blocks()
-
-        logger.info("Evaluation complete on %s.", self.__blocks[0].src.src)
+def content_files(generator):
+    """
+    Returns the article and page files of the content directory, relative
+    to it.
+    """
+    files = []
+    for paths, excludes in ((t + '_PATHS', t + '_EXCLUDES') for t in ('ARTICLE', 'PAGE')):
+        files.extend([process_file for process_file in
+                      generator.get_files(
+                          generator.settings[paths],
+                          exclude=generator.settings[excludes],
+                          extensions=False)])
+    return files
+
+
+def ingest(path, rst_reader):
+    """
+    Records the code blocks of the rst or ipynb file at path in the store,
+    the first pass for a single source.
+    """
+    from .notebook import process_ipynb, read_ipynb_metadata
+
+    fmt = os.path.splitext(path)[1][1:].lower()
+    src = path.replace(_CONTENT_PATH, '')
+
+    if fmt == 'rst':
+        # Drops references the source no longer makes
+        _FILE_MANAGER.delete_references(src)
+        _, metadata = rst_reader.read(path)
+    elif fmt == 'ipynb':
+        process_ipynb(_FILE_MANAGER, path, _CONTENT_PATH, _SAGE_SETTINGS['OUTPUT_PATH'])
+        metadata = read_ipynb_metadata(path)
+    else:
+        return
 
-        self.__queue.put((self.__blocks[0].src.src, results))
+    default = rst_reader.settings.get('DEFAULT_METADATA', {}).get('status', 'published')
+    _FILE_MANAGER.set_status(src, str(metadata.get('status', default)).lower())
+
+
+def selected_sources():
+    """
+    Returns the sources the current build writes the pages of, relative to
+    the content directory, None for all or when the sources of the outputs
+    written are not all known.
+    """
+    if _SELECTED is not None:
+        return set(path.replace(_CONTENT_PATH, '') for path in _SELECTED)
+    if _WRITE_SELECTED is not None:
+        # Outputs are recorded by the builds which write them, those of new
+        # or renamed pages are not known yet
+        sources = _FILE_MANAGER.get_output_sources(_WRITE_SELECTED)
+        unknown = _WRITE_SELECTED - set(sources)
+        if unknown:
+            logger.warning("No source is known to be saved as %s, evaluating every source.",
+                           ', '.join(sorted(unknown)))
+            return None
+        return set(sources.values())
+    return None
 
-    def execute_blocks(self):
-        results = []
 
-        for block in self.__blocks:
-            if block.language not in LanguagesStrEnum:
-                logger.error("%s is not a supported language.", block.language.upper())
-                continue
+def evaluation_sources():
+    """
+    Returns the sources whose code blocks the current build evaluates.
 
-            if block.platform not in self.__cell:
-                logger.error("%s not an available platform (try configuring url parameters in config file).",
-                             block.platform.upper())
-                continue
+    These are the selected sources, or every source when the build is not
+    targeted, with the sources whose results they embed.  Sources in the
+    'skip' status are never evaluated, drafts (the DRAFT_STATUSES) follow
+    the DRAFTS policy.
+    """
+    statuses = _FILE_MANAGER.get_statuses()
+    drafts = set(src for src, status in statuses.items() if status in _SAGE_SETTINGS['DRAFT_STATUSES'])
+    policy = _SAGE_SETTINGS['DRAFTS']
 
-            cell = self.__cell[block.platform]
+    selected = selected_sources()
+    if selected is None:
+        selected = set(statuses) - drafts if policy != 'evaluate' else set(statuses)
 
-            response = cell.execute_request(block.content)  # TODO: pass language as parameter
-            resp_results = cell.get_results_from_response(response)
-            results.append((block.id, resp_results))
+    sources = selected | _FILE_MANAGER.get_referenced_sources(selected)
+    sources -= set(src for src, status in statuses.items() if status == 'skip')
+    if policy == 'skip':
+        sources -= drafts
 
-        return results
+    return sources
 
 
 def pre_read(generator):
     global _PREPROCESSING_DONE
+    global _SNAPSHOT
+    global _RENDER_SPAN
+    global _RENDER_SOURCE_SPAN
+
+    from .evaluation import evaluate
+    from .snapshot import RenderSnapshot
+
     if _PREPROCESSING_DONE:
+        # Sent before each further file of the second pass is read, the
+        # span of the previous file is normally finished by post_context
+        _RENDER_SOURCE_SPAN.finish()
+        _RENDER_SOURCE_SPAN = _TRACER.start('render source', 'source')
         SageDirective.reset_src_order()
         return
 
+    pre_read_span = _TRACER.start('pre_read', 'phase', memory=True)
+
     rst_reader = RstReader(generator.settings)
 
     logger.info("Sage pre-processing files from the content directory")
-    files = []
-    for paths, excludes in ((t + '_PATHS', t + '_EXCLUDES') for t in ('ARTICLE', 'PAGE')):
-        files.extend([process_file for process_file in
-                      generator.get_files(
-                          generator.settings[paths],
-                          exclude=generator.settings[excludes],
-                          extensions=False)])
+    files = content_files(generator)
 
     logger.debug("Files to process: %s", files)
-    for f in files:
-        path = os.path.abspath(os.path.join(generator.path, f))
-        article = generator.readers.get_cached_data(path, None)
-        if article is None:
-            _, ext = os.path.splitext(os.path.basename(path))
-            fmt = ext[1:]
-            try:
-                if fmt.lower() == 'rst':
-                    rst_reader.read(path)
-                elif fmt.lower() == 'ipynb':
-                    process_ipynb(_FILE_MANAGER, path, _CONTENT_PATH, _SAGE_SETTINGS['OUTPUT_PATH'])
-            except:  # Exception as e:
-                logger.exception('Could not process {}\n{}'.format(f, format_exc()))
-                continue
+    with _TRACER.span('ingest', 'phase', memory=True, files=len(files)):
+        for f in files:
+            path = os.path.abspath(os.path.join(generator.path, f))
+            article = generator.readers.get_cached_data(path, None)
+            if article is None:
+                try:
+                    with _TRACER.span('ingest source', 'source', src=f):
+                        ingest(path, rst_reader)
+                except:  # Exception as e:
+                    logger.exception('Could not process {}\n{}'.format(f, format_exc()))
+                    continue
 
     # Reset the src order lookup table
     logger.info("Sage pre-processing completed.")
     _PREPROCESSING_DONE = True
     SageDirective.reset_src_order()
 
+    with _TRACER.span('evaluation', 'phase', memory=True):
+        evaluate(_FILE_MANAGER, _create_clients, _SAGE_SETTINGS['MAX_WORKERS'],
+                 _SAGE_SETTINGS['RETRIES'], _SAGE_SETTINGS['RETRY_BACKOFF'],
+                 _SAGE_SETTINGS['CHECKPOINT_PATH'], _route_limits(),
+                 _open_work_queue(), (_SAGE_SETTINGS['WORK_QUEUE'] or {}).get('poll', 0.5),
+                 _KERNELS, _SAGE_SETTINGS['BLOCK_TIMEOUT'], _SAGE_SETTINGS['ON_TIMEOUT'],
+                 evaluation_sources(), (_SAGE_SETTINGS['WORK_QUEUE'] or {}).get('timeout'))
+
+    if generator.settings.get('CACHE_CONTENT'):
+        with _TRACER.span('fingerprints', 'phase'):
+            check_fingerprints(generator)
+
+    with _TRACER.span('snapshot', 'phase', memory=True):
+        _SNAPSHOT = RenderSnapshot(_FILE_MANAGER)
+    logger.debug("Render snapshot holds %d code blocks.", len(_SNAPSHOT))
+
     # write out raw text snippets
-    blks = _FILE_MANAGER.get_all_codeblocks()
-    raw_base_path = os.path.join(generator.settings['OUTPUT_PATH'], 'raw/')
-    create_directory_tree(raw_base_path)
+    with _TRACER.span('raw snippets', 'phase'):
+        blks = _SNAPSHOT
+        raw_base_path = os.path.join(generator.settings['OUTPUT_PATH'], 'raw/')
+        create_directory_tree(raw_base_path)
+
+        for blk in blks:
+            raw_path = os.path.join(raw_base_path, '%s.txt' % (blk.id,))
+            with open(raw_path, 'w') as f:
+                f.write(blk.content)
 
-    for blk in blks:
-        raw_path = os.path.join(raw_base_path, '%s.txt' % (blk.id,))
-        with open(raw_path, 'w') as f:
-            f.write(blk.content)
+            # Full output of results which are truncated on the page
+            for result in blk.stream_results:
+                if _is_truncatable(result) and truncate_output(result.data, **_SAGE_SETTINGS['TRUNCATE'])[1]:
+                    with open(os.path.join(raw_base_path, _full_output_name(blk.id, result)), 'w') as f:
+                        f.write(result.data)
+
+    pre_read_span.finish()
+
+    # The second pass starts with reading the first file right after this
+    _RENDER_SPAN = _TRACER.start('render', 'phase', memory=True)
+    _RENDER_SOURCE_SPAN = _TRACER.start('render source', 'source')
 
 
 def post_context(*args, **kwargs):
-    logger.info("<<<<<<POST CONTEXT>>>>>>: %s , %s", args, kwargs)
+    metadata = kwargs.get('metadata') or {}
+    _RENDER_SOURCE_SPAN.args['slug'] = metadata.get('slug')
+    _RENDER_SOURCE_SPAN.finish()
     SageDirective.reset_src_order()
 
 
+def render_finalized(generator):
+    global _RENDER_SOURCE_SPAN
+
+    # A file without a context (e.g. a failed read) leaves its span open
+    _RENDER_SOURCE_SPAN = NULL_SPAN
+    _RENDER_SPAN.finish()
+
+    record_outputs(generator)
+
+
+def record_outputs(generator):
+    outputs = {}
+    # Articles and pages in every status, with their translations
+    for name in ('articles', 'translations', 'drafts', 'drafts_translations',
+                 'hidden_articles', 'hidden_translations', 'pages', 'hidden_pages',
+                 'draft_pages', 'draft_translations'):
+        for content in getattr(generator, name, None) or ():
+            if content.save_as:
+                _OUTPUT_SOURCES[content.save_as] = content.source_path
+                outputs[content.save_as] = content.source_path.replace(_CONTENT_PATH, '')
+
+    # Targeted builds map the outputs requested back to their sources
+    _FILE_MANAGER.record_outputs(outputs)
+
+
+def drop_stale(generator):
+    settings = generator.settings
+    if settings.get('CACHE_CONTENT') and settings.get('CONTENT_CACHING_LAYER') == 'generator':
+        # Cached content objects are used before the first file is read, and
+        # with it the results evaluated, so they cannot be checked against
+        # their results like the pages of the readers cache
+        logger.warning("Sage results cannot be checked against the generator content cache, "
+                       "%s reads every file again. Use CONTENT_CACHING_LAYER = 'reader'.",
+                       generator.__class__.__name__)
+        getattr(generator, '_cache', {}).clear()
+
+    # Selected sources are read again instead of taken from the readers cache
+    if _SELECTED is not None:
+        _drop_cached(generator, _SELECTED)
+
+
+def _render_salt():
+    # Settings changing how results are rendered
+    return repr((sorted((_SAGE_SETTINGS['TRUNCATE'] or {}).items()), _SAGE_SETTINGS['PUBLIC_CELL']))
+
+
+def check_fingerprints(generator):
+    """
+    Finds the sources whose results changed since their cached page was
+    read, including results embedded from other sources, and drops them
+    from the readers cache so the second pass reads them again.
+    """
+    global _FINGERPRINTS
+    global _CHANGED
+
+    _FINGERPRINTS = _FILE_MANAGER.result_fingerprints(_render_salt())
+    _CHANGED = set(_CONTENT_PATH + src for src in _FILE_MANAGER.changed_fingerprints(_FINGERPRINTS))
+
+    if _CHANGED:
+        logger.info("Results of %d cached sources changed, reading them again.", len(_CHANGED))
+
+    _drop_cached(generator, _CHANGED)
+
+
+def drop_changed(generator):
+    global _CHANGED
+
+    # Sent before each page is read, pages are read after every article
+    _drop_cached(generator, _CHANGED)
+    _CHANGED = set()
+
+
+def _drop_cached(generator, paths):
+    cache = getattr(generator.readers, '_cache', None)
+    if cache is None:
+        return
+
+    for path in paths:
+        cache.pop(path, None)
+
+
+def is_selected_output(name):
+    """
+    Returns whether the output file name is written by the current build,
+    every output not generated from a single source is.
+    """
+    if _WRITE_SELECTED is not None:
+        return name in _WRITE_SELECTED
+
+    src = _OUTPUT_SOURCES.get(name)
+    return _SELECTED is None or src is None or src in _SELECTED
+
+
+def get_writer(pelicanobj):
+    if _KERNELS is None and _WRITE_SELECTED is None:
+        return None
+
+    from .watch import selective_writer
+    return selective_writer()
+
+
+def start_watch():
+    """
+    Keeps the clients of every source alive between builds.
+    """
+    global _KERNELS
+
+    if _KERNELS is None:
+        _KERNELS = {}
+
+
+def stop_watch():
+    global _KERNELS
+    global _SELECTED
+
+    from .evaluation import close_clients
+
+    for cell in (_KERNELS or {}).values():
+        close_clients(cell)
+    _KERNELS = None
+    _SELECTED = None
+
+
+def prepare_rebuild(changed, removed=()):
+    """
+    Prepares building the site again after the sources changed were
+    modified and the sources removed deleted.  Returns the sources which
+    are read and written again, together with those embedding their
+    results.
+    """
+    global _PREPROCESSING_DONE
+    global _SNAPSHOT
+    global _SELECTED
+    global _BUILD_STARTED
+
+    from .evaluation import close_clients
+
+    # Sources are stored relative to the content directory
+    to_src = lambda path: path.replace(_CONTENT_PATH, '')
+
+    for src in map(to_src, removed):
+        if _KERNELS is not None and src in _KERNELS:
+            close_clients(_KERNELS.pop(src))
+
+    selected = set(changed) | set(removed)
+    selected |= set(_CONTENT_PATH + src for src in
+                    _FILE_MANAGER.get_referencing_sources(set(map(to_src, selected))))
+
+    _SELECTED = selected
+    _PREPROCESSING_DONE = False
+    _SNAPSHOT = None
+    _BUILD_STARTED = datetime.now()
+
+    _TRACER.configure(enabled=bool(_SAGE_SETTINGS['TRACE_PATH']), memory=_SAGE_SETTINGS['TRACE_MEMORY'])
+
+    return selected
+
+
+def sage_finalized(pelicanobj):
+    global _FINGERPRINTS
+
+    if _FILE_MANAGER is None:
+        return
+
+    if _SAGE_SETTINGS['REPORT_PATH']:
+        from .report import build_report, write_report
+
+        report = build_report(_FILE_MANAGER, since=_BUILD_STARTED)
+        write_report(report, _SAGE_SETTINGS['REPORT_PATH'])
+        logger.info("Sage build report written to %s", _SAGE_SETTINGS['REPORT_PATH'])
+
+    if _FINGERPRINTS is not None:
+        # Pages read with these results are in the saved readers caches now
+        _FILE_MANAGER.store_fingerprints(_FINGERPRINTS)
+        _FINGERPRINTS = None
+
+    if _SAGE_SETTINGS['GC']:
+        with _TRACER.span('collect garbage', 'phase'):
+            collected = _FILE_MANAGER.collect_garbage(content_path=_CONTENT_PATH,
+                                                      checkpoints=_SAGE_SETTINGS['CHECKPOINT_PATH'],
+                                                      raw_path=os.path.join(_SAGE_SETTINGS['OUTPUT_PATH'], 'raw'))
+        logger.info("Sage garbage collection: %s", ', '.join('%s %d' % item for item in sorted(collected.items())))
+
+    if _SAGE_SETTINGS['TRACE_PATH']:
+        _TRACER.write(_SAGE_SETTINGS['TRACE_PATH'])
+        logger.info("Sage build trace written to %s", _SAGE_SETTINGS['TRACE_PATH'])
+
+
+def _write_selected(pelicanobj):
+    # Output paths, absolute or relative to the working directory, as the
+    # --write-selected option of Pelican gave them
+    selected = pelicanobj.settings.get('WRITE_SELECTED')
+    if not selected:
+        return None
+
+    output_path = os.path.abspath(pelicanobj.settings['OUTPUT_PATH'])
+    return set(os.path.relpath(os.path.abspath(path), output_path) for path in selected)
+
+
 def sage_init(pelicanobj):
     global _FILE_MANAGER
+    global _BUILD_STARTED
+    global _WRITE_SELECTED
+
+    from .managefiles import FileManager
+
+    _BUILD_STARTED = datetime.now()
 
     try:
         settings = pelicanobj.settings['SAGE']
@@ -177,9 +627,14 @@ def sage_init(pelicanobj):
         settings = None
 
     process_settings(pelicanobj, settings)
+    _WRITE_SELECTED = _write_selected(pelicanobj)
 
-    _FILE_MANAGER = FileManager(location=_SAGE_SETTINGS['DB_PATH'],
-                                base_path=_SAGE_SETTINGS['FILE_BASE_PATH'])
+    _TRACER.configure(enabled=bool(_SAGE_SETTINGS['TRACE_PATH']), memory=_SAGE_SETTINGS['TRACE_MEMORY'])
+
+    with _TRACER.span('sage_init', 'phase', memory=True):
+        _FILE_MANAGER = FileManager(location=_SAGE_SETTINGS['DB_PATH'],
+                                    base_path=_SAGE_SETTINGS['FILE_BASE_PATH'],
+                                    codec=_SAGE_SETTINGS['BLOB_CODEC'])
 
 
 def merge_dict(k, d1, d2, transform=None):
@@ -197,6 +652,28 @@ def process_settings(pelicanobj, settings):
     _SAGE_SETTINGS['DB_PATH'] = ':memory:'
     _SAGE_SETTINGS['IPYTHON_URL'] = ''
     _SAGE_SETTINGS['IHASKELL_URL'] = ''
+    _SAGE_SETTINGS['JUPYTER_API'] = 'server'
+    _SAGE_SETTINGS['JUPYTER_TOKEN'] = None
+    _SAGE_SETTINGS['CELL_URL'] = []
+    _SAGE_SETTINGS['PUBLIC_CELL'] = 'https://sagecell.sagemath.org'
+    _SAGE_SETTINGS['MAX_WORKERS'] = 4
+    _SAGE_SETTINGS['REPORT_PATH'] = None
+    _SAGE_SETTINGS['LOCAL_KERNELS'] = {}
+    _SAGE_SETTINGS['RETRIES'] = 1
+    _SAGE_SETTINGS['RETRY_BACKOFF'] = 1.0
+    _SAGE_SETTINGS['CHECKPOINT_PATH'] = None
+    _SAGE_SETTINGS['ROUTES'] = {}
+    _SAGE_SETTINGS['LOCAL_TIMEOUT'] = None
+    _SAGE_SETTINGS['TRACE_PATH'] = None
+    _SAGE_SETTINGS['TRACE_MEMORY'] = False
+    _SAGE_SETTINGS['TRUNCATE'] = None
+    _SAGE_SETTINGS['WORK_QUEUE'] = None
+    _SAGE_SETTINGS['BLOB_CODEC'] = 'zlib'
+    _SAGE_SETTINGS['GC'] = False
+    _SAGE_SETTINGS['BLOCK_TIMEOUT'] = None
+    _SAGE_SETTINGS['ON_TIMEOUT'] = 'continue'
+    _SAGE_SETTINGS['DRAFTS'] = 'evaluate'
+    _SAGE_SETTINGS['DRAFT_STATUSES'] = ('draft',)
     _CONTENT_PATH = pelicanobj.settings['PATH']
 
     # Alias for merge_dict
@@ -212,6 +689,28 @@ def process_settings(pelicanobj, settings):
         md('DB_PATH', transform_content_db)
         md('IPYTHON_URL')
         md('IHASKELL_URL')
+        md('JUPYTER_API', _parse_jupyter_api)
+        md('JUPYTER_TOKEN')
+        md('CELL_URL', lambda x: [x] if isinstance(x, str) else list(x))
+        md('PUBLIC_CELL')
+        md('MAX_WORKERS', int)
+        md('REPORT_PATH', transform_content_db)
+        md('LOCAL_KERNELS', dict)
+        md('LOCAL_TIMEOUT')
+        md('RETRIES', int)
+        md('RETRY_BACKOFF', float)
+        md('CHECKPOINT_PATH', transform_content_db)
+        md('ROUTES', _parse_routes)
+        md('TRACE_PATH', transform_content_db)
+        md('TRACE_MEMORY', bool)
+        md('TRUNCATE', _parse_truncate)
+        md('WORK_QUEUE', lambda x: _parse_work_queue(x, transform_content_db))
+        md('BLOB_CODEC', lambda x: x.lower())
+        md('GC', bool)
+        md('BLOCK_TIMEOUT', lambda x: None if x is None else float(x))
+        md('ON_TIMEOUT', _parse_on_timeout)
+        md('DRAFTS', _parse_drafts)
+        md('DRAFT_STATUSES', lambda x: tuple(status.lower() for status in x))
 
 
 def _define_choice(choice1, choice2):
@@ -243,6 +742,13 @@ def _transform_pre(content, id=None, class_=None, style=None):
                      format='html')
 
 
+def _get_code(code_id=None, user_id=None, src=None):
+    if _SNAPSHOT is not None:
+        return _SNAPSHOT.get_code(code_id=code_id, user_id=user_id, src=src)
+
+    return _FILE_MANAGER.get_code(code_id=code_id, user_id=user_id, src=src)
+
+
 def _mod_format_permalinks(code_obj):
     if code_obj is None:
         return ''
@@ -265,14 +771,27 @@ def _mod_format_permalinks(code_obj):
     return link_template % {'link_content': link_content}
 
 
+def _is_truncatable(result):
+    return (_SAGE_SETTINGS['TRUNCATE'] is not None and
+            result.type == ResultTypes.Stream and result.mimetype == 'text/plain')
+
+
+def _full_output_name(code_id, result):
+    return '%s-%s.txt' % (code_id, result.id)
+
+
 def _mod_transform_result(code_id, result, order, latex=False):
-    code_obj = _FILE_MANAGER.get_code(code_id)
+    code_obj = _get_code(code_id)
 
     if result.mimetype == 'image/png':
         return _mod_transform_image(code_id, result, order)
 
+    truncated = False
+
     if result.type == ResultTypes.Error:
         result_data = ansi_converter(result.data.traceback)
+    elif _is_truncatable(result) and not latex:
+        result_data, truncated = truncate_output(result.data, **_SAGE_SETTINGS['TRUNCATE'])
     else:
         result_data = result.data
 
@@ -282,6 +801,10 @@ def _mod_transform_result(code_id, result, order, latex=False):
     if latex and result.mimetype == 'text/plain':
         result_data = '<p>$$ %s $$</p>' % (result_data,)
 
+    if truncated:
+        result_data += ("<div class='truncated'>Output truncated, "
+                        "<a href='/raw/%s'>full output</a></div>" % (_full_output_name(code_id, result),))
+
     return nodes.raw('',
                      """
                      <div class="code_block out_block">
@@ -294,7 +817,7 @@ def _mod_transform_result(code_id, result, order, latex=False):
 
 
 def _mod_transform_image(code_id, image, order):
-    code_obj = _FILE_MANAGER.get_code(code_id)
+    code_obj = _get_code(code_id)
     image_node = lambda x: nodes.raw('', "<img src='%s'/>" % (x,), format='html')
     if not isinstance(image, nodes.image):
         if image.mimetype == 'image/png' and image.type != ResultTypes.Image:
@@ -340,7 +863,8 @@ class SageDirective(CodeBlock):
                    'suppress-streams': directives.flag,
                    'suppress-errors': directives.flag,
                    'result-order': int,
-                   'latex': directives.flag
+                   'latex': directives.flag,
+                   'timeout': float
                    }
 
     option_spec.update(CodeBlock.option_spec)
@@ -421,12 +945,20 @@ class SageDirective(CodeBlock):
 
         code_block = '\n'.join(self.content)
 
+        if _SNAPSHOT is not None:
+            # Second pass, the block was stored and evaluated by the first
+            code_obj = _SNAPSHOT.get_code(src=src, order=order)
+            if code_obj is not None and code_obj.content == code_block:
+                return code_obj
+
         code_obj = _FILE_MANAGER.create_code(code=code_block,
                                              src=src,
                                              order=order,
                                              language=self.arguments[0],
                                              platform=self._platform,
-                                             user_id=user_id)
+                                             user_id=user_id,
+                                             timeout=self.options.get('timeout'),
+                                             default_timeout=_SAGE_SETTINGS['BLOCK_TIMEOUT'])
 
         return code_obj
 
@@ -519,7 +1051,8 @@ class SageResultMixin(object):
         src = src.replace(_CONTENT_PATH, '')
 
         logger.debug("Sources: %s, %s", src, this_src)
-        if this_src != src:
+        # References are recorded by the first pass
+        if this_src != src and _SNAPSHOT is None:
             _FILE_MANAGER.create_reference(this_src, src)
 
         return src
@@ -529,7 +1062,7 @@ class SageResultMixin(object):
 
     def _get_code_result(self, src):
 
-        code_obj = _FILE_MANAGER.get_code(src=src, user_id=self.arguments[0].strip().lower())
+        code_obj = _get_code(src=src, user_id=self.arguments[0].strip().lower())
 
         if code_obj is None:
             logger.warning("Uknown code identifier <%s> in src file %s",
@@ -572,17 +1105,18 @@ class IPythonNotebook(SageDirective, SageResultMixin):
 
         global _PREPROCESSING_DONE
 
+        src = self._get_file_reference(self.arguments[0], make_abs=True)
+
+        # First pass, only record the reference to the notebook
         if not _PREPROCESSING_DONE:
             return
 
-        src = self._get_file_reference(self.arguments[0], make_abs=True)
-
         if 'id' not in self.options and 'cell-order' not in self.options:
             raise Exception("You must provide an id or order to select the correct cell in ", self.arguments[0])
 
         user_id = self.options['id'] if 'id' in self.options else self.options['cell-order']
 
-        code_obj = _FILE_MANAGER.get_code(user_id=user_id, src=src)
+        code_obj = _get_code(user_id=user_id, src=src)
 
         if code_obj is None:
             logger.error("Can not find code block with data\n%s\n%s", user_id, src)
@@ -642,6 +1176,8 @@ class SageImage(SageResultMixin, Image):
 
 
 def add_generator(pelican_object):
+    from .slides import SlidesGenerator
+
     logger.error("ADDING PELICAN GENERATOR!!!")
     return SlidesGenerator
 
@@ -649,6 +1185,18 @@ def add_generator(pelican_object):
 def register():
     signals.get_generators.connect(add_generator)
     directives.register_directive('notebook', IPythonNotebook)
+    directives.register_directive('sage', SageDirective)
+    directives.register_directive('ipython', IPythonDirective)
+    directives.register_directive('ihaskell', IHaskellDirective)
+    directives.register_directive('sageresult', SageResult)
+    directives.register_directive('sageimage', SageImage)
     signals.article_generator_preread.connect(pre_read)
+    signals.page_generator_preread.connect(drop_changed)
     signals.article_generator_context.connect(post_context)
     signals.initialized.connect(sage_init)
+    signals.article_generator_finalized.connect(render_finalized)
+    signals.page_generator_finalized.connect(record_outputs)
+    signals.article_generator_init.connect(drop_stale)
+    signals.page_generator_init.connect(drop_stale)
+    signals.get_writer.connect(get_writer)
+    signals.finalized.connect(sage_finalized)
@@ -6,7 +6,6 @@ import os, sys
 import errno
 from urllib.error import HTTPError
 
-import requests
 from datetime import datetime
 
 import urllib, shutil
@@ -89,6 +88,10 @@ join = os.path.join
 
 class Globals(object):
     def __getattr__(self, attr):
+        if attr == 'requests':
+            # Only the notebook clients need requests, import it on first use
+            import requests
+            return requests
         return globals()[attr]
 
 
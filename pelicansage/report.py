@@ -0,0 +1,134 @@
+"""
+Build performance report generated from the recorded block statistics.
+"""
+
+import json
+import os
+from collections import defaultdict
+
+from .pelicansageio import create_directory_tree
+
+REPORT_JSON = 'sage-report.json'
+REPORT_TEXT = 'sage-report.txt'
+
+
+def _block_entry(stat):
+    return {'code_id': stat.code_id,
+            'src': stat.src.src if stat.src is not None else None,
+            'order': stat.order,
+            'queue_wait': stat.queue_wait,
+            'setup_time': stat.setup_time,
+            'exec_time': stat.exec_time,
+            'output_bytes': stat.output_bytes,
+            'iopub_messages': stat.iopub_messages,
+            'images': stat.images,
+            'endpoint': stat.endpoint}
+
+
+def build_report(manager, since=None, limit=10):
+    """
+    Summarizes the block statistics recorded since the given datetime into
+    the slowest blocks, the slowest sources and the per endpoint throughput.
+    """
+    blocks = [_block_entry(stat) for stat in manager.get_stats(since=since)]
+
+    sources = defaultdict(lambda: {'blocks': 0, 'setup_time': 0.0, 'exec_time': 0.0, 'output_bytes': 0})
+    endpoints = defaultdict(lambda: {'blocks': 0, 'exec_time': 0.0, 'output_bytes': 0})
+
+    for block in blocks:
+        source = sources[block['src']]
+        source['blocks'] += 1
+        source['setup_time'] += block['setup_time']
+        source['exec_time'] += block['exec_time']
+        source['output_bytes'] += block['output_bytes']
+
+        endpoint = endpoints[block['endpoint']]
+        endpoint['blocks'] += 1
+        endpoint['exec_time'] += block['setup_time'] + block['exec_time']
+        endpoint['output_bytes'] += block['output_bytes']
+
+    for src, source in sources.items():
+        source['src'] = src
+        source['total_time'] = source['setup_time'] + source['exec_time']
+
+    for url, endpoint in endpoints.items():
+        endpoint['endpoint'] = url
+        endpoint['blocks_per_second'] = endpoint['blocks'] / endpoint['exec_time'] if endpoint['exec_time'] else 0.0
+
+    slowest_blocks = sorted(blocks, key=lambda x: x['setup_time'] + x['exec_time'], reverse=True)
+    slowest_sources = sorted(sources.values(), key=lambda x: x['total_time'], reverse=True)
+
+    return {'blocks': len(blocks),
+            'total_time': sum(x['total_time'] for x in sources.values()),
+            'slowest_blocks': slowest_blocks[:limit],
+            'slowest_sources': slowest_sources[:limit],
+            'endpoints': sorted(endpoints.values(), key=lambda x: x['blocks'], reverse=True)}
+
+
+def _table(title, columns, rows):
+    widths = [max([len(name)] + [len(row[i]) for row in rows]) for i, name in enumerate(columns)]
+    line = '  '.join('%%-%ds' % (width,) for width in widths)
+
+    out = [title, '=' * len(title), line % tuple(columns), line % tuple('-' * width for width in widths)]
+    out.extend(line % tuple(row) for row in rows)
+    out.append('')
+
+    return '\n'.join(out)
+
+
+def format_report(report):
+    """
+    Returns the report as human readable tables.
+    """
+    out = ['Evaluated %d blocks in %.3fs\n' % (report['blocks'], report['total_time'])]
+
+    out.append(_table('Slowest blocks',
+                      ('src', 'order', 'wait', 'setup', 'exec', 'bytes', 'msgs', 'images', 'endpoint'),
+                      [(str(x['src']), str(x['order']), '%.3f' % x['queue_wait'], '%.3f' % x['setup_time'],
+                        '%.3f' % x['exec_time'], str(x['output_bytes']), str(x['iopub_messages']),
+                        str(x['images']), str(x['endpoint'])) for x in report['slowest_blocks']]))
+
+    out.append(_table('Slowest sources',
+                      ('src', 'blocks', 'setup', 'exec', 'total', 'bytes'),
+                      [(str(x['src']), str(x['blocks']), '%.3f' % x['setup_time'], '%.3f' % x['exec_time'],
+                        '%.3f' % x['total_time'], str(x['output_bytes'])) for x in report['slowest_sources']]))
+
+    out.append(_table('Endpoints',
+                      ('endpoint', 'blocks', 'busy', 'blocks/s', 'bytes'),
+                      [(str(x['endpoint']), str(x['blocks']), '%.3f' % x['exec_time'],
+                        '%.2f' % x['blocks_per_second'], str(x['output_bytes'])) for x in report['endpoints']]))
+
+    return '\n'.join(out)
+
+
+def format_plan(planned, wall_time, workers):
+    """
+    Returns the evaluation plan returned by evaluation.plan as a table.
+    """
+    counts = dict((action, len([x for x in planned if x.action == action])) for action in ('run', 'replay', 'cached', 'skipped'))
+    sources = set(x.src for x in planned if x.action in ('run', 'replay'))
+    total = sum(x.estimate for x in planned)
+
+    out = [_table('Evaluation plan',
+                  ('src', 'order', 'action', 'estimate'),
+                  [(str(x.src), str(x.order), x.action, '%.3f' % x.estimate if x.action in ('run', 'replay') else '')
+                   for x in planned])]
+
+    out.append('%d sources to evaluate: %d blocks to run, %d to replay, %d blocks cached, %d skipped' %
+               (len(sources), counts['run'], counts['replay'], counts['cached'], counts['skipped']))
+    out.append('Estimated %.3fs of evaluation, %.3fs of wall time with %d workers' % (total, wall_time, workers))
+
+    return '\n'.join(out)
+
+
+def write_report(report, path):
+    """
+    Writes the report as json and as a text table into the directory path.
+    """
+    create_directory_tree(path)
+
+    with open(os.path.join(path, REPORT_JSON), 'w') as f:
+        json.dump(report, f, indent=2)
+
+    with open(os.path.join(path, REPORT_TEXT), 'w') as f:
+        f.write(format_report(report))
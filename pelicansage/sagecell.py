@@ -5,12 +5,17 @@ Requires the websocket-client package: http://pypi.python.org/pypi/websocket-cli
 """
 
 import websocket
+import base64
 import json
+import struct
+import timeit
+from datetime import datetime, timezone
+from queue import Empty
 from uuid import uuid4
 
 from .pelicansageio import pelicansageio
 
-from .managefiles import ResultTypes
+from .constants import ResultTypes, SAGE_INTERFACES
 
 import pprint
 
@@ -18,7 +23,56 @@ from .util import CellResult, SageError, combine_results
 
 CR = CellResult
 
+def timeout_message(timeout):
+    """
+    Returns the iopub error message recorded for a block interrupted after
+    running for timeout seconds.
+    """
+    evalue = 'Evaluation exceeded its deadline of %g seconds and was interrupted' % (timeout,)
+    return {'channel': 'iopub',
+            'msg_type': 'error',
+            'header': {'msg_type': 'error'},
+            'parent_header': {},
+            'metadata': {},
+            'content': {'ename': 'TimeoutError', 'evalue': evalue,
+                        'traceback': ['TimeoutError: ' + evalue]}}
+
+
+# iopub messages carrying the output of a block
+OUTPUT_MESSAGES = ('stream', 'display_data', 'execute_result', 'error')
+
+
+def output_size(msg):
+    """
+    Returns the size in bytes, encoded as UTF-8, of the output carried by
+    the iopub message msg, 0 for messages without output.
+    """
+    msg_type = msg['header']['msg_type']
+    content = msg['content']
+
+    if msg_type not in OUTPUT_MESSAGES:
+        return 0
+
+    if msg_type == 'stream':
+        payload = [content.get('text', '')]
+    elif msg_type == 'error':
+        payload = [content.get('ename', ''), content.get('evalue', '')] + list(content.get('traceback', []))
+    else:
+        payload = [data if isinstance(data, str) else json.dumps(data, default=str)
+                   for data in content.get('data', {}).values()]
+
+    return sum(len(part.encode('utf-8')) for part in payload)
+
+
 class BaseClient(object):
+    supports_checkpoints = False
+
+    # Seconds an interrupted block is given to stop
+    interrupt_grace = 5.0
+
+    # Whether the last call to execute_request ran past its deadline
+    timed_out = False
+
     def __init__(self, url, timeout=10, io=None):
 
         self.io = pelicansageio if io is None else io
@@ -32,15 +86,38 @@ class BaseClient(object):
         self._json_session_info = None
         self.kernel_id = None
 
+        # Statistics of the last call to execute_request
+        self.stats = {}
+
         self.reset()
     
     def reset(self):
+        # Releases what the session holds on the server, a retry starts a
+        # new one
+        if getattr(self, '_running', False):
+            try:
+                self.cleanup()
+            except Exception:
+                pass
 
         self._running = False
 
     def _code_keepalive(self, code):
         return code
 
+    def checkpoint(self, path):
+        """
+        Saves the kernel namespace to path, returns True on success.
+        Only supported by clients with supports_checkpoints set.
+        """
+        return False
+
+    def restore(self, path):
+        """
+        Restores a namespace saved by checkpoint, returns True on success.
+        """
+        return False
+
     def _get_terminate_command(self):
         return "exit"
 
@@ -51,54 +128,137 @@ class BaseClient(object):
         raise NotImplemented()
 
     def cleanup(self):
-        self.close()
+        if self._running:
+            self.close()
+
+    def execute_request(self, code, store_history=False, silent=False, timeout=None):
+        """
+        Executes code and returns the messages it produced.  If it runs for
+        more than timeout seconds the kernel is interrupted, timed_out is
+        set and a TimeoutError is recorded after the output produced so far.
+        """
+        self.stats = {'setup_time': 0.0,
+                      'exec_time': 0.0,
+                      'output_bytes': 0,
+                      'iopub_messages': 0,
+                      'endpoint': self.url}
+        self.timed_out = False
 
-    def execute_request(self, code, store_history=False):
         # zero out our list of messages, in case this is not the first request
         if not self._running:
+            start = timeit.default_timer()
+
             self._create_new_session()
 
             # RESPONSE: {"id": "ce20fada-f757-45e5-92fa-05e952dd9c87", "ws_url": "ws://localhost:8888/"}
             # construct the iopub and shell websocket channel urls from that
 
-            websocket.setdefaulttimeout(self.timeout)
-            self._ws = websocket.create_connection(self.kernel_url + 'channels',
-                                                   header={'Jupyter-Kernel-ID': self.kernel_id})
+            self._ws = self._connect()
             self._send_first_message()
 
             self._running = True
 
             code = self._code_keepalive(code)
 
+            self.stats['setup_time'] = timeit.default_timer() - start
+
         self.shell_messages = []
         self.iopub_messages = []
 
         # Send the JSON execute_request message string down the shell channel
 
-        msg = self._make_execute_request(code, store_history)
-        self._ws.send(msg)
-            
-        self._get_messages()
+        start = timeit.default_timer()
+
+        msg = self._make_execute_request(code, store_history, silent)
+        self._send(msg)
+
+        self._get_messages(None if timeout is None else start + timeout)
+
+        if self.timed_out:
+            self.iopub_messages.append(timeout_message(timeout))
+
+        self.stats['exec_time'] = timeit.default_timer() - start
+        self.stats['iopub_messages'] = len(self.iopub_messages)
 
         return {'kernel_url': self.kernel_url, 'shell': self.shell_messages, 'iopub': self.iopub_messages}
 
-    def _get_messages(self):
+    def _connect(self):
+        # The timeout only applies to this connection
+        return websocket.create_connection(self.kernel_url + 'channels',
+                                           header={'Jupyter-Kernel-ID': self.kernel_id},
+                                           timeout=self.timeout)
+
+    def _send(self, msg):
+        self._ws.send(msg)
+
+    def _decode(self, raw):
+        return json.loads(raw)
+
+    def _recv(self, deadline):
+        """
+        Returns the next frame, or None once deadline has passed.  The
+        connection timeout still applies to each frame.
+        """
+        if deadline is None:
+            return self._ws.recv()
+
+        remaining = deadline - timeit.default_timer()
+        if remaining <= 0:
+            return None
+
+        expires = self.timeout is None or remaining <= self.timeout
+        self._ws.settimeout(remaining if expires else self.timeout)
+        try:
+            return self._ws.recv()
+        except websocket.WebSocketTimeoutException:
+            if expires:
+                return None
+            raise
+        finally:
+            self._ws.settimeout(self.timeout)
+
+    def _interrupt(self):
+        self._send(self._make_request('interrupt_request', {}, channel='control'))
+
+    def _expire(self):
+        """
+        Interrupts the kernel running past its deadline and returns the
+        deadline for it to finish.
+        """
+        if self.timed_out:
+            raise Exception("Kernel %s did not stop within %g seconds of being interrupted." %
+                            (self.kernel_id, self.interrupt_grace))
+
+        self._interrupt()
+        self.timed_out = True
+
+        return timeit.default_timer() + self.interrupt_grace
+
+    def _get_messages(self, deadline=None):
         got_execute_reply = False
         got_idle_status = False
         while not (got_execute_reply and got_idle_status):
-            msg = json.loads(self._ws.recv())
+            raw = self._recv(deadline)
+            if raw is None:
+                deadline = self._expire()
+                continue
+            msg = self._decode(raw)
+            if self.timed_out and msg.get('msg_type', msg['header']['msg_type']) == 'error':
+                # The KeyboardInterrupt of the interrupted block
+                continue
             if msg['channel'] == 'shell':
                 self.shell_messages.append(msg)
                 # an execute_reply message signifies the computation is done
                 if msg['header']['msg_type'] == 'execute_reply':
                     got_execute_reply = True
             if msg['channel'] == 'iopub':
+                self.stats['output_bytes'] += output_size(msg)
                 self.iopub_messages.append(msg)
                 # the kernel status idle message signifies the kernel is done
                 if msg['header']['msg_type'] == 'status' and msg['content']['execution_state'] == 'idle':
                     got_idle_status = True
 
-    def _make_request(self, msg_type, content):
+    def _make_request(self, msg_type, content, channel=None):
         message = str(uuid4())
 
         # Here is the general form for an execute_request message
@@ -106,6 +266,8 @@ class BaseClient(object):
                             'parent_header':{},
                             'metadata': {},
                             'content': content}
+        if channel is not None:
+            request['channel'] = channel
 
         return json.dumps(request)
 
@@ -115,7 +277,7 @@ class BaseClient(object):
     def _make_kernel_info_request(self):
         return self._make_request('kernel_info_request', {})
 
-    def _make_execute_request(self, code, store_history=False):
+    def _make_execute_request(self, code, store_history=False, silent=False):
         return self._make_request('execute_request', {})
 
     def close(self):
@@ -223,6 +385,17 @@ class BaseClient(object):
 
 class SageCell(BaseClient):
 
+    def __init__(self, url, timeout=10, io=None, language=None):
+        # Language of the code executed, one of SAGE_INTERFACES runs through
+        # its Sage interface, anything else as Sage code
+        self.language = language
+        BaseClient.__init__(self, url, timeout=timeout, io=io)
+
+    def execute_request(self, code, *args, **kwargs):
+        if self.language in SAGE_INTERFACES:
+            code = 'print(%s.eval(%r))' % (self.language, code)
+        return BaseClient.execute_request(self, code, *args, **kwargs)
+
     def _create_new_session(self):
         self.req_ses = self.io.requests.Session()
         s = self.req_ses
@@ -239,9 +412,9 @@ class SageCell(BaseClient):
     def _send_first_message(self):
         return
 
-    def _make_execute_request(self, code, store_history=False):
+    def _make_execute_request(self, code, store_history=False, silent=False):
         content = {'code': code, 
-                   'silent': False, 
+                   'silent': silent, 
                    'store_history' : store_history,
                    'user_variables': [], 
                    'user_expressions': {'_sagecell_files': 'sys._sage_.new_files()'}, 
@@ -258,6 +431,11 @@ class SageCell(BaseClient):
 
 class IPythonNotebookClient(BaseClient):
 
+    def __init__(self, url, timeout=10, io=None, kernel_name=None):
+        # Kernel spec requested for the session, the server default if None
+        self.kernel_name = kernel_name
+        BaseClient.__init__(self, url, timeout=timeout, io=io)
+
     def _create_new_session(self):
         self.req_ses = self.io.requests.Session()
         s = self.req_ses
@@ -278,6 +456,8 @@ class IPythonNotebookClient(BaseClient):
                                       'path': self.notebook_path if self.notebook_path else ''
                                     }
                                  }
+        if self.kernel_name:
+            self._json_session_info['kernel'] = {'name': self.kernel_name}
         self._json_session_info = json.dumps(self._json_session_info)
         resp = s.post(url=self.url+'api/sessions',
                                    data=self._json_session_info,
@@ -291,24 +471,395 @@ class IPythonNotebookClient(BaseClient):
     def _send_first_message(self):
         self._ws.send(self.session + ":")
 
-    def cleanup(self):
-        if self._running and self._ws.connected:
-            self._ws.send(self._make_request('shutdown_request', {'restart': False}))
-            self.req_ses.delete(url=self.url+'api/sessions/%s' % (self.session,),
-                                headers={'Accept': 'application/json'})
-            self.req_ses.delete(url=self.url+'api/notebooks/%s' %(self.notebook_name,),
-                          data=self._json_session_info,
+    def _interrupt(self):
+        self.req_ses.post(url=self.url + 'api/kernels/%s/interrupt' % (self.kernel_id,),
                           headers={'Accept': 'application/json'})
 
-    def _make_execute_request(self, code, store_history=False):
+    def cleanup(self):
+        if self._running:
+            try:
+                if self._ws.connected:
+                    self._ws.send(self._make_request('shutdown_request', {'restart': False}))
+                    self.close()
+            finally:
+                # The session and notebook outlive a dropped connection
+                self.req_ses.delete(url=self.url+'api/sessions/%s' % (self.session,),
+                                    headers={'Accept': 'application/json'})
+                self.req_ses.delete(url=self.url+'api/notebooks/%s' %(self.notebook_name,),
+                                    data=self._json_session_info,
+                                    headers={'Accept': 'application/json'})
+            self._running = False
+
+    def _make_execute_request(self, code, store_history=False, silent=False):
         content = {'code': code, 
-                   'silent': False, 
+                   'silent': silent, 
                    'store_history' : store_history,
                    'user_variables': [], 
                    'user_expressions': {}, 
                    'allow_stdin': False}
         return self._make_request('execute_request', content)
 
+
+# Websocket subprotocol of Jupyter Server 2, messages are binary frames
+# whose JSON parts and buffers are delimited by offsets.
+KERNEL_WS_PROTOCOL = 'v1.kernel.websocket.jupyter.org'
+
+MESSAGE_PARTS = ('header', 'parent_header', 'metadata', 'content')
+
+
+def serialize_ws_v1(channel, parts):
+    """
+    Returns the binary frame of the message parts (header, parent header,
+    metadata, content and buffers, as bytes) sent on channel.
+    """
+    channel = channel.encode('utf-8')
+
+    offsets = [8 * (len(parts) + 3), 8 * (len(parts) + 3) + len(channel)]
+    for part in parts:
+        offsets.append(offsets[-1] + len(part))
+
+    return b''.join([struct.pack('<%dQ' % (len(offsets) + 1,), len(offsets), *offsets), channel] + list(parts))
+
+
+def deserialize_ws_v1(frame):
+    """
+    Returns the channel and the parts of a binary frame.
+    """
+    count = struct.unpack_from('<Q', frame)[0]
+    offsets = struct.unpack_from('<%dQ' % (count,), frame, 8)
+
+    channel = frame[offsets[0]:offsets[1]].decode('utf-8')
+    parts = [frame[offsets[i]:offsets[i + 1]] for i in range(1, count - 1)]
+
+    return channel, parts
+
+
+def deserialize_binary_message(frame):
+    """
+    Returns the message of a binary frame sent without subprotocol, a JSON
+    message followed by its buffers.
+    """
+    count = struct.unpack_from('!I', frame)[0]
+    offsets = list(struct.unpack_from('!%dI' % (count,), frame, 4)) + [len(frame)]
+
+    msg = json.loads(frame[offsets[0]:offsets[1]].decode('utf-8'))
+    msg['buffers'] = [frame[offsets[i]:offsets[i + 1]] for i in range(1, count)]
+
+    return msg
+
+
+class JupyterServerClient(BaseClient):
+    """
+    Client of the kernels and sessions REST API of Jupyter Server (and of
+    the notebook server since version 5).
+
+    Messages are exchanged as binary frames of the
+    v1.kernel.websocket.jupyter.org subprotocol, falling back to JSON text
+    frames on servers which do not support it or with binary=False.
+    Images are returned as raw bytes, ready to be saved as files.
+    """
+
+    def __init__(self, url, timeout=10, io=None, kernel_name=None, token=None, binary=True):
+        # Kernel spec requested for the session, the server default if None
+        self.kernel_name = kernel_name
+        self.token = token
+        self.binary = binary
+        # Subprotocol negotiated with the server, None for JSON frames
+        self.protocol = None
+        self.session_id = None
+        BaseClient.__init__(self, url, timeout=timeout, io=io)
+
+    def _auth_headers(self):
+        return {'Authorization': 'token %s' % (self.token,)} if self.token else {}
+
+    def _create_new_session(self):
+        self.req_ses = self.io.requests.Session()
+        self.req_ses.headers.update(self._auth_headers())
+
+        path = 'pelicansage-%s.ipynb' % (uuid4().hex,)
+        model = {'path': path, 'name': path, 'type': 'notebook'}
+        if self.kernel_name:
+            model['kernel'] = {'name': self.kernel_name}
+
+        resp = self.req_ses.post(url=self.url + 'api/sessions',
+                                 data=json.dumps(model),
+                                 headers={'Accept': 'application/json', 'Content-Type': 'application/json'})
+        resp.raise_for_status()
+
+        resp_json = resp.json()
+        self.session_id = resp_json['id']
+        self.kernel_id = resp_json['kernel']['id']
+        # Identifies this client in the headers of its messages
+        self.session = uuid4().hex
+        self.kernel_url = self.url.replace('http', 'ws', 1) + 'api/kernels/' + self.kernel_id + '/'
+
+    def _connect(self):
+        url = self.kernel_url + 'channels?session_id=' + self.session
+        header = self._auth_headers()
+
+        if self.binary:
+            try:
+                ws = websocket.create_connection(url, header=header, timeout=self.timeout,
+                                                 subprotocols=[KERNEL_WS_PROTOCOL])
+                self.protocol = KERNEL_WS_PROTOCOL
+                return ws
+            except websocket.WebSocketException:
+                # The server did not accept the subprotocol
+                pass
+
+        self.protocol = None
+        return websocket.create_connection(url, header=header, timeout=self.timeout)
+
+    def _send_first_message(self):
+        return
+
+    def _interrupt(self):
+        # The server interrupts the kernel however its kernel spec asks to,
+        # a signal or an interrupt_request on the control channel
+        resp = self.req_ses.post(url=self.url + 'api/kernels/%s/interrupt' % (self.kernel_id,),
+                                 headers={'Accept': 'application/json'})
+        resp.raise_for_status()
+
+    def _send(self, msg):
+        if isinstance(msg, bytes):
+            self._ws.send_binary(msg)
+        else:
+            self._ws.send(msg)
+
+    def _make_request(self, msg_type, content, channel='shell'):
+        header = {'msg_type': msg_type,
+                  'msg_id': str(uuid4()),
+                  'username': '',
+                  'session': self.session,
+                  'date': datetime.now(timezone.utc).isoformat(),
+                  'version': '5.3'}
+
+        if self.protocol == KERNEL_WS_PROTOCOL:
+            return serialize_ws_v1(channel, [json.dumps(part).encode('utf-8') for part in (header, {}, {}, content)])
+
+        return json.dumps({'header': header, 'parent_header': {}, 'metadata': {}, 'content': content,
+                           'channel': channel, 'buffers': []})
+
+    def _decode(self, raw):
+        if not isinstance(raw, bytes):
+            msg = json.loads(raw)
+        elif self.protocol == KERNEL_WS_PROTOCOL:
+            channel, parts = deserialize_ws_v1(raw)
+            msg = dict(zip(MESSAGE_PARTS, (json.loads(part.decode('utf-8')) for part in parts[:4])))
+            msg['buffers'] = parts[4:]
+            msg['channel'] = channel
+        else:
+            msg = deserialize_binary_message(raw)
+
+        msg.setdefault('msg_type', msg['header']['msg_type'])
+        return msg
+
+    def _make_execute_request(self, code, store_history=False, silent=False):
+        content = {'code': code,
+                   'silent': silent,
+                   'store_history': store_history,
+                   'user_expressions': {},
+                   'allow_stdin': False,
+                   'stop_on_error': True}
+        return self._make_request('execute_request', content)
+
+    def get_streams_from_response(self, response):
+        results = BaseClient.get_streams_from_response(self, response)
+
+        # Decoded once here, the bytes are written to disk as they are
+        return [CR(ResultTypes.Image, r.order, base64.b64decode(r.data), r.mimetype)
+                if r.mimetype == 'image/png' and not isinstance(r.data, bytes) else r
+                for r in results]
+
+    def cleanup(self):
+        if self._running:
+            try:
+                self.close()
+            finally:
+                # Deleting the session shuts its kernel down
+                self.req_ses.delete(url=self.url + 'api/sessions/%s' % (self.session_id,),
+                                    headers={'Accept': 'application/json'})
+            self._running = False
+
+# Executed in python kernels to save / restore the user namespace with a
+# pickle compatible library able to serialize functions and lambdas.
+_CHECKPOINT_CODE = """
+def _pelicansage_checkpoint(path):
+    import os
+    try:
+        import dill as pickler
+    except ImportError:
+        import cloudpickle as pickler
+    skip = ('In', 'Out', 'exit', 'quit', 'get_ipython')
+    namespace = dict((k, v) for k, v in globals().items() if not k.startswith('_') and k not in skip)
+    try:
+        with open(path + '.tmp', 'wb') as f:
+            pickler.dump(namespace, f)
+        os.replace(path + '.tmp', path)
+    finally:
+        if os.path.exists(path + '.tmp'):
+            os.remove(path + '.tmp')
+try:
+    _pelicansage_checkpoint(%r)
+finally:
+    del _pelicansage_checkpoint
+"""
+
+_RESTORE_CODE = """
+def _pelicansage_restore(path):
+    try:
+        import dill as pickler
+    except ImportError:
+        import cloudpickle as pickler
+    with open(path, 'rb') as f:
+        globals().update(pickler.load(f))
+try:
+    _pelicansage_restore(%r)
+finally:
+    del _pelicansage_restore
+"""
+
+
+class LocalKernelClient(BaseClient):
+    """
+    Runs code in a kernel launched on this machine through jupyter_client,
+    talking to it directly over ZeroMQ instead of a notebook server.
+
+    Python (and Sage) kernels support namespace checkpoints, which need dill
+    or cloudpickle installed in the kernel environment.
+    """
+
+    supports_checkpoints = True
+
+    def __init__(self, kernel_name='python3', timeout=10, io=None):
+        self.kernel_name = kernel_name
+        self.km = None
+        self.kc = None
+        BaseClient.__init__(self, 'local://' + kernel_name, timeout=timeout, io=io)
+
+    def reset(self):
+        if self.km is not None:
+            self.cleanup()
+
+        self._running = False
+
+    def _create_new_session(self):
+        try:
+            from jupyter_client.manager import KernelManager
+        except ImportError:
+            raise Exception("jupyter_client is required to evaluate %s blocks with a local kernel." %
+                            (self.kernel_name,))
+
+        self.km = KernelManager(kernel_name=self.kernel_name)
+        self.km.start_kernel()
+        self.kc = self.km.client()
+        self.kc.start_channels()
+        self.kc.wait_for_ready(timeout=self.timeout)
+
+        self.kernel_id = self.km.kernel_id if hasattr(self.km, 'kernel_id') else None
+        self.session = self.kc.session.session
+        self.kernel_url = self.url
+
+    def execute_request(self, code, store_history=False, silent=False, timeout=None):
+        self.stats = {'setup_time': 0.0,
+                      'exec_time': 0.0,
+                      'output_bytes': 0,
+                      'iopub_messages': 0,
+                      'endpoint': self.url}
+        self.timed_out = False
+
+        if not self._running:
+            start = timeit.default_timer()
+            self._create_new_session()
+            self._running = True
+            self.stats['setup_time'] = timeit.default_timer() - start
+
+        self.shell_messages = []
+        self.iopub_messages = []
+
+        start = timeit.default_timer()
+
+        msg_id = self.kc.execute(code, silent=silent, store_history=store_history, allow_stdin=False)
+
+        self._get_messages(msg_id, None if timeout is None else start + timeout)
+
+        if self.timed_out:
+            self.iopub_messages.append(timeout_message(timeout))
+
+        self.stats['exec_time'] = timeit.default_timer() - start
+        self.stats['iopub_messages'] = len(self.iopub_messages)
+
+        return {'kernel_url': self.kernel_url, 'shell': self.shell_messages, 'iopub': self.iopub_messages}
+
+    def _recv_from(self, get_msg, deadline):
+        # get_msg raises Empty after its timeout
+        if deadline is None:
+            return get_msg(timeout=self.timeout)
+
+        remaining = deadline - timeit.default_timer()
+        if remaining <= 0:
+            return None
+
+        expires = self.timeout is None or remaining <= self.timeout
+        try:
+            return get_msg(timeout=remaining if expires else self.timeout)
+        except Empty:
+            if expires:
+                return None
+            raise
+
+    def _interrupt(self):
+        self.km.interrupt_kernel()
+
+    def _get_messages(self, msg_id=None, deadline=None):
+        got_idle_status = False
+        while not got_idle_status:
+            msg = self._recv_from(self.kc.get_iopub_msg, deadline)
+            if msg is None:
+                deadline = self._expire()
+                continue
+            if msg['parent_header'].get('msg_id') != msg_id:
+                continue
+            if self.timed_out and msg['msg_type'] == 'error':
+                continue
+            msg['channel'] = 'iopub'
+            self.stats['output_bytes'] += output_size(msg)
+            self.iopub_messages.append(msg)
+            if msg['msg_type'] == 'status' and msg['content']['execution_state'] == 'idle':
+                got_idle_status = True
+
+        while True:
+            msg = self._recv_from(self.kc.get_shell_msg, deadline)
+            if msg is None:
+                deadline = self._expire()
+                continue
+            if msg['parent_header'].get('msg_id') == msg_id:
+                msg['channel'] = 'shell'
+                self.shell_messages.append(msg)
+                break
+
+    def _execute_ok(self, code):
+        self.execute_request(code, silent=True)
+        return bool(self.shell_messages) and self.shell_messages[-1]['content'].get('status') == 'ok'
+
+    def checkpoint(self, path):
+        return self._execute_ok(_CHECKPOINT_CODE % (path,))
+
+    def restore(self, path):
+        return self._execute_ok(_RESTORE_CODE % (path,))
+
+    def close(self):
+        if self.kc is not None:
+            self.kc.stop_channels()
+        if self.km is not None:
+            self.km.shutdown_kernel(now=True)
+        self.kc = None
+        self.km = None
+
+    def cleanup(self):
+        self.close()
+
+
 def traverse_down(collection, *args):
     node = collection
     for arg in args:
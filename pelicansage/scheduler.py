@@ -0,0 +1,214 @@
+"""
+Ordering of source evaluation by the references between sources.
+
+A source embedding results of another source through sageresult / sageimage
+(a SrcReference) is only dispatched once the referenced source finished
+evaluating, while independent sources are dispatched as soon as possible.
+
+Given the estimated cost of every source, from the durations recorded by
+previous builds, ready sources are dispatched longest first.  The cost of
+a source includes the longest chain of sources waiting on it, so a long
+chain is started before a single long source.
+"""
+
+import logging
+from collections import defaultdict
+
+logger = logging.getLogger(__name__)
+
+
+class SourceGraph(object):
+    """
+    Directed acyclic graph of the sources awaiting evaluation.
+
+    references is an iterable of (src, upstream) pairs where src embeds
+    results of upstream.  Pairs involving sources which are not awaiting
+    evaluation are ignored, their results are already available.  costs
+    optionally maps sources to their estimated evaluation time, without it
+    ready sources are dispatched in the order of sources.
+    """
+
+    def __init__(self, sources, references, costs=None):
+        self.sources = list(sources)
+        self.costs = costs
+
+        known = set(self.sources)
+
+        self._upstream = dict((src, set()) for src in self.sources)
+        self._downstream = defaultdict(set)
+
+        for src, upstream in references:
+            if src in known and upstream in known and src != upstream:
+                self._upstream[src].add(upstream)
+                self._downstream[upstream].add(src)
+
+        self._break_cycles()
+
+        self._priority = self._priorities() if costs is not None else None
+
+        self._ready = []
+        self._add_ready([src for src in self.sources if not self._upstream[src]])
+        self._done = set()
+
+    def _priorities(self):
+        # Cost of a source plus the longest chain of sources waiting on it
+        priority = {}
+        for src in reversed(self.topological_order()):
+            priority[src] = self.costs.get(src, 0.0) + max([priority[downstream] for downstream
+                                                            in self._downstream[src]] or [0.0])
+        return priority
+
+    def _add_ready(self, sources):
+        self._ready.extend(sources)
+        if self._priority is not None:
+            # Stable, equally expensive sources keep their order
+            self._ready.sort(key=lambda src: -self._priority[src])
+
+    def priority(self, src):
+        return None if self._priority is None else self._priority[src]
+
+    def _break_cycles(self):
+        # Kahn's algorithm, whatever can not be ordered is part of a cycle
+        remaining = dict((src, len(upstream)) for src, upstream in self._upstream.items())
+        ordered = [src for src, count in remaining.items() if count == 0]
+
+        for src in ordered:
+            for downstream in self._downstream[src]:
+                remaining[downstream] -= 1
+                if remaining[downstream] == 0:
+                    ordered.append(downstream)
+
+        unordered = set(self.sources) - set(ordered)
+
+        if not unordered:
+            return
+
+        def reaches(start, target):
+            seen = set()
+            stack = [start]
+            while stack:
+                node = stack.pop()
+                if node == target:
+                    return True
+                if node in seen or node not in unordered:
+                    continue
+                seen.add(node)
+                stack.extend(self._upstream[node])
+            return False
+
+        # Sources downstream of a cycle are unordered too, only the
+        # references within a cycle are dropped.
+        cyclic = [(src, upstream) for src in unordered for upstream in self._upstream[src]
+                  if reaches(upstream, src)]
+
+        logger.warning("Circular result references between %s, evaluating them without ordering.",
+                       ', '.join(sorted(set(src for src, _ in cyclic))))
+
+        for src, upstream in cyclic:
+            self._upstream[src].discard(upstream)
+            self._downstream[upstream].discard(src)
+
+    def upstream(self, src):
+        return set(self._upstream[src])
+
+    def has_ready(self):
+        return bool(self._ready)
+
+    def pop_ready(self, accept=None):
+        """
+        Returns the next source whose upstream sources all finished and
+        which is accepted by accept, or None if there is no such source.
+        """
+        for indx, src in enumerate(self._ready):
+            if accept is None or accept(src):
+                return self._ready.pop(indx)
+
+        return None
+
+    def complete(self, src):
+        """
+        Marks src as evaluated and returns the sources it made ready.
+        """
+        self._done.add(src)
+        ready = []
+
+        for downstream in sorted(self._downstream[src], key=self.sources.index):
+            self._upstream[downstream].discard(src)
+            if not self._upstream[downstream] and downstream not in self._done:
+                ready.append(downstream)
+
+        self._add_ready(ready)
+
+        return ready
+
+    def topological_order(self):
+        """
+        Returns all sources in an order respecting their references.
+        """
+        remaining = dict((src, set(upstream)) for src, upstream in self._upstream.items())
+        order = [src for src in self.sources if not remaining[src]]
+
+        for src in order:
+            for downstream in sorted(self._downstream[src], key=self.sources.index):
+                remaining[downstream].discard(src)
+                if not remaining[downstream] and downstream not in order:
+                    order.append(downstream)
+
+        return order
+
+
+def estimate_costs(tasks, durations, default=None):
+    """
+    Returns the estimated evaluation time of every source of tasks, a
+    dictionary of source to BlockTasks, together with the estimates of
+    their blocks by (src, order).
+
+    Blocks are estimated by durations, the recorded duration by (src,
+    order), then by the mean duration of the blocks of their source, then
+    by the mean of all durations (or default if nothing was recorded).
+    Every block counts, evaluated blocks are replayed to rebuild the
+    namespace.
+    """
+    recorded = list(durations.values())
+    fallback = sum(recorded) / len(recorded) if recorded else (1.0 if default is None else default)
+
+    by_src = {}
+    for (src, order), duration in durations.items():
+        by_src.setdefault(src, []).append(duration)
+
+    costs = {}
+    estimates = {}
+
+    for src, src_tasks in tasks.items():
+        src_durations = by_src.get(src)
+        src_fallback = sum(src_durations) / len(src_durations) if src_durations else fallback
+
+        for task in src_tasks:
+            estimates[(src, task.order)] = durations.get((src, task.order), src_fallback)
+
+        costs[src] = sum(estimates[(src, task.order)] for task in src_tasks)
+
+    return costs, estimates
+
+
+def simulate(graph, workers):
+    """
+    Returns the wall time and the start time of every source when the
+    sources of graph, a SourceGraph with costs, are dispatched to workers
+    concurrent workers.  The graph is consumed.
+    """
+    now = 0.0
+    started = {}
+    running = []
+
+    while graph.has_ready() or running:
+        while len(running) < max(1, workers) and graph.has_ready():
+            src = graph.pop_ready()
+            started[src] = now
+            running.append((now + graph.costs.get(src, 0.0), src))
+
+        running.sort()
+        now, src = running.pop(0)
+        graph.complete(src)
+
+    return now, started
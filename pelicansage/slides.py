@@ -1,14 +1,20 @@
 from pelican.generators import CachingGenerator
+from pelican.cache import FileDataCacher
 from pelican.contents import Content
 
-from hovercraft.generate import generate
 from argparse import Namespace
+from concurrent.futures import ProcessPoolExecutor
+import hashlib
 import os
 
 import logging
 
+from .tracing import get_tracer
+
 logger = logging.getLogger(__name__)
 
+MATHJAX_CDN = 'https://cdnjs.cloudflare.com/ajax/libs/mathjax/2.7.1/MathJax.js?config=TeX-MML-AM_CHTML'
+
 
 class Slides(Content):
     mandatory_properties = ('title',)
@@ -20,43 +26,134 @@ class Slides(Content):
         return True
 
 
+def _generate_deck(args):
+    """
+    Generates a single deck, run in a worker process.  Returns the files
+    the deck was generated from, or the error message if it failed.
+    """
+    from hovercraft.generate import generate
+
+    try:
+        return True, sorted(generate(args))
+    except Exception as e:
+        return False, '%s: %s' % (e.__class__.__name__, e)
+
+
+def _hash_files(digest, paths):
+    for path in sorted(paths):
+        digest.update(path.encode('utf-8') + b'\0')
+        try:
+            with open(path, 'rb') as f:
+                digest.update(f.read())
+        except (IOError, OSError):
+            digest.update(b'\0missing')
+        digest.update(b'\0')
+
+
+def _hash_directory(path):
+    digest = hashlib.sha1()
+    _hash_files(digest, [os.path.join(root, name) for root, _, names in os.walk(path) for name in names])
+    return digest.hexdigest()
+
+
 class SlidesGenerator(CachingGenerator):
-    """Generates Hovercraft Slides"""
+    """Generates Hovercraft Slides
+
+    Every deck is generated into its own directory below slides/.  Decks are
+    fingerprinted by their source files, the template and the MathJax url,
+    decks whose fingerprint did not change since the previous build are not
+    generated again unless SLIDES_CACHE is False.  Changed decks are
+    generated in a pool of SLIDES_PROCESSES processes.
+    """
 
     def __init__(self, *args, **kwargs):
         self.slides = []
         self.hidden_slides = []
         super(SlidesGenerator, self).__init__(*args, **kwargs)
 
+        # Decks are not read through the readers, the fingerprints are kept
+        # in a cache of their own whatever the content caching settings are.
+        use_cache = self.settings.get('SLIDES_CACHE', True)
+        FileDataCacher.__init__(self, self.settings, self.__class__.__name__, use_cache, use_cache)
+
     def generate_context(self):
         pass
 
+    def _deck_name(self, f):
+        for root in self.settings['SLIDE_PATHS']:
+            if f.startswith(root.rstrip('/') + os.sep):
+                f = os.path.relpath(f, root)
+                break
+        return os.path.splitext(f)[0]
+
+    def _fingerprint(self, presentation, sources, template_hash, mathjax):
+        digest = hashlib.sha1()
+        digest.update(template_hash.encode('ascii') + b'\0' + mathjax.encode('utf-8') + b'\0')
+        _hash_files(digest, set(sources) | {presentation})
+        return digest.hexdigest()
+
     def generate_output(self, writer):
+        with get_tracer().span('slides', 'phase', memory=True):
+            self._generate_decks()
+
+    def _generate_decks(self):
 
         template_path = os.path.abspath(self.settings['SLIDES_THEME'])
         output_path = os.path.abspath(os.path.join(self.output_path, 'slides'))
-        mathjax_cdn = 'https://cdnjs.cloudflare.com/ajax/libs/mathjax/2.7.1/MathJax.js?config=TeX-MML-AM_CHTML'
+        mathjax = os.environ.get('HOVERCRAFT_MATHJAX', MATHJAX_CDN)
+        template_hash = _hash_directory(template_path)
+
+        pending = []
 
         for f in self.get_files(
                 self.settings['SLIDE_PATHS'],
                 exclude=self.settings['SLIDE_EXCLUDES']):
 
-            presentation = os.path.abspath(os.path.join('content', f))
+            presentation = os.path.abspath(os.path.join(self.path, f))
+            targetdir = os.path.join(output_path, self._deck_name(f))
+
+            cached = FileDataCacher.get_cached_data(self, f, None)
+            if cached is not None and os.path.exists(os.path.join(targetdir, 'index.html')):
+                fingerprint, sources = cached
+                if fingerprint == self._fingerprint(presentation, sources, template_hash, mathjax):
+                    logger.debug('Slides %s are up to date', f)
+                    continue
+
             args = Namespace(presentation=presentation,
                              template=template_path,
-                             targetdir=output_path,
+                             targetdir=targetdir,
                              css=None,
                              js=None,
                              auto_console=False,
                              slide_numbers=False,
                              skip_help=False,
                              skip_notes=False,
-                             mathjax=os.environ.get('HOVERCRAFT_MATHJAX', mathjax_cdn))
+                             mathjax=mathjax)
+
+            pending.append((f, args))
 
+        if not pending:
+            return
 
-            try:
-                generate(args)
-            except Exception as e:
+        logger.info('Generating %d slide decks', len(pending))
+
+        processes = self.settings.get('SLIDES_PROCESSES')
+
+        if len(pending) == 1 or processes == 1:
+            generated = [_generate_deck(args) for _, args in pending]
+        else:
+            with ProcessPoolExecutor(max_workers=processes) as pool:
+                generated = list(pool.map(_generate_deck, [args for _, args in pending]))
+
+        for (f, args), (ok, result) in zip(pending, generated):
+            if not ok:
                 logger.error(
-                    'Could not process %s\n%s', f, e)
+                    'Could not process %s\n%s', f, result)
                 self._add_failed_source_path(f)
+                continue
+
+            FileDataCacher.cache_data(self, f, (self._fingerprint(args.presentation, result,
+                                                                  template_hash, args.mathjax),
+                                                result))
+
+        self.save_cache()
@@ -0,0 +1,164 @@
+"""
+Immutable in-memory view of the evaluated code blocks used while rendering.
+
+The second pass of the build only reads code blocks and their results.  A
+RenderSnapshot loads them once, with one query per table, into plain
+records indexed by code id, (src, order) and (src, user_id) so directives
+never go through the ORM (or accidentally write to it) while rendering.
+"""
+
+from .managefiles import (CodeBlock, DataSrc, StreamResult, FileResult, ErrorResult, ResultBlob, ResultTypes,
+                          decompress_payload)
+
+
+class SrcRecord(object):
+    __slots__ = ('id', 'src', 'permalink', 'filetype')
+
+    def __init__(self, id, src, permalink, filetype):
+        self.id = id
+        self.src = src
+        self.permalink = permalink
+        self.filetype = filetype
+
+
+class ResultRecord(object):
+    """
+    A stream, file or error result, exposing the same attributes as the
+    corresponding StreamResult, FileResult and ErrorResult rows.
+    """
+    __slots__ = ('id', 'code_id', 'type', 'order', 'mimetype', 'result', 'file_name',
+                 'ename', 'evalue', 'traceback')
+
+    def __init__(self, id, code_id, type, order, mimetype, result=None, file_name=None,
+                 ename=None, evalue=None, traceback=None):
+        self.id = id
+        self.code_id = code_id
+        self.type = type
+        self.order = order
+        self.mimetype = mimetype
+        self.result = result
+        self.file_name = file_name
+        self.ename = ename
+        self.evalue = evalue
+        self.traceback = traceback
+
+    @property
+    def data(self):
+        if self.type == ResultTypes.Stream:
+            return self.result
+        return self
+
+
+class CodeRecord(object):
+    __slots__ = ('id', 'src', 'order', 'user_id', 'content', 'language', 'platform', 'permalink',
+                 'last_evaluated', 'stream_results', 'file_results', 'error_results', 'results')
+
+    def __init__(self, id, src, order, user_id, content, language, platform, permalink, last_evaluated):
+        self.id = id
+        self.src = src
+        self.order = order
+        self.user_id = user_id
+        self.content = content
+        self.language = language
+        self.platform = platform
+        self.permalink = permalink
+        self.last_evaluated = last_evaluated
+        self.stream_results = ()
+        self.file_results = ()
+        self.error_results = ()
+        self.results = ()
+
+
+def _by_order(results):
+    # Same ordering as CodeBlock.results, stable within equal orders
+    return tuple(sorted(results, key=lambda x: (x.order is None, x.order or 0)))
+
+
+class RenderSnapshot(object):
+
+    def __init__(self, manager):
+        srcs = dict((row.id, SrcRecord(row.id, row.src, row.permalink, row.filetype))
+                    for row in manager.query(DataSrc.id, DataSrc.src, DataSrc.permalink, DataSrc.filetype))
+
+        self._by_id = {}
+        self._by_order = {}
+        self._by_user_id = {}
+
+        for row in manager.query(CodeBlock.id, CodeBlock.src_id, CodeBlock.order, CodeBlock.user_id,
+                                 CodeBlock.content, CodeBlock.language, CodeBlock.platform,
+                                 CodeBlock.permalink, CodeBlock.last_evaluated).order_by(CodeBlock.id):
+            src = srcs.get(row.src_id)
+            if src is None:
+                continue
+
+            record = CodeRecord(row.id, src, row.order, row.user_id, row.content, row.language,
+                                row.platform, row.permalink, row.last_evaluated)
+
+            self._by_id[record.id] = record
+            self._by_order[(src.src, record.order)] = record
+            if record.user_id is not None:
+                # get_code returns the first match, keep the lowest id
+                self._by_user_id.setdefault((src.src, str(record.user_id)), record)
+
+        streams = {}
+        files = {}
+        errors = {}
+
+        # Payloads shared by several results are decompressed, and kept, once
+        texts = {}
+
+        def text(blob_id, codec, payload, legacy):
+            if blob_id is None:
+                return legacy
+            if blob_id not in texts:
+                texts[blob_id] = decompress_payload(codec, payload)
+            return texts[blob_id]
+
+        for row in manager.query(StreamResult.id, StreamResult.code_id, StreamResult.order,
+                                 StreamResult.mimetype, StreamResult._result, StreamResult.blob_id,
+                                 ResultBlob.codec, ResultBlob.payload)\
+                          .outerjoin(ResultBlob, StreamResult.blob_id == ResultBlob.id).order_by(StreamResult.id):
+            streams.setdefault(row.code_id, []).append(
+                ResultRecord(row.id, row.code_id, ResultTypes.Stream, row.order, row.mimetype,
+                             result=text(row.blob_id, row.codec, row.payload, row._result)))
+
+        for row in manager.query(FileResult.id, FileResult.code_id, FileResult.order,
+                                 FileResult.mimetype, FileResult.file_name).order_by(FileResult.id):
+            files.setdefault(row.code_id, []).append(
+                ResultRecord(row.id, row.code_id, ResultTypes.Image, row.order, row.mimetype,
+                             file_name=row.file_name))
+
+        for row in manager.query(ErrorResult.id, ErrorResult.code_id, ErrorResult.order,
+                                 ErrorResult.ename, ErrorResult.evalue, ErrorResult._traceback,
+                                 ErrorResult.traceback_blob_id, ResultBlob.codec, ResultBlob.payload)\
+                          .outerjoin(ResultBlob, ErrorResult.traceback_blob_id == ResultBlob.id)\
+                          .order_by(ErrorResult.id):
+            errors.setdefault(row.code_id, []).append(
+                ResultRecord(row.id, row.code_id, ResultTypes.Error, row.order, ErrorResult.mimetype,
+                             ename=row.ename, evalue=row.evalue,
+                             traceback=text(row.traceback_blob_id, row.codec, row.payload, row._traceback)))
+
+        for code_id, record in self._by_id.items():
+            record.stream_results = tuple(streams.get(code_id, ()))
+            record.file_results = tuple(files.get(code_id, ()))
+            record.error_results = tuple(errors.get(code_id, ()))
+            record.results = _by_order(record.stream_results + record.file_results + record.error_results)
+
+    def __len__(self):
+        return len(self._by_id)
+
+    def __iter__(self):
+        return iter(self._by_id.values())
+
+    def get_code(self, code_id=None, user_id=None, src=None, order=None):
+        """
+        Looks up a code block by id, by (src, user_id) or by (src, order),
+        returning None if there is no such block.
+        """
+        if src is not None and user_id is not None:
+            return self._by_user_id.get((src, str(user_id)))
+
+        if src is not None and order is not None:
+            return self._by_order.get((src, order))
+
+        return self._by_id.get(code_id)
@@ -0,0 +1,185 @@
+"""
+Opt-in tracing of where a build spends its time.
+
+Spans are recorded around the build phases, every evaluated source and
+block, the database writes and the rendering of each source, and written
+as a Chrome trace (chrome://tracing, https://ui.perfetto.dev).  Phase
+spans optionally capture the tracemalloc peak and top allocations.
+
+Tracing is configured with the TRACE_PATH and TRACE_MEMORY settings.  When
+it is disabled span() returns a shared no-op span.
+"""
+
+import json
+import os
+import threading
+import timeit
+import tracemalloc
+
+from .pelicansageio import create_directory_tree
+
+# Number of allocation sites listed for each phase
+TOP_ALLOCATIONS = 10
+
+
+class _NullSpan(object):
+    @property
+    def args(self):
+        return {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def finish(self):
+        pass
+
+
+NULL_SPAN = _NullSpan()
+
+
+class Span(object):
+    def __init__(self, tracer, name, category, args, memory):
+        self.tracer = tracer
+        self.name = name
+        self.category = category
+        self.args = args
+        self.memory = memory and tracer.memory
+        self.peak = 0
+        self.start = None
+        self.end = None
+
+    def begin(self):
+        if self.memory:
+            self.tracer._memory_begin(self)
+        self.start = timeit.default_timer()
+        return self
+
+    def finish(self):
+        if self.end is not None:
+            return
+        self.end = timeit.default_timer()
+        if self.memory:
+            self.tracer._memory_end(self)
+        self.tracer._add(self, self.end)
+
+    def __enter__(self):
+        return self.begin()
+
+    def __exit__(self, exc_type, *exc):
+        if exc_type is not None:
+            self.args['error'] = exc_type.__name__
+        self.finish()
+        return False
+
+
+class Tracer(object):
+
+    def __init__(self, enabled=False, memory=False):
+        self.configure(enabled, memory)
+
+    def configure(self, enabled=False, memory=False):
+        self.enabled = enabled
+        self.memory = enabled and memory
+        self.events = []
+        self._lock = threading.Lock()
+        self._origin = timeit.default_timer()
+        self._threads = {}
+        self._memory_spans = []
+        # Whether tracemalloc was started by the tracer, and is stopped by it
+        self._started_tracemalloc = False
+
+    def span(self, name, category='sage', memory=False, **args):
+        """
+        Returns a context manager recording a span, memory captures the
+        tracemalloc peak and top allocations while it is open.
+        """
+        if not self.enabled:
+            return NULL_SPAN
+        return Span(self, name, category, args, memory)
+
+    def start(self, name, category='sage', memory=False, **args):
+        """
+        Opens a span which is closed by calling its finish method, for
+        spans which do not fit a with statement.
+        """
+        if not self.enabled:
+            return NULL_SPAN
+        return Span(self, name, category, args, memory).begin()
+
+    def _add(self, span, end):
+        thread = threading.current_thread()
+        event = {'name': span.name,
+                 'cat': span.category,
+                 'ph': 'X',
+                 'ts': (span.start - self._origin) * 1e6,
+                 'dur': (end - span.start) * 1e6,
+                 'pid': os.getpid(),
+                 'tid': thread.ident,
+                 'args': span.args}
+
+        with self._lock:
+            self._threads[thread.ident] = thread.name
+            self.events.append(event)
+
+    def _memory_begin(self, span):
+        with self._lock:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+                self._started_tracemalloc = True
+            elif self._memory_spans:
+                # Keep the peak of the enclosing span before resetting it
+                outer = self._memory_spans[-1]
+                outer.peak = max(outer.peak, tracemalloc.get_traced_memory()[1])
+            tracemalloc.reset_peak()
+            self._memory_spans.append(span)
+
+    def _memory_end(self, span):
+        with self._lock:
+            span.peak = max(span.peak, tracemalloc.get_traced_memory()[1])
+            snapshot = tracemalloc.take_snapshot()
+
+            if span in self._memory_spans:
+                self._memory_spans.remove(span)
+
+            if self._memory_spans:
+                outer = self._memory_spans[-1]
+                outer.peak = max(outer.peak, span.peak)
+            elif self._started_tracemalloc:
+                tracemalloc.stop()
+                self._started_tracemalloc = False
+
+        span.args['peak_memory'] = span.peak
+        span.args['top_allocations'] = ['%s: %d bytes in %d blocks' % (stat.traceback, stat.size, stat.count)
+                                        for stat in snapshot.statistics('lineno')[:TOP_ALLOCATIONS]]
+
+    def trace(self):
+        """
+        Returns the recorded spans in the Chrome trace event format.
+        """
+        with self._lock:
+            events = list(self.events)
+            threads = dict(self._threads)
+
+        metadata = [{'name': 'thread_name', 'ph': 'M', 'pid': os.getpid(), 'tid': ident,
+                     'args': {'name': name}} for ident, name in sorted(threads.items())]
+
+        return {'traceEvents': metadata + sorted(events, key=lambda x: x['ts']),
+                'displayTimeUnit': 'ms'}
+
+    def write(self, path):
+        directory = os.path.dirname(path)
+        if directory:
+            create_directory_tree(directory)
+
+        with open(path, 'w') as f:
+            json.dump(self.trace(), f, default=str)
+
+
+_TRACER = Tracer()
+
+
+def get_tracer():
+    return _TRACER
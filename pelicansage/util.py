@@ -1,7 +1,7 @@
 
 from collections import namedtuple
 
-from .managefiles import ResultTypes
+from .constants import ResultTypes
 
 NT = namedtuple
 
@@ -13,46 +13,65 @@ CR = CellResult
 def combine_results(results):
         # We want to combine all of the text/plains together.
         combined_result = []
-        
-        if len(results) == 0:
-            return []
-        
-        indx = 0
-        accum = ''
+
+        # Chunks are joined once per combined result, appending to a
+        # string is quadratic for blocks streaming many small chunks.
+        accum = []
         accum_mimetype = ''
         accumulated_mimetypes = ('text/plain', 'text/html')
 
+        def flush():
+            text = ''.join(accum)
+            del accum[:]
+            if text != '':
+                combined_result.append(CR(ResultTypes.Stream, len(combined_result), text, accum_mimetype))
+
+        if len(results) == 0:
+            return []
+
         if results[0].mimetype in accumulated_mimetypes:
             accum_mimetype = results[0].mimetype
 
-        while indx != len(results):
-            current_result = results[indx]
-            cr = current_result
+        for cr in results:
+            if cr.mimetype != accum_mimetype:
+                flush()
+                if cr.mimetype in accumulated_mimetypes:
+                    accum_mimetype = cr.mimetype
 
             if cr.mimetype == accum_mimetype:
-                accum += cr.data
+                accum.append(cr.data)
                 if accum_mimetype == 'text/html':
-                    accum += '<br/>'
-
-                indx += 1
+                    accum.append('<br/>')
                 continue
-            elif accum != '':
-                combined_result.append(CR(ResultTypes.Stream, len(combined_result), accum, accum_mimetype))
-                accum = ''
-
-            if cr.mimetype != accum_mimetype and cr.mimetype in accumulated_mimetypes:
-                accum_mimetype = cr.mimetype
-                accum += cr.data
-                if accum_mimetype == 'text/html':
-                    accum += '<br/>'
-                indx += 1
-                continue
-
 
             combined_result.append(CR(cr.result_type, len(combined_result), cr.data, cr.mimetype))
-            indx += 1
 
-        if accum != '':
-            combined_result.append(CR(ResultTypes.Stream, len(combined_result), accum, accum_mimetype))
+        flush()
 
         return combined_result
+
+
+def truncate_output(text, lines=None, bytes=None, keep='head'):
+    """
+    Returns text cut down to its first (keep='head') or last (keep='tail')
+    lines lines and bytes bytes of UTF-8, together with whether anything
+    was cut.
+    """
+    truncated = False
+
+    if lines is not None:
+        split = text.splitlines(True)
+        if len(split) > lines:
+            split = split[:lines] if keep == 'head' else split[len(split) - lines:]
+            text = ''.join(split)
+            truncated = True
+
+    if bytes is not None:
+        encoded = text.encode('utf-8')
+        if len(encoded) > bytes:
+            encoded = encoded[:bytes] if keep == 'head' else encoded[len(encoded) - bytes:]
+            # Drop a character cut in half
+            text = encoded.decode('utf-8', 'ignore')
+            truncated = True
+
+    return text, truncated
@@ -0,0 +1,172 @@
+"""
+Watch mode, rebuilding the site whenever its content changes.
+
+    python -m pelicansage watch -s pelicanconf.py
+
+A single Pelican instance is kept for the whole session, together with the
+result store, the readers cache and the clients of every evaluated source.
+When files change only their modified blocks are evaluated, in the warm
+namespace of their source, and only the pages of the changed sources and of
+the sources embedding their results are read and written again.  Pages not
+generated from a single source (indexes, archives, tags, ...) are always
+written.
+
+The namespace of a warm client still holds the variables of the previous
+version of its source, like a notebook whose cells are run again.  Stop and
+start the watch for a clean evaluation.
+"""
+
+import fnmatch
+import logging
+import os
+import time
+import timeit
+
+from . import pelicansage as plugin
+
+logger = logging.getLogger(__name__)
+
+# Pelican settings the rebuilds depend on
+WATCH_SETTINGS = {'CACHE_CONTENT': True,
+                  'LOAD_CONTENT_CACHE': True,
+                  'CONTENT_CACHING_LAYER': 'reader',
+                  'DELETE_OUTPUT_DIRECTORY': False}
+
+_SELECTIVE_WRITER = None
+
+
+def selective_writer():
+    """
+    Returns a pelican Writer class only writing the outputs selected for
+    the current build, see pelicansage.is_selected_output.
+    """
+    global _SELECTIVE_WRITER
+
+    if _SELECTIVE_WRITER is None:
+        from pelican.writers import Writer
+
+        class SelectiveWriter(Writer):
+            def write_file(self, name, *args, **kwargs):
+                if not plugin.is_selected_output(name):
+                    return None
+                return Writer.write_file(self, name, *args, **kwargs)
+
+        _SELECTIVE_WRITER = SelectiveWriter
+
+    return _SELECTIVE_WRITER
+
+
+class SiteWatcher(object):
+    """
+    Builds the site described by settings and rebuilds it when the files
+    in its content directory change.
+    """
+
+    def __init__(self, settings):
+        from pelican import Pelican
+
+        settings = dict(settings)
+        for key, value in WATCH_SETTINGS.items():
+            if settings.get(key) != value:
+                logger.info("Watch mode sets %s to %r.", key, value)
+                settings[key] = value
+
+        self.settings = settings
+        self.path = os.path.abspath(settings['PATH'])
+        self._ignored = [os.path.abspath(settings[key]) for key in ('OUTPUT_PATH', 'CACHE_PATH')
+                         if settings.get(key)]
+        self._stamps = {}
+
+        self.pelican = Pelican(settings)
+
+        if plugin._FILE_MANAGER is None:
+            raise ValueError("pelicansage is not in the PLUGINS of the watched site.")
+
+        plugin.start_watch()
+
+    def _ignore(self, path):
+        name = os.path.basename(path)
+        return (name.startswith('.') or
+                any(fnmatch.fnmatch(name, pattern) for pattern in self.settings.get('IGNORE_FILES', ())))
+
+    def scan(self):
+        """
+        Returns the files modified or added, and the files removed since
+        the previous scan.
+        """
+        stamps = {}
+
+        for root, dirs, files in os.walk(self.path):
+            dirs[:] = [d for d in dirs
+                       if not self._ignore(d) and os.path.abspath(os.path.join(root, d)) not in self._ignored]
+
+            for name in files:
+                path = os.path.join(root, name)
+                if self._ignore(path):
+                    continue
+                try:
+                    stamps[path] = os.stat(path).st_mtime_ns
+                except OSError:
+                    # Removed while scanning
+                    continue
+
+        changed = set(path for path, stamp in stamps.items() if self._stamps.get(path) != stamp)
+        removed = set(self._stamps) - set(stamps)
+
+        self._stamps = stamps
+
+        return changed, removed
+
+    def build(self):
+        """
+        Builds the whole site.
+        """
+        self.scan()
+        self._run()
+
+    def rebuild(self):
+        """
+        Builds the changes since the previous build, returns the sources
+        read again or None if nothing changed.
+        """
+        changed, removed = self.scan()
+        if not changed and not removed:
+            return None
+
+        selected = plugin.prepare_rebuild(changed, removed)
+        logger.info("Rebuilding %d changed sources, %d in total.", len(changed) + len(removed), len(selected))
+
+        self._run()
+
+        return selected
+
+    def _run(self):
+        start = timeit.default_timer()
+        try:
+            self.pelican.run()
+        except Exception:
+            logger.exception("Build failed.")
+        logger.info("Built in %.2f seconds.", timeit.default_timer() - start)
+
+    def close(self):
+        plugin.stop_watch()
+
+
+def watch(settings, interval=0.5):
+    """
+    Builds the site and rebuilds it whenever its content changes, until
+    interrupted.
+    """
+    watcher = SiteWatcher(settings)
+
+    try:
+        watcher.build()
+        logger.info("Watching %s for changes, press Ctrl-C to stop.", watcher.path)
+
+        while True:
+            time.sleep(interval)
+            watcher.rebuild()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        watcher.close()
@@ -0,0 +1,407 @@
+"""
+Work queue distributing the evaluation of sources over worker processes.
+
+Instead of evaluating sources in its own threads, a build publishes one
+work unit per source (its blocks, languages and platforms) to a queue kept
+in a SQLite file or a directory.  ``python -m pelicansage worker``
+processes, on the same machine or on others sharing the filesystem, claim
+units, evaluate them with their own clients and post the results of every
+block back, which the build collects as they arrive.
+
+A claimed unit is leased to its worker, which renews the lease while it
+evaluates.  If the worker dies the lease expires and another worker claims
+the unit again.  Prefer the directory backend on network filesystems,
+SQLite locking is unreliable on most of them.
+"""
+
+import base64
+import json
+import logging
+import os
+import socket
+import sqlite3
+import threading
+import time
+from uuid import uuid4
+
+from .constants import ResultTypes
+from .evaluation import BlockTask, CellWorker
+from .pelicansageio import create_directory_tree
+from .util import CellResult, SageError
+
+logger = logging.getLogger(__name__)
+
+# Seconds a claim is valid without being renewed
+DEFAULT_LEASE = 60.0
+
+
+def worker_name():
+    return '%s-%d-%s' % (socket.gethostname(), os.getpid(), uuid4().hex[:8])
+
+
+def encode_tasks(tasks):
+    return json.dumps([task._asdict() for task in tasks])
+
+
+def decode_tasks(payload):
+    return [BlockTask(**task) for task in json.loads(payload)]
+
+
+def encode_item(item):
+    """
+    Encodes an item put on the queue by a CellWorker, either None once the
+    source is finished or (code id, results, stats).
+    """
+    if item is None:
+        return json.dumps(None)
+
+    code_id, results, stats = item
+
+    encoded = []
+    for result in results:
+        data = result.data
+        encoding = None
+        if result.result_type == ResultTypes.Error:
+            data = data._asdict()
+        elif isinstance(data, bytes):
+            data = base64.b64encode(data).decode('ascii')
+            encoding = 'base64'
+        encoded.append({'result_type': result.result_type, 'order': result.order,
+                        'mimetype': result.mimetype, 'data': data, 'encoding': encoding})
+
+    return json.dumps({'code_id': code_id, 'results': encoded, 'stats': stats})
+
+
+def decode_item(payload):
+    item = json.loads(payload)
+
+    if item is None:
+        return None
+
+    results = []
+    for result in item['results']:
+        data = result['data']
+        if result['result_type'] == ResultTypes.Error:
+            data = SageError(**data)
+        elif result.get('encoding') == 'base64':
+            data = base64.b64decode(data)
+        results.append(CellResult(result['result_type'], result['order'], data, result['mimetype']))
+
+    return item['code_id'], results, item['stats']
+
+
+class SQLiteWorkQueue(object):
+    """
+    Work queue kept in a single SQLite database file.
+    """
+
+    def __init__(self, path, lease=DEFAULT_LEASE):
+        self.path = path
+        self.lease = lease
+        self._collected = 0
+
+        directory = os.path.dirname(os.path.abspath(path))
+        create_directory_tree(directory)
+
+        with self._connect() as connection:
+            connection.execute('CREATE TABLE IF NOT EXISTS units ('
+                               'id TEXT PRIMARY KEY, src TEXT, payload TEXT, state TEXT, '
+                               'owner TEXT, expires REAL, created REAL)')
+            connection.execute('CREATE TABLE IF NOT EXISTS results ('
+                               'id INTEGER PRIMARY KEY AUTOINCREMENT, unit_id TEXT, src TEXT, payload TEXT)')
+            connection.execute('CREATE INDEX IF NOT EXISTS units_state ON units (state, created)')
+            connection.execute('CREATE INDEX IF NOT EXISTS results_unit ON results (unit_id, id)')
+
+    def _connect(self):
+        connection = sqlite3.connect(self.path, timeout=60, isolation_level=None)
+        connection.execute('PRAGMA busy_timeout = 60000')
+        return _Transaction(connection)
+
+    def publish(self, src, tasks):
+        unit_id = uuid4().hex
+        with self._connect() as connection:
+            connection.execute('INSERT INTO units VALUES (?, ?, ?, ?, NULL, NULL, ?)',
+                               (unit_id, src, encode_tasks(tasks), 'pending', time.time()))
+        return unit_id
+
+    def claim(self, owner):
+        now = time.time()
+        with self._connect() as connection:
+            row = connection.execute("SELECT id, src, payload FROM units "
+                                     "WHERE state = 'pending' OR (state = 'claimed' AND expires < ?) "
+                                     "ORDER BY created LIMIT 1", (now,)).fetchone()
+            if row is None:
+                return None
+
+            connection.execute("UPDATE units SET state = 'claimed', owner = ?, expires = ? WHERE id = ?",
+                               (owner, now + self.lease, row[0]))
+
+        return row[0], row[1], decode_tasks(row[2])
+
+    def renew(self, unit_id, owner):
+        with self._connect() as connection:
+            connection.execute("UPDATE units SET expires = ? WHERE id = ? AND owner = ? AND state = 'claimed'",
+                               (time.time() + self.lease, unit_id, owner))
+
+    def post(self, unit_id, src, item):
+        with self._connect() as connection:
+            connection.execute('INSERT INTO results (unit_id, src, payload) VALUES (?, ?, ?)',
+                               (unit_id, src, encode_item(item)))
+            if item is None:
+                connection.execute("UPDATE units SET state = 'done' WHERE id = ?", (unit_id,))
+
+    def collect(self, unit_ids):
+        """
+        Returns the (src, item) posted for the units unit_ids since the
+        previous call.
+        """
+        if not unit_ids:
+            return []
+
+        unit_ids = list(unit_ids)
+        with self._connect() as connection:
+            rows = connection.execute('SELECT id, src, payload FROM results WHERE id > ? AND unit_id IN (%s) '
+                                      'ORDER BY id' % (', '.join('?' * len(unit_ids)),),
+                                      [self._collected] + unit_ids).fetchall()
+
+        if rows:
+            self._collected = rows[-1][0]
+
+        return [(src, decode_item(payload)) for _, src, payload in rows]
+
+    def remove(self, unit_id):
+        with self._connect() as connection:
+            connection.execute('DELETE FROM results WHERE unit_id = ?', (unit_id,))
+            connection.execute('DELETE FROM units WHERE id = ?', (unit_id,))
+
+
+class _Transaction(object):
+    """
+    Runs the statements of a with block in an immediate transaction, so
+    concurrent claims are serialized, and closes the connection.
+    """
+
+    def __init__(self, connection):
+        self.connection = connection
+
+    def __enter__(self):
+        self.connection.execute('BEGIN IMMEDIATE')
+        return self.connection
+
+    def __exit__(self, exc_type, *exc):
+        try:
+            self.connection.execute('COMMIT' if exc_type is None else 'ROLLBACK')
+        finally:
+            self.connection.close()
+        return False
+
+
+class DirectoryWorkQueue(object):
+    """
+    Work queue kept as files in a directory, claims are atomic renames.
+
+        pending/<unit>.json          published units
+        claimed/<unit>.json          claimed units, the lease is the mtime
+        results/<unit>/<seq>.json    results posted for a unit
+    """
+
+    def __init__(self, path, lease=DEFAULT_LEASE):
+        self.path = path
+        self.lease = lease
+        self._collected = {}
+
+        for name in ('pending', 'claimed', 'results'):
+            create_directory_tree(os.path.join(path, name))
+
+    def _write(self, path, data):
+        # Readers never see a partially written file
+        tmp = '%s.%s.tmp' % (path, uuid4().hex)
+        with open(tmp, 'w') as f:
+            f.write(data)
+        os.rename(tmp, path)
+
+    def publish(self, src, tasks):
+        unit_id = '%.6f-%s' % (time.time(), uuid4().hex)
+        create_directory_tree(os.path.join(self.path, 'results', unit_id))
+        self._write(os.path.join(self.path, 'pending', unit_id + '.json'),
+                    json.dumps({'src': src, 'tasks': encode_tasks(tasks)}))
+        return unit_id
+
+    def _expire_claims(self):
+        now = time.time()
+        claimed = os.path.join(self.path, 'claimed')
+
+        for name in os.listdir(claimed):
+            if not name.endswith('.json'):
+                continue
+            path = os.path.join(claimed, name)
+            try:
+                if os.path.getmtime(path) + self.lease < now:
+                    os.rename(path, os.path.join(self.path, 'pending', name))
+                    logger.warning("Lease of work unit %s expired, requeued.", name[:-5])
+            except OSError:
+                # Renewed, finished or requeued by someone else
+                continue
+
+    def claim(self, owner):
+        self._expire_claims()
+
+        pending = os.path.join(self.path, 'pending')
+
+        for name in sorted(os.listdir(pending)):
+            if not name.endswith('.json'):
+                continue
+
+            claimed = os.path.join(self.path, 'claimed', name)
+            try:
+                os.rename(os.path.join(pending, name), claimed)
+            except OSError:
+                # Claimed by another worker
+                continue
+
+            os.utime(claimed, None)
+
+            with open(claimed) as f:
+                unit = json.load(f)
+
+            return name[:-5], unit['src'], decode_tasks(unit['tasks'])
+
+        return None
+
+    def renew(self, unit_id, owner):
+        try:
+            os.utime(os.path.join(self.path, 'claimed', unit_id + '.json'), None)
+        except OSError:
+            pass
+
+    def post(self, unit_id, src, item):
+        directory = os.path.join(self.path, 'results', unit_id)
+        create_directory_tree(directory)
+        name = '%.6f-%s.json' % (time.time(), uuid4().hex)
+        self._write(os.path.join(directory, name), json.dumps({'src': src, 'item': encode_item(item)}))
+
+        if item is None:
+            try:
+                os.remove(os.path.join(self.path, 'claimed', unit_id + '.json'))
+            except OSError:
+                pass
+
+    def collect(self, unit_ids):
+        collected = []
+
+        for unit_id in unit_ids:
+            directory = os.path.join(self.path, 'results', unit_id)
+            seen = self._collected.setdefault(unit_id, set())
+
+            try:
+                names = sorted(name for name in os.listdir(directory) if name.endswith('.json'))
+            except OSError:
+                continue
+
+            for name in names:
+                if name in seen:
+                    continue
+                seen.add(name)
+                with open(os.path.join(directory, name)) as f:
+                    result = json.load(f)
+                collected.append((result['src'], decode_item(result['item'])))
+
+        return collected
+
+    def remove(self, unit_id):
+        import shutil
+
+        for name in ('pending', 'claimed'):
+            try:
+                os.remove(os.path.join(self.path, name, unit_id + '.json'))
+            except OSError:
+                pass
+        shutil.rmtree(os.path.join(self.path, 'results', unit_id), ignore_errors=True)
+        self._collected.pop(unit_id, None)
+
+
+BACKENDS = {'sqlite': SQLiteWorkQueue,
+            'directory': DirectoryWorkQueue}
+
+
+def open_work_queue(config):
+    """
+    Opens the work queue described by the WORK_QUEUE setting, a path or a
+    dictionary with a path and optionally the backend ('sqlite' or
+    'directory', derived from the path by default) and lease in seconds.
+    """
+    if not isinstance(config, dict):
+        config = {'path': config}
+
+    path = config['path']
+    backend = config.get('backend') or ('sqlite' if path.endswith(('.db', '.sqlite')) else 'directory')
+
+    return BACKENDS[backend](path, lease=float(config.get('lease', DEFAULT_LEASE)))
+
+
+class _Forward(object):
+    """
+    Queue handed to a CellWorker, posting its items to the work queue.
+    """
+
+    def __init__(self, work_queue, unit_id):
+        self.work_queue = work_queue
+        self.unit_id = unit_id
+
+    def put(self, item):
+        src, result = item
+        self.work_queue.post(self.unit_id, src, result)
+
+
+def run_worker(work_queue, create_clients, owner=None, retries=1, backoff=1.0, checkpoints=None,
+               poll=1.0, idle_timeout=None, stop=None, timeout=None, on_timeout='continue'):
+    """
+    Claims and evaluates units until idle for idle_timeout seconds (forever
+    if None) or until the stop event is set.  Returns the number of units
+    evaluated.  timeout and on_timeout apply to the blocks of the units as
+    in evaluate.
+    """
+    owner = owner or worker_name()
+    stop = stop or threading.Event()
+    evaluated = 0
+    idle_since = time.time()
+
+    logger.info("Worker %s waiting for work.", owner)
+
+    while not stop.is_set():
+        unit = work_queue.claim(owner)
+
+        if unit is None:
+            if idle_timeout is not None and time.time() - idle_since > idle_timeout:
+                break
+            stop.wait(poll)
+            continue
+
+        unit_id, src, tasks = unit
+        logger.info("Worker %s evaluating %s (%d blocks).", owner, src, len(tasks))
+
+        # Keep the lease while the unit is evaluated
+        done = threading.Event()
+
+        def heartbeat():
+            while not done.wait(work_queue.lease / 3.0):
+                work_queue.renew(unit_id, owner)
+
+        renewer = threading.Thread(target=heartbeat)
+        renewer.daemon = True
+        renewer.start()
+
+        try:
+            worker = CellWorker(_Forward(work_queue, unit_id), tasks, create_clients(),
+                                retries=retries, backoff=backoff, checkpoints=checkpoints,
+                                timeout=timeout, on_timeout=on_timeout)
+            # The worker thread puts (src, None) on the queue when it is done
+            worker.run()
+        finally:
+            done.set()
+            renewer.join()
+
+        evaluated += 1
+        idle_since = time.time()
+
+    return evaluated
@@ -0,0 +1,94 @@
+"""
+Benchmarks the evaluation path (CellWorker, clients and result storage)
+against the local fake kernel server.
+
+    python test/bench_evaluation.py --sources 1,10,100,1000 --blocks 5
+
+For every number of sources, all sources are evaluated concurrently and the
+blocks/sec, p50/p99 block latency and the peak python memory are reported.
+"""
+
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from pelicansage.evaluation import evaluate
+from pelicansage.managefiles import FileManager
+from pelicansage.sagecell import SageCell, IPythonNotebookClient
+
+from benchutil import measure, percentile, print_table, write_json
+from fakekernel import FakeKernelServer
+
+CLIENTS = {'sage': SageCell, 'ipython': IPythonNotebookClient}
+
+
+def populate(manager, sources, blocks, platform):
+    for src in range(sources):
+        for order in range(blocks):
+            manager.create_code('x = %d\nprint(x)' % (order,), 'bench/%05d.rst' % (src,), order,
+                                language='python', platform=platform)
+    manager.commit()
+
+
+def run(server, sources, blocks, platform, memory=True):
+    base_path = tempfile.mkdtemp(prefix='pelicansage-bench-')
+    try:
+        manager = FileManager(base_path=base_path)
+        populate(manager, sources, blocks, platform)
+
+        client = CLIENTS[platform]
+
+        with measure(memory) as measurement:
+            evaluate(manager, lambda: {platform: client(server.url, timeout=60)}, max_workers=sources)
+
+        latencies = [stat.setup_time + stat.exec_time for stat in manager.get_stats()]
+    finally:
+        shutil.rmtree(base_path, ignore_errors=True)
+
+    evaluated = len(latencies)
+
+    return {'sources': sources,
+            'blocks': evaluated,
+            'elapsed': measurement.elapsed,
+            'blocks_per_second': evaluated / measurement.elapsed if measurement.elapsed else 0.0,
+            'p50': percentile(latencies, 50),
+            'p99': percentile(latencies, 99),
+            'peak_memory': measurement.peak_memory}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--sources', default='1,10,100,1000',
+                        help='comma separated numbers of concurrent sources')
+    parser.add_argument('--blocks', type=int, default=5, help='blocks per source')
+    parser.add_argument('--platform', choices=sorted(CLIENTS), default='sage')
+    parser.add_argument('--latency', type=float, default=0.005, help='kernel seconds per block')
+    parser.add_argument('--output-size', type=int, default=1024, help='characters of output per block')
+    parser.add_argument('--stream-chunks', type=int, default=4)
+    parser.add_argument('--images', type=int, default=0, help='images per block')
+    parser.add_argument('--no-memory', action='store_true', help='do not trace memory allocations')
+    parser.add_argument('--json', help='write the results to this file')
+    args = parser.parse_args()
+
+    rows = []
+    with FakeKernelServer(latency=args.latency, output_size=args.output_size,
+                          stream_chunks=args.stream_chunks, images=args.images) as server:
+        for sources in [int(x) for x in args.sources.split(',')]:
+            rows.append(run(server, sources, args.blocks, args.platform, not args.no_memory))
+
+    print_table(('sources', 'blocks', 'elapsed s', 'blocks/s', 'p50 ms', 'p99 ms', 'peak MiB'),
+                [(r['sources'], r['blocks'], '%.3f' % r['elapsed'], '%.1f' % r['blocks_per_second'],
+                  '%.1f' % (r['p50'] * 1000), '%.1f' % (r['p99'] * 1000),
+                  '%.1f' % (r['peak_memory'] / 2.0 ** 20)) for r in rows])
+
+    if args.json:
+        write_json(args.json, rows)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,154 @@
+"""
+Scale benchmark and regression harness for FileManager.
+
+Generates synthetic sources, code blocks and results and times ingestion,
+lookup, invalidation and the rendering-time reads against an in-memory and
+an on-disk database.
+
+    python test/bench_filemanager.py --sources 1000 --blocks 50 --save-baseline
+    python test/bench_filemanager.py --sources 1000 --blocks 50
+
+The second run fails with a non-zero exit status when any timing is slower
+than the stored baseline by more than --threshold.  Baselines are machine
+specific and are kept in test/baselines/ (not under version control).
+"""
+
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from pelicansage.managefiles import FileManager
+
+from benchutil import measure, print_table, check_baseline, RegressionError
+
+BASELINE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baselines')
+
+
+def source_name(src):
+    return 'content/bench/%05d.rst' % (src,)
+
+
+def ingest(manager, sources, blocks, results):
+    for src in range(sources):
+        for order in range(blocks):
+            code_obj = manager.create_code('x_%d = %d\nprint(x_%d)' % (order, order, order),
+                                           source_name(src), order,
+                                           user_id='blk%d' % (order,),
+                                           language='python', platform='sage')
+            for result in range(results):
+                if result % 5 == 4:
+                    manager.create_error(code_obj.id, 'NameError', 'name y is not defined',
+                                         'Traceback\nNameError: name y is not defined', result)
+                else:
+                    manager.create_result(code_obj.id, 'output %d\n' % (result,) * 10, result)
+            manager.timestamp_code(code_obj.id)
+        manager.commit()
+
+
+def lookup(manager, sources, blocks, code_ids):
+    for code_id in code_ids:
+        manager.get_code(code_id=code_id)
+    for src in range(sources):
+        for order in range(0, blocks, max(1, blocks // 5)):
+            manager.get_code(src=source_name(src), user_id='blk%d' % (order,))
+
+
+def render_reads(manager, code_ids):
+    total = 0
+    for code_id in code_ids:
+        code_obj = manager.get_code(code_id=code_id)
+        for result in code_obj.results:
+            total += len(result.data if isinstance(result.data, str) else result.data.traceback)
+    return total
+
+
+def invalidate(manager, sources, blocks, fraction):
+    step = max(1, int(round(1.0 / fraction))) if fraction > 0 else sources + 1
+    for src in range(0, sources, step):
+        order = blocks // 2
+        manager.create_code('changed = %d' % (order,), source_name(src), order,
+                            user_id='blk%d' % (order,), language='python', platform='sage')
+
+
+def run(backend, args):
+    location = None
+    directory = None
+
+    if backend == 'disk':
+        directory = tempfile.mkdtemp(prefix='pelicansage-bench-')
+        location = directory
+
+    try:
+        manager = FileManager(location=location)
+
+        timings = {}
+
+        with measure(False) as m:
+            ingest(manager, args.sources, args.blocks, args.results)
+        timings['ingest'] = m.elapsed
+
+        code_ids = [blk.id for blk in manager.get_all_codeblocks()]
+
+        with measure(False) as m:
+            lookup(manager, args.sources, args.blocks, code_ids)
+        timings['lookup'] = m.elapsed
+
+        manager._session.expire_all()
+        with measure(False) as m:
+            render_reads(manager, code_ids)
+        timings['render'] = m.elapsed
+
+        with measure(False) as m:
+            invalidate(manager, args.sources, args.blocks, args.invalidate)
+        timings['invalidate'] = m.elapsed
+    finally:
+        if directory is not None:
+            shutil.rmtree(directory, ignore_errors=True)
+
+    return timings
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--sources', type=int, default=100)
+    parser.add_argument('--blocks', type=int, default=20, help='blocks per source')
+    parser.add_argument('--results', type=int, default=3, help='results per block')
+    parser.add_argument('--invalidate', type=float, default=0.1,
+                        help='fraction of sources whose middle block is edited')
+    parser.add_argument('--backends', default='memory,disk')
+    parser.add_argument('--threshold', type=float, default=0.25,
+                        help='allowed slowdown against the baseline, as a fraction')
+    parser.add_argument('--baseline', help='baseline file (default: derived from the scale)')
+    parser.add_argument('--save-baseline', action='store_true')
+    args = parser.parse_args()
+
+    results = {}
+    rows = []
+    for backend in args.backends.split(','):
+        timings = run(backend, args)
+        for name, elapsed in timings.items():
+            results['%s:%s' % (backend, name)] = elapsed
+        rows.append((backend,) + tuple('%.3f' % timings[x] for x in ('ingest', 'lookup', 'render', 'invalidate')))
+
+    print('%d sources x %d blocks x %d results' % (args.sources, args.blocks, args.results))
+    print_table(('backend', 'ingest s', 'lookup s', 'render s', 'invalidate s'), rows)
+
+    baseline = args.baseline or os.path.join(BASELINE_DIR, 'filemanager_%d_%d_%d.json' %
+                                             (args.sources, args.blocks, args.results))
+    if args.save_baseline and not os.path.isdir(os.path.dirname(baseline)):
+        os.makedirs(os.path.dirname(baseline))
+
+    try:
+        check_baseline(results, baseline, args.threshold, args.save_baseline)
+    except RegressionError as e:
+        print(e)
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
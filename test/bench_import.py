@@ -0,0 +1,123 @@
+"""
+Import time benchmark for the plugin.
+
+Imports pelicansage in fresh interpreters with ``python -X importtime``
+after pelican itself is imported, as it is when pelican loads the plugin,
+and reports the time the plugin adds together with its slowest imports.
+
+    python test/bench_import.py --save-baseline
+    python test/bench_import.py
+
+The second run fails with a non-zero exit status when importing the plugin
+is slower than the stored baseline by more than --threshold, or when any of
+the heavy dependencies is imported eagerly again.
+"""
+
+import argparse
+import os
+import subprocess
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from benchutil import percentile, print_table, check_baseline, RegressionError, HEAVY_MODULES
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+BASELINE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baselines')
+
+SCRIPT = 'import pelican; import pelicansage'
+
+
+def parse_importtime(stderr):
+    """
+    Returns a list of (module, self us, cumulative us, depth) of the
+    output of -X importtime.
+    """
+    imports = []
+
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+
+        self_us, cumulative_us, name = line[len('import time:'):].split('|')
+        depth = (len(name) - len(name.lstrip(' '))) // 2
+
+        imports.append((name.strip(), int(self_us), int(cumulative_us), depth))
+
+    return imports
+
+
+def import_plugin():
+    """
+    Imports the plugin in a fresh interpreter and returns the parsed import
+    times of every module imported after pelican.
+    """
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join([ROOT, os.environ.get('PYTHONPATH', '')]))
+    env.pop('PYTHONDONTWRITEBYTECODE', None)
+
+    proc = subprocess.run([sys.executable, '-X', 'importtime', '-c', SCRIPT],
+                          env=env, cwd=ROOT, stderr=subprocess.PIPE, universal_newlines=True)
+
+    if proc.returncode != 0:
+        raise RuntimeError('Could not import the plugin:\n%s' % (proc.stderr,))
+
+    imports = parse_importtime(proc.stderr)
+
+    # Everything up to and including the top level pelican import
+    for indx, (name, _, _, depth) in enumerate(imports):
+        if name == 'pelican' and depth == 0:
+            return imports[indx + 1:]
+
+    return imports
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--runs', type=int, default=10)
+    parser.add_argument('--top', type=int, default=10, help='number of slowest imports to list')
+    parser.add_argument('--threshold', type=float, default=0.5,
+                        help='allowed slowdown against the baseline, as a fraction')
+    parser.add_argument('--baseline', help='baseline file')
+    parser.add_argument('--save-baseline', action='store_true')
+    args = parser.parse_args()
+
+    # Populate the bytecode caches first
+    import_plugin()
+
+    totals = []
+    slowest = {}
+
+    for _ in range(args.runs):
+        imports = import_plugin()
+        totals.append(sum(cumulative for name, _, cumulative, depth in imports if depth == 0) / 1e6)
+
+        for name, self_us, _, _ in imports:
+            slowest.setdefault(name, []).append(self_us / 1e6)
+
+    rows = sorted(((name, percentile(times, 50)) for name, times in slowest.items()),
+                  key=lambda x: -x[1])[:args.top]
+
+    print_table(('module', 'self s'), [(name, '%.4f' % (elapsed,)) for name, elapsed in rows])
+    print()
+    print('plugin import: p50 %.4fs, p99 %.4fs over %d runs' %
+          (percentile(totals, 50), percentile(totals, 99), args.runs))
+
+    eager = sorted(set(name.split('.')[0] for name in slowest) & set(HEAVY_MODULES))
+    if eager:
+        print('Heavy modules imported eagerly: %s' % (', '.join(eager),))
+        sys.exit(1)
+
+    baseline = args.baseline or os.path.join(BASELINE_DIR, 'import.json')
+    if args.save_baseline and not os.path.isdir(os.path.dirname(baseline)):
+        os.makedirs(os.path.dirname(baseline))
+
+    try:
+        check_baseline({'import': percentile(totals, 50)}, baseline, args.threshold, args.save_baseline)
+    except RegressionError as e:
+        print(e)
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
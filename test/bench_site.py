@@ -0,0 +1,170 @@
+"""
+End-to-end synthetic site build benchmark.
+
+Generates a synthetic content tree (see sitegen.py), starts the fake kernel
+server and builds the site three times, each in a fresh process:
+
+* cold: empty output directory and result database
+* warm: nothing changed since the cold build
+* incremental: one article had a block edited
+
+For every build the time spent in the first pass (pre_read without the
+evaluation nested in it), evaluation, the article pass and slide generation
+is reported.  The columns do not overlap, total also holds the rest of the
+build.
+
+    python test/bench_site.py --articles 100 --notebooks 10 --slides 10
+
+With --trace DIR a Chrome trace of every build is written to DIR.
+"""
+
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import timeit
+
+TEST_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT_DIR = os.path.dirname(TEST_DIR)
+
+sys.path.insert(0, TEST_DIR)
+sys.path.insert(0, ROOT_DIR)
+
+from benchutil import print_table, write_json
+from fakekernel import FakeKernelServer
+import sitegen
+
+PHASES = ('pre_read', 'evaluation', 'articles', 'slides', 'total')
+
+
+def build(site, trace=None):
+    """
+    Builds the site in this process and returns the phase timings.
+    """
+    from pelican import Pelican, signals
+    from pelican.settings import read_settings
+
+    import pelicansage.evaluation as evaluation
+    import pelicansage.pelicansage as plugin
+    from pelicansage.slides import SlidesGenerator
+
+    timings = dict((phase, 0.0) for phase in PHASES)
+    marks = {}
+
+    def timed(phase, func):
+        def wrapper(*args, **kwargs):
+            start = timeit.default_timer()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                timings[phase] += timeit.default_timer() - start
+        return wrapper
+
+    pre_read = plugin.pre_read
+
+    def first_pass(generator):
+        # pre_read is sent again before every file of the second pass, only
+        # the first call runs the first pass
+        if plugin._PREPROCESSING_DONE:
+            return pre_read(generator)
+
+        start = timeit.default_timer()
+        try:
+            return pre_read(generator)
+        finally:
+            marks['pre_read'] = timeit.default_timer()
+            timings['pre_read'] += marks['pre_read'] - start
+
+    # The plugin looks these up when they are called, so they have to be
+    # wrapped before pelican registers the plugin.
+    plugin.pre_read = first_pass
+    evaluation.evaluate = timed('evaluation', evaluation.evaluate)
+    SlidesGenerator.generate_output = timed('slides', SlidesGenerator.generate_output)
+
+    def articles_done(generator):
+        timings['articles'] = timeit.default_timer() - marks['pre_read']
+
+    signals.article_generator_finalized.connect(articles_done)
+
+    os.chdir(site)
+    settings = read_settings(os.path.join(site, 'pelicanconf.py'))
+    if trace:
+        settings['SAGE'] = dict(settings['SAGE'], TRACE_PATH=trace, TRACE_MEMORY=True)
+
+    start = timeit.default_timer()
+    Pelican(settings).run()
+    timings['total'] = timeit.default_timer() - start
+
+    # Evaluation runs within the first pass
+    timings['pre_read'] -= timings['evaluation']
+
+    return timings
+
+
+def run_build(site, verbose=False, trace=None):
+    command = [sys.executable, os.path.abspath(__file__), '--build', site]
+    if trace:
+        command.extend(['--trace', trace])
+    output = subprocess.check_output(command,
+                                     cwd=site, env=dict(os.environ, PYTHONPATH=ROOT_DIR),
+                                     stderr=None if verbose else subprocess.DEVNULL)
+    return json.loads(output.decode('utf-8').strip().split('\n')[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--articles', type=int, default=20)
+    parser.add_argument('--notebooks', type=int, default=4)
+    parser.add_argument('--slides', type=int, default=4)
+    parser.add_argument('--blocks', type=int, default=5, help='blocks per article')
+    parser.add_argument('--cells', type=int, default=5, help='cells per notebook')
+    parser.add_argument('--latency', type=float, default=0.005, help='kernel seconds per block')
+    parser.add_argument('--images', type=int, default=1, help='images per block')
+    parser.add_argument('--max-workers', type=int, default=8)
+    parser.add_argument('--keep', action='store_true', help='keep the generated site')
+    parser.add_argument('--verbose', action='store_true', help='show the output of the builds')
+    parser.add_argument('--json', help='write the results to this file')
+    parser.add_argument('--trace', help='write a Chrome trace of each build to this directory')
+    parser.add_argument('--build', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.build:
+        print(json.dumps(build(args.build, args.trace)))
+        return
+
+    site = tempfile.mkdtemp(prefix='pelicansage-site-')
+    rows = []
+
+    try:
+        with FakeKernelServer(latency=args.latency, images=args.images) as server:
+            sitegen.generate(site, args.articles, args.notebooks, args.slides, args.blocks, args.cells,
+                             cell_url=server.url, ipython_url=server.url, max_workers=args.max_workers)
+
+            def trace(name):
+                return os.path.abspath(os.path.join(args.trace, name + '.json')) if args.trace else None
+
+            rows.append(('cold', run_build(site, args.verbose, trace('cold'))))
+            rows.append(('warm', run_build(site, args.verbose, trace('warm'))))
+
+            sitegen.edit_article(site, args.articles // 2, args.blocks, args.notebooks)
+            rows.append(('incremental', run_build(site, args.verbose, trace('incremental'))))
+    finally:
+        if args.keep:
+            print('Site kept in %s' % (site,))
+        else:
+            shutil.rmtree(site, ignore_errors=True)
+
+    print('%d articles x %d blocks, %d notebooks, %d slides' %
+          (args.articles, args.blocks, args.notebooks, args.slides))
+    print_table(('build',) + tuple(phase + ' s' for phase in PHASES),
+                [(name,) + tuple('%.3f' % timings[phase] for phase in PHASES) for name, timings in rows])
+
+    if args.json:
+        write_json(args.json, dict(rows))
+
+
+if __name__ == '__main__':
+    main()
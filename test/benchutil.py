@@ -0,0 +1,122 @@
+"""
+Helpers shared by the bench_*.py benchmark scripts.
+"""
+
+import json
+import timeit
+import tracemalloc
+from contextlib import contextmanager
+
+# Dependencies which are only needed by some builds and must not be
+# imported together with the plugin, see test_imports.py and bench_import.py
+HEAVY_MODULES = ('nbconvert', 'nbformat', 'traitlets', 'hovercraft', 'sqlalchemy',
+                 'websocket', 'requests', 'ansi2html', 'jupyter_client')
+
+
+def percentile(values, pct):
+    """
+    Nearest rank percentile of values, pct in [0, 100].
+    """
+    if not values:
+        return 0.0
+
+    ordered = sorted(values)
+    rank = int(round(pct / 100.0 * (len(ordered) - 1)))
+    return ordered[rank]
+
+
+class Measurement(object):
+    def __init__(self):
+        self.elapsed = 0.0
+        self.peak_memory = 0
+
+
+@contextmanager
+def measure(memory=True):
+    """
+    Measures the wall time and (optionally) the peak of python memory
+    allocations of the enclosed block.
+    """
+    measurement = Measurement()
+
+    if memory:
+        tracemalloc.start()
+
+    start = timeit.default_timer()
+    try:
+        yield measurement
+    finally:
+        measurement.elapsed = timeit.default_timer() - start
+        if memory:
+            measurement.peak_memory = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+
+
+def print_table(columns, rows):
+    widths = [max([len(name)] + [len(str(row[i])) for row in rows]) for i, name in enumerate(columns)]
+    line = '  '.join('%%%ds' % (width,) for width in widths)
+
+    print(line % tuple(columns))
+    for row in rows:
+        print(line % tuple(str(x) for x in row))
+
+
+def write_json(path, data):
+    with open(path, 'w') as f:
+        json.dump(data, f, indent=2, sort_keys=True)
+
+
+def load_baseline(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (IOError, OSError, ValueError):
+        return None
+
+
+def compare_to_baseline(results, baseline, threshold):
+    """
+    Returns a list of (name, baseline, current) for every timing in results
+    that is slower than its baseline by more than the threshold fraction.
+    """
+    regressions = []
+
+    for name, current in sorted(results.items()):
+        previous = baseline.get(name)
+        if previous is None or previous <= 0:
+            continue
+        if current > previous * (1.0 + threshold):
+            regressions.append((name, previous, current))
+
+    return regressions
+
+
+class RegressionError(Exception):
+    pass
+
+
+def check_baseline(results, path, threshold=0.25, save=False):
+    """
+    Stores results as the new baseline when save is set, otherwise compares
+    them to the stored baseline and raises RegressionError listing every
+    timing that regressed beyond the threshold.
+    """
+    if save:
+        write_json(path, results)
+        print('Baseline written to %s' % (path,))
+        return
+
+    baseline = load_baseline(path)
+    if baseline is None:
+        print('No baseline at %s, run with --save-baseline to create one.' % (path,))
+        return
+
+    regressions = compare_to_baseline(results, baseline, threshold)
+
+    if regressions:
+        raise RegressionError('\n'.join(['Performance regressions beyond %d%%:' % (threshold * 100,)] +
+                                        ['  %s: %.4fs -> %.4fs (%+.0f%%)' %
+                                         (name, old, new, (new / old - 1.0) * 100)
+                                         for name, old, new in regressions]))
+
+    print('No regressions against %s' % (path,))
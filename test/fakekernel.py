@@ -0,0 +1,460 @@
+"""
+A local stand-in for the kernel servers used by pelicansage.sagecell.
+
+It implements the SageCell ``kernel`` endpoint, the (legacy) IPython
+notebook login / notebook / session endpoints and the Jupyter Server
+session endpoints together with the websocket ``channels`` of a kernel,
+optionally speaking the binary v1.kernel.websocket.jupyter.org
+subprotocol.  Every execute_request is answered with
+configurable latency, amount of stream output and number of images so the
+evaluation path can be exercised and benchmarked without a live server.
+
+    with FakeKernelServer(latency=0.01, output_size=1024, images=1) as server:
+        cell = SageCell(server.url)
+"""
+
+import base64
+import hashlib
+import json
+import struct
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from uuid import uuid4
+
+WS_MAGIC = '258EAFA5-E914-47DA-95CA-C5AB0DC85B11'
+
+OP_TEXT, OP_BINARY, OP_CLOSE, OP_PING, OP_PONG = 0x1, 0x2, 0x8, 0x9, 0xA
+
+KERNEL_WS_PROTOCOL = 'v1.kernel.websocket.jupyter.org'
+MESSAGE_PARTS = ('header', 'parent_header', 'metadata', 'content')
+
+# A 1x1 transparent png
+PNG = base64.b64decode('iVBORw0KGgoAAAANSUhEUgAAAAEAAAABCAYAAAAfFcSJAAAADUlEQVR42mNkYPhfDwAChwGA60e6kgAAAABJRU5ErkJggg==')
+
+
+class KernelConfig(object):
+    def __init__(self, latency=0.0, output_size=64, stream_chunks=1, images=0, image_size=None):
+        # Seconds spent "computing" each execute_request
+        self.latency = latency
+        # Number of characters of stream output per execute_request
+        self.output_size = output_size
+        # Number of stream messages the output is split into
+        self.stream_chunks = max(1, stream_chunks)
+        # Number of images displayed by each execute_request
+        self.images = images
+        # Size of each image in bytes, defaults to a tiny valid png
+        self.image_size = image_size
+
+    def image(self):
+        if self.image_size is None or self.image_size <= len(PNG):
+            return PNG
+        return PNG + b'\0' * (self.image_size - len(PNG))
+
+
+def read_frame(rfile):
+    head = rfile.read(2)
+    if len(head) < 2:
+        return OP_CLOSE, b''
+
+    opcode = head[0] & 0x0F
+    masked = head[1] & 0x80
+    length = head[1] & 0x7F
+
+    if length == 126:
+        length = struct.unpack('!H', rfile.read(2))[0]
+    elif length == 127:
+        length = struct.unpack('!Q', rfile.read(8))[0]
+
+    mask = rfile.read(4) if masked else None
+    payload = rfile.read(length)
+
+    if mask:
+        payload = bytes(b ^ mask[i % 4] for i, b in enumerate(payload))
+
+    return opcode, payload
+
+
+def write_frame(wfile, payload, opcode=OP_TEXT):
+    if isinstance(payload, str):
+        payload = payload.encode('utf-8')
+
+    length = len(payload)
+    if length < 126:
+        head = struct.pack('!BB', 0x80 | opcode, length)
+    elif length < (1 << 16):
+        head = struct.pack('!BBH', 0x80 | opcode, 126, length)
+    else:
+        head = struct.pack('!BBQ', 0x80 | opcode, 127, length)
+
+    wfile.write(head + payload)
+    wfile.flush()
+
+
+def pack_v1(msg):
+    parts = [json.dumps(msg[name]).encode('utf-8') for name in MESSAGE_PARTS]
+    channel = msg['channel'].encode('utf-8')
+
+    offsets = [8 * (len(parts) + 3)]
+    for part in [channel] + parts:
+        offsets.append(offsets[-1] + len(part))
+
+    return b''.join([struct.pack('<Q', len(offsets))] + [struct.pack('<Q', o) for o in offsets] + [channel] + parts)
+
+
+def unpack_v1(payload):
+    count = struct.unpack('<Q', payload[:8])[0]
+    offsets = [struct.unpack('<Q', payload[8 * (i + 1):8 * (i + 2)])[0] for i in range(count)]
+
+    msg = dict((name, json.loads(payload[offsets[i + 1]:offsets[i + 2]].decode('utf-8')))
+               for i, name in enumerate(MESSAGE_PARTS))
+    msg['channel'] = payload[offsets[0]:offsets[1]].decode('utf-8')
+
+    return msg
+
+
+class KernelChannel(object):
+    """
+    Answers the messages of a single websocket connection to a kernel.
+    """
+
+    def __init__(self, server, kernel_id, sagecell):
+        self.server = server
+        self.kernel_id = kernel_id
+        self.sagecell = sagecell
+
+    def message(self, channel, msg_type, content, parent):
+        return {'channel': channel,
+                'msg_type': msg_type,
+                'msg_id': str(uuid4()),
+                'header': {'msg_type': msg_type,
+                           'msg_id': str(uuid4()),
+                           'session': parent.get('header', {}).get('session', '')},
+                'parent_header': parent.get('header', {}),
+                'metadata': {},
+                'content': content}
+
+    def status(self, state, parent):
+        return self.message('iopub', 'status', {'execution_state': state}, parent)
+
+    def handle(self, request):
+        msg_type = request.get('header', {}).get('msg_type')
+
+        if msg_type == 'execute_request':
+            return self.execute(request)
+
+        if msg_type == 'kernel_info_request':
+            return [self.message('shell', 'kernel_info_reply', {'status': 'ok'}, request)]
+
+        return []
+
+    def execute(self, request):
+        config = self.server.config
+        code = request['content'].get('code', '')
+        silent = request['content'].get('silent', False)
+
+        if self.server.should_drop(code):
+            # Simulate a broken connection, the caller closes the socket
+            return None
+
+        self.server.record_execute(self.kernel_id, code, silent)
+
+        replies = [self.status('busy', request)]
+
+        latency = self.server.latency_of(code)
+        interrupt = self.server.interrupt_event(self.kernel_id)
+        interrupt.clear()
+
+        if latency and interrupt.wait(latency):
+            # Interrupted through the REST API
+            error = {'ename': 'KeyboardInterrupt', 'evalue': '', 'traceback': ['KeyboardInterrupt']}
+            replies.append(self.message('iopub', 'error', error, request))
+            replies.append(self.message('shell', 'execute_reply', {'status': 'error'}, request))
+            replies.append(self.status('idle', request))
+            return replies
+
+        if config.output_size:
+            text = ('x' * 79 + '\n') * (config.output_size // 80) + 'x' * (config.output_size % 80)
+            step = -(-len(text) // config.stream_chunks)
+            for start in range(0, len(text), step):
+                replies.append(self.message('iopub', 'stream',
+                                            {'name': 'stdout', 'text': text[start:start + step]},
+                                            request))
+
+        for indx in range(config.images):
+            if self.sagecell:
+                file_name = '%s_%d.png' % (uuid4(), indx)
+                self.server.files[file_name] = config.image()
+                data = {'text/image-filename': file_name}
+            else:
+                data = {'image/png': base64.b64encode(config.image()).decode('ascii'),
+                        'text/plain': '<Figure>'}
+            replies.append(self.message('iopub', 'display_data', {'data': data, 'metadata': {}}, request))
+
+        if 'raise' in code:
+            error = {'ename': 'Exception', 'evalue': 'raised', 'traceback': ['Traceback', 'Exception: raised']}
+            replies.append(self.message('iopub', 'error', error, request))
+            status = 'error'
+        else:
+            status = 'ok'
+
+        replies.append(self.message('shell', 'execute_reply', {'status': status}, request))
+        replies.append(self.status('idle', request))
+
+        return replies
+
+
+class FakeKernelHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def _json(self, data, code=200):
+        body = json.dumps(data).encode('utf-8')
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _empty(self, code=204):
+        self.send_response(code)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def _authorized(self):
+        token = self.server.token
+        if token is None or self.headers.get('Authorization') == 'token %s' % (token,):
+            return True
+        self._empty(403)
+        return False
+
+    def _read_body(self):
+        length = int(self.headers.get('Content-Length', 0) or 0)
+        return self.rfile.read(length) if length else b''
+
+    def do_GET(self):
+        path = self.path.split('?')[0]
+        parts = [p for p in path.split('/') if p]
+
+        if self.headers.get('Upgrade', '').lower() == 'websocket' and parts[-1:] == ['channels']:
+            if parts[0] == 'api' and not self._authorized():
+                return
+            return self.websocket(parts)
+
+        if parts == ['login']:
+            return self._json({})
+
+        if len(parts) == 4 and parts[0] == 'kernel' and parts[2] == 'files':
+            data = self.server.files.get(parts[3])
+            if data is None:
+                return self._empty(404)
+            self.send_response(200)
+            self.send_header('Content-Type', 'image/png')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+            return
+
+        self._empty(404)
+
+    def do_POST(self):
+        body = self._read_body()
+        parts = [p for p in self.path.split('?')[0].split('/') if p]
+
+        if parts[:1] == ['api'] and not self._authorized():
+            return
+
+        if parts == ['kernel']:
+            kernel_id = self.server.new_kernel()
+            return self._json({'id': kernel_id, 'ws_url': self.server.ws_url})
+
+        if parts == ['api', 'notebooks']:
+            return self._json({'name': 'Untitled%s.ipynb' % (uuid4().hex,), 'path': ''}, 201)
+
+        if len(parts) == 4 and parts[:2] == ['api', 'kernels'] and parts[3] == 'interrupt':
+            with self.server._lock:
+                self.server.interrupted.append(parts[2])
+            self.server.interrupt_event(parts[2]).set()
+            return self._empty(204)
+
+        if parts == ['api', 'sessions']:
+            try:
+                model = json.loads(body.decode('utf-8')) if body else {}
+            except ValueError:
+                model = {}
+            kernel_id = self.server.new_kernel()
+            session = {'id': str(uuid4()),
+                       'path': model.get('path', ''),
+                       'kernel': {'id': kernel_id, 'name': (model.get('kernel') or {}).get('name', 'python3')}}
+            with self.server._lock:
+                self.server.sessions[session['id']] = session
+            return self._json(session, 201)
+
+        self._empty(404)
+
+    def do_DELETE(self):
+        self._read_body()
+        parts = [p for p in self.path.split('?')[0].split('/') if p]
+
+        if len(parts) == 3 and parts[:2] == ['api', 'sessions']:
+            with self.server._lock:
+                self.server.sessions.pop(parts[2], None)
+
+        self._empty(204)
+
+    def websocket(self, parts):
+        sagecell = parts[0] == 'kernel'
+        kernel_id = parts[1] if sagecell else parts[2]
+
+        key = self.headers['Sec-WebSocket-Key']
+        accept = base64.b64encode(hashlib.sha1((key + WS_MAGIC).encode('ascii')).digest()).decode('ascii')
+
+        self.send_response(101)
+        self.send_header('Upgrade', 'websocket')
+        self.send_header('Connection', 'Upgrade')
+        self.send_header('Sec-WebSocket-Accept', accept)
+        requested = [p.strip() for p in self.headers.get('Sec-WebSocket-Protocol', '').split(',')]
+        binary = self.server.binary and KERNEL_WS_PROTOCOL in requested
+        if binary:
+            self.send_header('Sec-WebSocket-Protocol', KERNEL_WS_PROTOCOL)
+        self.end_headers()
+        self.wfile.flush()
+
+        channel = KernelChannel(self.server, kernel_id, sagecell)
+        self.close_connection = True
+
+        while True:
+            opcode, payload = read_frame(self.rfile)
+
+            if opcode == OP_CLOSE:
+                try:
+                    write_frame(self.wfile, b'', OP_CLOSE)
+                except OSError:
+                    pass
+                return
+
+            if opcode == OP_PING:
+                write_frame(self.wfile, payload, OP_PONG)
+                continue
+
+            try:
+                if binary and opcode == OP_BINARY:
+                    request = unpack_v1(payload)
+                else:
+                    request = json.loads(payload.decode('utf-8'))
+            except ValueError:
+                # e.g. the "session:" greeting of the notebook client
+                continue
+
+            replies = channel.handle(request)
+
+            if replies is None:
+                return
+
+            for reply in replies:
+                if binary:
+                    write_frame(self.wfile, pack_v1(reply), OP_BINARY)
+                else:
+                    write_frame(self.wfile, json.dumps(reply))
+
+
+class FakeKernelServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 1024
+
+    def __init__(self, host='127.0.0.1', port=0, **config):
+        ThreadingHTTPServer.__init__(self, (host, port), FakeKernelHandler)
+        self.config = KernelConfig(**config)
+        self.files = {}
+        self.kernels = set()
+        self.executed = []
+        self.sessions = {}
+        # Accept the binary websocket subprotocol of Jupyter Server
+        self.binary = True
+        # Token required by the Jupyter Server endpoints, if any
+        self.token = None
+        # Code containing any of these strings drops the connection once
+        self.drop_once = set()
+        # Seconds spent by code containing a key, instead of the latency
+        self.hang = {}
+        self.interrupted = []
+        self._interrupts = {}
+        self._lock = threading.Lock()
+        self._thread = None
+
+    @property
+    def url(self):
+        return 'http://%s:%d/' % self.server_address[:2]
+
+    @property
+    def ws_url(self):
+        return 'ws://%s:%d/' % self.server_address[:2]
+
+    def new_kernel(self):
+        kernel_id = str(uuid4())
+        with self._lock:
+            self.kernels.add(kernel_id)
+        return kernel_id
+
+    def record_execute(self, kernel_id, code, silent=False):
+        with self._lock:
+            self.executed.append((kernel_id, code, silent))
+
+    def latency_of(self, code):
+        for marker, seconds in self.hang.items():
+            if marker in code:
+                return seconds
+        return self.config.latency
+
+    def interrupt_event(self, kernel_id):
+        with self._lock:
+            return self._interrupts.setdefault(kernel_id, threading.Event())
+
+    def should_drop(self, code):
+        with self._lock:
+            for marker in self.drop_once:
+                if marker in code:
+                    self.drop_once.discard(marker)
+                    return True
+        return False
+
+    def start(self):
+        self._thread = threading.Thread(target=self.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
+
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Run a fake SageCell / IPython kernel server.')
+    parser.add_argument('--port', type=int, default=8888)
+    parser.add_argument('--latency', type=float, default=0.0)
+    parser.add_argument('--output-size', type=int, default=64)
+    parser.add_argument('--stream-chunks', type=int, default=1)
+    parser.add_argument('--images', type=int, default=0)
+    args = parser.parse_args()
+
+    server = FakeKernelServer(port=args.port, latency=args.latency, output_size=args.output_size,
+                              stream_chunks=args.stream_chunks, images=args.images)
+    print('Serving fake kernels on %s' % (server.url,))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.server_close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,189 @@
+"""
+Generates a synthetic Pelican content tree exercising pelicansage.
+
+    python test/sitegen.py /tmp/site --articles 50 --notebooks 10 --slides 5
+
+The tree contains rst articles with sage / ipython directives and
+sageresult / sageimage cross references to the previous article, nbformat
+v3 and v4 notebooks with image outputs referenced by the notebook directive,
+hovercraft slides and a pelicanconf.py wired to a kernel server url.
+"""
+
+import argparse
+import base64
+import json
+import os
+
+from fakekernel import PNG
+
+PNG_B64 = base64.b64encode(PNG).decode('ascii')
+
+PELICANCONF = """\
+PATH = 'content'
+OUTPUT_PATH = 'output'
+SITEURL = ''
+TIMEZONE = 'UTC'
+PLUGINS = ['pelicansage']
+ARTICLE_PATHS = ['articles', 'notebooks']
+ARTICLE_EXCLUDES = []
+PAGE_PATHS = ['pages']
+PAGE_EXCLUDES = []
+SLIDE_PATHS = ['slides']
+SLIDE_EXCLUDES = []
+SLIDES_THEME = %(slides_theme)r
+FEED_ALL_ATOM = None
+CATEGORY_FEED_ATOM = None
+CACHE_CONTENT = False
+SAGE = {'CELL_URL': %(cell_url)r,
+        'IPYTHON_URL': %(ipython_url)r,
+        'DB_PATH': '{PATH}/../cache',
+        'MAX_WORKERS': %(max_workers)d}
+"""
+
+
+def article_name(indx):
+    return 'article_%04d.rst' % (indx,)
+
+
+def notebook_name(indx):
+    return 'notebook_%04d.ipynb' % (indx,)
+
+
+def write_article(path, indx, blocks, notebooks, edit=0):
+    lines = ['Synthetic article %d' % (indx,),
+             '#' * 30,
+             '',
+             ':date: 2020-01-01 00:00',
+             ':category: bench',
+             ':slug: article-%d' % (indx,),
+             '']
+
+    for order in range(blocks):
+        directive = 'ipython' if order % 4 == 3 else 'sage'
+        lines.extend(['Block %d' % (order,),
+                      '',
+                      '.. %s::' % (directive,),
+                      '   :id: block%d' % (order,),
+                      '',
+                      '   x%d = %d + %d' % (order, order, edit if order == blocks - 1 else 0),
+                      '   print(x%d)' % (order,),
+                      ''])
+
+    if indx > 0:
+        previous = '/articles/' + article_name(indx - 1)
+        lines.extend(['.. sageresult:: block0',
+                      '   :file: %s' % (previous,),
+                      '',
+                      '.. sageimage:: block0',
+                      '   :file: %s' % (previous,),
+                      '   :alt: block0 of the previous article',
+                      ''])
+
+    if notebooks:
+        lines.extend(['.. notebook:: /notebooks/%s' % (notebook_name(indx % notebooks),),
+                      '   :cell-order: 0',
+                      ''])
+
+    with open(os.path.join(path, article_name(indx)), 'w') as f:
+        f.write('\n'.join(lines))
+
+
+def _nb_cells(cells):
+    for order in range(cells):
+        source = ['x = %d\n' % (order,), 'plot(x)\n']
+        outputs = [{'text/plain': 'Figure %d' % (order,), 'image/png': PNG_B64},
+                   'x is %d\n' % (order,)]
+        yield source, outputs
+
+
+def write_notebook(path, indx, cells):
+    if indx % 2:
+        notebook = {'nbformat': 3, 'nbformat_minor': 0,
+                    'metadata': {'name': notebook_name(indx), 'language': 'python'},
+                    'worksheets': [{'metadata': {}, 'cells': [
+                        {'cell_type': 'code', 'collapsed': False, 'language': 'python',
+                         'input': source, 'metadata': {}, 'prompt_number': order + 1,
+                         'outputs': [{'output_type': 'display_data', 'metadata': {},
+                                      'png': outputs[0]['image/png'], 'text': [outputs[0]['text/plain']]},
+                                     {'output_type': 'stream', 'stream': 'stdout', 'text': [outputs[1]]}]}
+                        for order, (source, outputs) in enumerate(_nb_cells(cells))]}]}
+    else:
+        notebook = {'nbformat': 4, 'nbformat_minor': 2,
+                    'metadata': {'language_info': {'name': 'python'}},
+                    'cells': [{'cell_type': 'code', 'execution_count': order + 1, 'metadata': {},
+                               'source': source,
+                               'outputs': [{'output_type': 'display_data', 'metadata': {}, 'data': outputs[0]},
+                                           {'output_type': 'stream', 'name': 'stdout', 'text': outputs[1]}]}
+                              for order, (source, outputs) in enumerate(_nb_cells(cells))]}
+
+    with open(os.path.join(path, notebook_name(indx)), 'w') as f:
+        json.dump(notebook, f, indent=1)
+
+
+def write_slides(path, indx, slides):
+    lines = [':title: Synthetic deck %d' % (indx,), '']
+    for slide in range(slides):
+        lines.extend(['----', '', 'Slide %d' % (slide,), '=' * 10, '', 'Some content for slide %d.' % (slide,), ''])
+
+    with open(os.path.join(path, 'deck_%04d.rst' % (indx,)), 'w') as f:
+        f.write('\n'.join(lines))
+
+
+def slides_theme():
+    import hovercraft
+    return os.path.join(os.path.dirname(hovercraft.__file__), 'templates', 'default')
+
+
+def generate(path, articles=10, notebooks=2, slides=2, blocks=5, cells=5,
+             cell_url='', ipython_url='', max_workers=4):
+    content = os.path.join(path, 'content')
+    subdirs = dict((name, os.path.join(content, name)) for name in ('articles', 'pages', 'notebooks', 'slides'))
+
+    for directory in subdirs.values():
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    for indx in range(articles):
+        write_article(subdirs['articles'], indx, blocks, notebooks)
+
+    # The notebook directory is an article path so pre_read ingests them
+    for indx in range(notebooks):
+        write_notebook(subdirs['notebooks'], indx, cells)
+
+    for indx in range(slides):
+        write_slides(subdirs['slides'], indx, 5)
+
+    with open(os.path.join(path, 'pelicanconf.py'), 'w') as f:
+        f.write(PELICANCONF % {'slides_theme': slides_theme(),
+                               'cell_url': cell_url,
+                               'ipython_url': ipython_url,
+                               'max_workers': max_workers})
+
+    return path
+
+
+def edit_article(path, indx, blocks, notebooks):
+    """
+    Changes the last block of an article, simulating an author edit.
+    """
+    write_article(os.path.join(path, 'content', 'articles'), indx, blocks, notebooks, edit=1)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('path')
+    parser.add_argument('--articles', type=int, default=10)
+    parser.add_argument('--notebooks', type=int, default=2)
+    parser.add_argument('--slides', type=int, default=2)
+    parser.add_argument('--blocks', type=int, default=5, help='blocks per article')
+    parser.add_argument('--cells', type=int, default=5, help='cells per notebook')
+    parser.add_argument('--cell-url', default='')
+    parser.add_argument('--ipython-url', default='')
+    args = parser.parse_args()
+
+    generate(args.path, args.articles, args.notebooks, args.slides, args.blocks, args.cells,
+             args.cell_url, args.ipython_url)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,112 @@
+import json
+import os
+import shutil
+import tempfile
+import unittest
+import zipfile
+
+from pelicansage.cache import export_results, import_results
+from pelicansage.managefiles import FileManager
+from pelicansage.snapshot import RenderSnapshot
+
+
+class TestResultArchive(unittest.TestCase):
+    def setUp(self):
+        self.location = tempfile.mkdtemp()
+        self.archive = os.path.join(self.location, 'results.zip')
+
+    def tearDown(self):
+        shutil.rmtree(self.location)
+
+    def manager(self, name):
+        return FileManager(location=os.path.join(self.location, name),
+                           base_path=os.path.join(self.location, name, 'images'))
+
+    def test_round_trip(self):
+        source = self.manager('source')
+        first = source.create_code('x = 1', '/a.rst', 0, user_id='first')
+        second = source.create_code('plot(x)', '/a.rst', 1)
+        source.create_code('pending', '/b.rst', 0)
+
+        source.create_result(first.id, 'out', 0)
+        source.create_error(first.id, 'E', 'v', 'Traceback', 1)
+        source.save_file(second.id, b'png', 'x.png', 0, 'image/png')
+        source.timestamp_code(first.id)
+        source.timestamp_code(second.id)
+        source.commit()
+
+        self.assertEqual(export_results(source, self.archive), 2)
+
+        target = self.manager('target')
+        self.assertEqual(import_results(target, self.archive), 2)
+
+        snapshot = RenderSnapshot(target)
+        first = snapshot.get_code(src='/a.rst', user_id='first')
+        self.assertEqual([r.data for r in first.stream_results], ['out'])
+        self.assertEqual(first.error_results[0].traceback, 'Traceback')
+        self.assertTrue(first.permalink)
+
+        second = snapshot.get_code(src='/a.rst', order=1)
+        image = second.file_results[0]
+        with open(target.file_location(second.id, image.file_name), 'rb') as f:
+            self.assertEqual(f.read(), b'png')
+
+        # Unevaluated blocks are added without results
+        pending = snapshot.get_code(src='/b.rst', order=0)
+        self.assertEqual(pending.last_evaluated, None)
+
+        # Importing again does not duplicate results
+        self.assertEqual(import_results(target, self.archive), 0)
+
+    def test_invalid_file_names(self):
+        source = self.manager('source')
+        block = source.create_code('plot(x)', '/a.rst', 0)
+        source.save_file(block.id, b'png', 'x.png', 0, 'image/png')
+        source.timestamp_code(block.id)
+        source.commit()
+        export_results(source, self.archive)
+
+        with zipfile.ZipFile(self.archive) as archive:
+            manifest = json.loads(archive.read('manifest.json').decode('utf-8'))
+
+        for name in ('../../escaped.png', '/tmp/escaped.png', '..', 'sub\\..\\x.png'):
+            for entry in manifest['results'].values():
+                entry['files'][0]['file_name'] = name
+
+            crafted = os.path.join(self.location, 'crafted.zip')
+            with zipfile.ZipFile(crafted, 'w') as archive:
+                archive.writestr('manifest.json', json.dumps(manifest))
+                for chain in manifest['results']:
+                    archive.writestr('files/%s/%s' % (chain, name), b'png')
+
+            target = self.manager('target')
+            with self.assertRaises(ValueError):
+                import_results(target, crafted)
+
+            # Nothing is imported from a rejected archive
+            self.assertEqual(target.get_all_codeblocks(), [])
+            self.assertFalse(any('escaped.png' in names for _, _, names in os.walk(self.location)))
+
+    def test_merge_by_chain(self):
+        source = self.manager('source')
+        code_obj = source.create_code('x = 1', '/a.rst', 0)
+        source.create_result(code_obj.id, 'out', 0)
+        source.timestamp_code(code_obj.id)
+        source.commit()
+        export_results(source, self.archive)
+
+        # Same blocks under another source name, with a changed second block
+        target = self.manager('target')
+        target.create_code('x = 1', '/renamed.rst', 0)
+        target.create_code('y = 2', '/renamed.rst', 1)
+
+        # The block of /a.rst, added from the archive, and the matching one of /renamed.rst
+        self.assertEqual(import_results(target, self.archive), 2)
+
+        snapshot = RenderSnapshot(target)
+        self.assertEqual([r.data for r in snapshot.get_code(src='/renamed.rst', order=0).results], ['out'])
+        self.assertEqual(snapshot.get_code(src='/renamed.rst', order=1).last_evaluated, None)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,71 @@
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+
+import sitegen
+from fakekernel import FakeKernelServer
+
+from pelicansage.managefiles import CodeBlock, DataSrc, FileManager
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+class TestContentCache(unittest.TestCase):
+    def setUp(self):
+        self.server = FakeKernelServer(output_size=10).start()
+        self.location = tempfile.mkdtemp()
+
+        sitegen.generate(self.location, articles=3, notebooks=0, slides=0, blocks=2,
+                         cell_url=self.server.url, ipython_url=self.server.url)
+
+    def configure(self, layer):
+        with open(os.path.join(self.location, 'pelicanconf.py'), 'a') as f:
+            f.write("CACHE_CONTENT = True\nLOAD_CONTENT_CACHE = True\nCONTENT_CACHING_LAYER = %r\n" % (layer,))
+
+    def tearDown(self):
+        shutil.rmtree(self.location)
+        self.server.stop()
+
+    def build(self):
+        env = dict(os.environ, PYTHONPATH=os.pathsep.join([ROOT_DIR, os.environ.get('PYTHONPATH', '')]))
+        subprocess.check_call([sys.executable, '-m', 'pelican', 'content', '-s', 'pelicanconf.py', '-q'],
+                              cwd=self.location, env=env)
+
+    def output(self, indx):
+        with open(os.path.join(self.location, 'output', 'article-%d.html' % (indx,))) as f:
+            return f.read()
+
+    def check_changed_results(self):
+        self.build()
+        self.assertFalse('x' * 20 in self.output(1))
+
+        # The results of the first article change while no file does
+        self.server.config.output_size = 20
+        manager = FileManager(location=os.path.join(self.location, 'cache'))
+        blocks = manager.query(CodeBlock).join(DataSrc, CodeBlock.src_id == DataSrc.id)\
+                        .filter(DataSrc.src == '/articles/' + sitegen.article_name(1)).all()
+        manager.delete_results([block.id for block in blocks])
+        for block in blocks:
+            block.last_evaluated = None
+        manager.commit()
+
+        self.build()
+
+        # The second article embeds results of the first one
+        self.assertEqual(['x' * 20 in self.output(indx) for indx in range(3)], [False, True, True])
+
+    def test_changed_results_invalidate_cached_pages(self):
+        self.configure('reader')
+        self.check_changed_results()
+
+    def test_generator_cache(self):
+        # Content objects cached by the generators are never used
+        self.configure('generator')
+        self.check_changed_results()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,4 +1,11 @@
+import base64
+import shutil
+import tempfile
+import threading
 import unittest
+import zlib
+
+import sqlalchemy
 
 from pelicansage.managefiles import FileManager
 
@@ -43,6 +50,52 @@ class TestFileManager(unittest.TestCase):
         self.assertEqual(code_obj2.user_id, 'myuniqueid')
         self.assertEqual(code_obj2.order, order + 2)
 
+    def test_timeout_change(self):
+        manager = FileManager()
+        before = manager.create_code('x = 1', 'a.rst', 0)
+        slow = manager.create_code('sleep(10)', 'a.rst', 1, timeout=1.0)
+        after = manager.create_code('y = 1', 'a.rst', 2)
+        for code_obj in (before, slow, after):
+            manager.timestamp_code(code_obj.id)
+        manager.create_result(before.id, 'one')
+        manager.create_error(slow.id, 'TimeoutError', 'exceeded', 'TimeoutError: exceeded', 0)
+        manager.create_error(after.id, 'Skipped', 'skipped', '', 0)
+        manager.commit()
+
+        # Raising the deadline of the timed out block evaluates it again,
+        # with the blocks after it
+        manager.create_code('sleep(10)', 'a.rst', 1, timeout=20.0)
+
+        blocks = sorted(manager.get_all_codeblocks(), key=lambda x: x.order)
+        self.assertEqual([b.last_evaluated is not None for b in blocks], [True, False, False])
+        self.assertEqual([len(b.results) for b in blocks], [1, 0, 0])
+        self.assertEqual(blocks[1].timeout, 20.0)
+
+        # A new deadline alone does not touch blocks which finished in time
+        manager.timestamp_code(before.id)
+        manager.create_code('x = 1', 'a.rst', 0, timeout=5.0)
+        self.assertTrue(manager.get_code(code_id=before.id).last_evaluated is not None)
+        self.assertEqual(len(manager.get_code(code_id=before.id).results), 1)
+
+    def test_default_timeout_change(self):
+        manager = FileManager()
+        slow = manager.create_code('sleep(10)', 'a.rst', 0, default_timeout=1.0)
+        manager.timestamp_code(slow.id)
+        manager.create_error(slow.id, 'TimeoutError', 'exceeded', 'TimeoutError: exceeded', 0)
+        manager.commit()
+
+        # The same BLOCK_TIMEOUT, or a :timeout: of the same length, keeps the error
+        manager.create_code('sleep(10)', 'a.rst', 0, default_timeout=1.0)
+        manager.create_code('sleep(10)', 'a.rst', 0, timeout=1.0, default_timeout=5.0)
+        self.assertTrue(manager.get_code(code_id=slow.id).last_evaluated is not None)
+
+        # Raising BLOCK_TIMEOUT evaluates the timed out block again
+        manager.create_code('sleep(10)', 'a.rst', 0, default_timeout=5.0)
+        code_obj = manager.get_code(code_id=slow.id)
+        self.assertEqual(code_obj.last_evaluated, None)
+        self.assertEqual(code_obj.results, [])
+        self.assertEqual((code_obj.timeout, code_obj.deadline), (None, 5.0))
+
     def test_create_file(self):
         manager = FileManager()
         src = 'a.rst'
@@ -126,6 +179,69 @@ class TestFileManager(unittest.TestCase):
         self.assertEqual([srcref.src2.src for srcref in src1_obj.references],
                          [src2, src3])
 
+    def test_referencing_sources(self):
+        manager = FileManager()
+
+        manager.create_reference('b.rst', 'a.rst')
+        manager.create_reference('c.rst', 'b.rst')
+        manager.create_reference('a.rst', 'c.rst')
+        manager.create_reference('e.rst', 'd.rst')
+
+        self.assertEqual(manager.get_referencing_sources(['c.rst']), set(['a.rst', 'b.rst']))
+        self.assertEqual(manager.get_referencing_sources(['d.rst']), set(['e.rst']))
+        self.assertEqual(manager.get_referencing_sources(['e.rst', 'unknown.rst']), set())
+
+    def test_referenced_sources(self):
+        manager = FileManager()
+
+        manager.create_reference('b.rst', 'a.rst')
+        manager.create_reference('c.rst', 'b.rst')
+        manager.create_reference('e.rst', 'd.rst')
+
+        self.assertEqual(manager.get_referenced_sources(['c.rst']), set(['a.rst', 'b.rst']))
+        self.assertEqual(manager.get_referenced_sources(['a.rst', 'e.rst']), set(['d.rst']))
+
+    def test_statuses_and_outputs(self):
+        manager = FileManager()
+
+        manager.create_code('x = 1', 'a.rst', 0)
+        manager.create_code('y = 1', 'b.rst', 0)
+        manager.set_status('a.rst', 'draft')
+        # Sources without code blocks are not stored
+        manager.set_status('c.rst', 'published')
+
+        self.assertEqual(manager.get_statuses(), {'a.rst': 'draft', 'b.rst': None})
+
+        manager.record_outputs({'drafts/a.html': 'a.rst', 'b.html': 'b.rst', 'c.html': 'c.rst'})
+        self.assertEqual(manager.get_output_sources(['b.html', 'c.html']), {'b.html': 'b.rst'})
+
+    def test_result_fingerprints(self):
+        manager = FileManager()
+
+        a = manager.create_code('x = 1', 'a.rst', 0)
+        b = manager.create_code('y = 1', 'b.rst', 0)
+        manager.create_code('z = 1', 'c.rst', 0)
+        manager.create_result(a.id, 'one')
+        manager.create_result(b.id, 'two')
+        # c embeds results of b, which embeds results of a
+        manager.create_reference('b.rst', 'a.rst')
+        manager.create_reference('c.rst', 'b.rst')
+
+        fingerprints = manager.result_fingerprints()
+        self.assertEqual(manager.changed_fingerprints(fingerprints), set(['a.rst', 'b.rst', 'c.rst']))
+
+        manager.store_fingerprints(fingerprints)
+        self.assertEqual(manager.changed_fingerprints(manager.result_fingerprints()), set())
+
+        manager.delete_results([a.id])
+        manager.create_result(a.id, 'uno')
+        self.assertEqual(manager.changed_fingerprints(manager.result_fingerprints()),
+                         set(['a.rst', 'b.rst', 'c.rst']))
+
+        manager.store_fingerprints(manager.result_fingerprints())
+        self.assertEqual(manager.changed_fingerprints(manager.result_fingerprints(salt='truncated')),
+                         set(['a.rst', 'b.rst', 'c.rst']))
+
     def test_timestamp(self):
         src = 'a.rst'
         order = 1
@@ -152,6 +268,169 @@ class TestFileManager(unittest.TestCase):
 
         self.assertEqual(code_obj.last_evaluated, dummy_io().datetime.now())
 
+    def test_permalink(self):
+        manager = FileManager()
+        first = manager.create_code('x = 1', 'a.rst', 0)
+        second = manager.create_code('print(x)', 'a.rst', 1)
+
+        manager.compute_permalink('a.rst')
+        src_permalink = first.src.permalink
+        first_permalink = first.permalink
+
+        self.assertEqual(first.permalink_hash, first.content_hash)
+        self.assertEqual(zlib.decompress(base64.urlsafe_b64decode(second.permalink)), b'print(x)')
+
+        # Unchanged sources are not regenerated
+        first.permalink = 'memoized'
+        manager.compute_permalink('a.rst')
+        self.assertEqual(first.permalink, 'memoized')
+        self.assertEqual(first.src.permalink, src_permalink)
+
+        manager.create_code('print(x + 1)', 'a.rst', 1)
+        manager.compute_permalink('a.rst')
+        second = manager.get_code(code_id=second.id)
+
+        self.assertEqual(first.permalink, 'memoized')
+        self.assertNotEqual(first.src.permalink, src_permalink)
+        self.assertEqual(zlib.decompress(base64.urlsafe_b64decode(second.permalink)), b'print(x + 1)')
+
+    def test_permalink_pool(self):
+        manager = FileManager()
+        for order in range(4):
+            manager.create_code('x = %d  # %s' % (order, 'y' * (1 << 15)), 'a.rst', order)
+
+        threads = threading.active_count()
+        manager.compute_permalink('a.rst')
+
+        # Large sources are encoded in threads which are gone afterwards
+        first = sorted(manager.get_all_codeblocks(), key=lambda x: x.order)[0]
+        self.assertEqual(zlib.decompress(base64.urlsafe_b64decode(first.permalink))[:5], b'x = 0')
+        self.assertEqual(threading.active_count(), threads)
+
+    def test_missing_columns(self):
+        location = tempfile.mkdtemp()
+        try:
+            engine = sqlalchemy.create_engine('sqlite:///' + pyos.path.join(location, 'content.db'))
+            with engine.begin() as connection:
+                connection.execute(sqlalchemy.text('CREATE TABLE "CodeBlock" (id INTEGER PRIMARY KEY, '
+                                                   'src_id INTEGER, "order" INTEGER, content VARCHAR)'))
+                connection.execute(sqlalchemy.text('INSERT INTO "CodeBlock" VALUES (1, 1, 0, \'x\')'))
+            engine.dispose()
+
+            manager = FileManager(location=location)
+            code_obj = manager.get_code(code_id=1)
+
+            self.assertEqual(code_obj.content, 'x')
+            self.assertEqual(code_obj.content_hash, None)
+        finally:
+            shutil.rmtree(location)
+
+    def test_result_blobs(self):
+        from pelicansage.managefiles import ResultBlob
+
+        manager = FileManager()
+        first = manager.create_code('help(x)', 'a.rst', 0)
+        second = manager.create_code('help(x)', 'b.rst', 0)
+
+        text = 'Help on x\n' * 100
+        manager.create_result(first.id, text, 0)
+        manager.create_result(second.id, text, 0)
+        manager.create_error(second.id, 'E', 'v', 'Traceback\n' * 50, 1)
+        manager.commit()
+
+        self.assertEqual([r.data for r in manager.get_results(first.id)], [text])
+        self.assertEqual(manager.get_code(code_id=second.id).error_results[0].traceback, 'Traceback\n' * 50)
+
+        blobs = manager.query(ResultBlob).order_by(ResultBlob.id).all()
+        self.assertEqual([(blob.codec, blob.refs) for blob in blobs], [('zlib', 2), ('zlib', 1)])
+        self.assertTrue(len(blobs[0].payload) < len(text))
+
+        # Changing a block releases the blobs of its results
+        manager.create_code('help(y)', 'a.rst', 0)
+        manager.commit()
+        self.assertEqual([blob.refs for blob in manager.query(ResultBlob).order_by(ResultBlob.id)], [1, 1])
+
+    def test_migrate_payloads(self):
+        location = tempfile.mkdtemp()
+        try:
+            manager = FileManager(location=location)
+            code_obj = manager.create_code('x', 'a.rst', 0)
+            manager.commit()
+            manager._engine.dispose()
+
+            engine = sqlalchemy.create_engine('sqlite:///' + pyos.path.join(location, 'content.db'))
+            with engine.begin() as connection:
+                # Results stored before ResultBlob existed
+                connection.execute(sqlalchemy.text('INSERT INTO "StreamResult" (code_id, "order", result, mimetype) '
+                                                   'VALUES (%d, 0, \'out\', \'text/plain\')' % (code_obj.id,)))
+                connection.execute(sqlalchemy.text('INSERT INTO "ErrorResult" (code_id, "order", ename, traceback) '
+                                                   'VALUES (%d, 1, \'E\', \'tb\')' % (code_obj.id,)))
+            engine.dispose()
+
+            manager = FileManager(location=location)
+            code_obj = manager.get_code(code_id=code_obj.id)
+
+            self.assertEqual([r.data for r in code_obj.stream_results], ['out'])
+            self.assertEqual(code_obj.error_results[0].traceback, 'tb')
+            self.assertEqual(code_obj.stream_results[0]._result, None)
+            self.assertTrue(code_obj.stream_results[0].blob_id is not None)
+        finally:
+            shutil.rmtree(location)
+
+    def test_collect_garbage(self):
+        from pelicansage.managefiles import ResultBlob, SrcReference
+
+        location = tempfile.mkdtemp()
+        try:
+            content = pyos.path.join(location, 'content')
+            images = pyos.path.join(location, 'images')
+            checkpoints = pyos.path.join(location, 'checkpoints')
+            for directory in (content, images, checkpoints):
+                pyos.makedirs(directory)
+            with open(pyos.path.join(content, 'kept.rst'), 'w') as f:
+                f.write('kept')
+
+            manager = FileManager(location=location, base_path=images)
+            kept = manager.create_code('x = 1', '/kept.rst', 0)
+            removed = manager.create_code('y = 1', '/removed.rst', 0)
+            manager.create_result(kept.id, 'shared output ' * 20, 0)
+            manager.create_result(removed.id, 'shared output ' * 20, 0)
+            manager.create_result(removed.id, 'only removed ' * 20, 1)
+            manager.save_file(removed.id, b'png', 'x.png', 2, 'image/png')
+            manager.create_reference('/kept.rst', '/removed.rst')
+            manager.record_stats(removed.id)
+            manager.commit()
+
+            kept_id, removed_id = kept.id, removed.id
+
+            # Checkpoint of a block chain which no longer exists
+            for name in ('stale.pkl', 'orphan'):
+                with open(pyos.path.join(checkpoints, name), 'w') as f:
+                    f.write('x')
+            pyos.makedirs(pyos.path.join(images, '999'))
+
+            collected = manager.collect_garbage(content_path=content, checkpoints=checkpoints)
+
+            self.assertEqual(dict((k, v) for k, v in collected.items() if not k.endswith('bytes')),
+                             {'sources': 1, 'blocks': 1, 'results': 0, 'references': 1, 'blobs': 1,
+                              'image_dirs': 2, 'raw_files': 0, 'checkpoints': 1})
+            self.assertTrue(collected['file_bytes'] > 0)
+
+            self.assertEqual(sorted(pyos.listdir(images)), [])
+            self.assertEqual(sorted(pyos.listdir(checkpoints)), ['orphan'])
+            self.assertEqual(manager.get_code(code_id=removed_id), None)
+            self.assertEqual(manager.query(SrcReference).count(), 0)
+            self.assertEqual([r.data for r in manager.get_results(kept_id)], ['shared output ' * 20])
+            self.assertEqual([blob.refs for blob in manager.query(ResultBlob)], [1])
+            self.assertEqual(len(manager.get_stats()), 0)
+
+            # A wrong content directory does not wipe the store
+            pyos.remove(pyos.path.join(content, 'kept.rst'))
+            self.assertRaises(ValueError, manager.collect_garbage, content_path=content)
+            self.assertRaises(ValueError, manager.collect_garbage, content_path=pyos.path.join(location, 'nope'))
+        finally:
+            shutil.rmtree(location)
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,32 @@
+import json
+import os
+import subprocess
+import sys
+import unittest
+
+from benchutil import HEAVY_MODULES
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+SCRIPT = """
+import json, sys
+import pelican
+before = set(sys.modules)
+import pelicansage
+print(json.dumps(sorted(set(sys.modules) - before)))
+"""
+
+
+class TestImports(unittest.TestCase):
+    def test_heavy_modules_are_lazy(self):
+        env = dict(os.environ, PYTHONPATH=os.pathsep.join([ROOT, os.environ.get('PYTHONPATH', '')]))
+        output = subprocess.check_output([sys.executable, '-c', SCRIPT], env=env, cwd=ROOT,
+                                         universal_newlines=True)
+
+        imported = set(name.split('.')[0] for name in json.loads(output.strip().splitlines()[-1]))
+
+        self.assertEqual(sorted(imported & set(HEAVY_MODULES)), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
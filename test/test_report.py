@@ -0,0 +1,40 @@
+import unittest
+
+from pelicansage.managefiles import FileManager
+from pelicansage.report import build_report, format_report
+
+
+class TestReport(unittest.TestCase):
+    def test_build_report(self):
+        manager = FileManager()
+
+        fast = manager.create_code('1+1', 'a.rst', 0)
+        slow = manager.create_code('sleep(1)', 'a.rst', 1)
+        other = manager.create_code('2+2', 'b.rst', 0)
+
+        manager.record_stats(fast.id, exec_time=0.1, setup_time=0.5, output_bytes=10,
+                             iopub_messages=4, endpoint='http://one/')
+        manager.record_stats(slow.id, exec_time=2.0, output_bytes=100,
+                             iopub_messages=6, images=1, endpoint='http://one/')
+        manager.record_stats(other.id, exec_time=0.2, output_bytes=20,
+                             iopub_messages=4, endpoint='http://two/')
+        manager.commit()
+
+        report = build_report(manager)
+
+        self.assertEqual(report['blocks'], 3)
+        self.assertEqual([(x['src'], x['order']) for x in report['slowest_blocks']],
+                         [('a.rst', 1), ('a.rst', 0), ('b.rst', 0)])
+        self.assertEqual([x['src'] for x in report['slowest_sources']], ['a.rst', 'b.rst'])
+        self.assertAlmostEqual(report['slowest_sources'][0]['total_time'], 2.6)
+
+        endpoints = dict((x['endpoint'], x) for x in report['endpoints'])
+        self.assertEqual(endpoints['http://one/']['blocks'], 2)
+        self.assertEqual(endpoints['http://one/']['output_bytes'], 110)
+        self.assertAlmostEqual(endpoints['http://two/']['blocks_per_second'], 5.0)
+
+        self.assertTrue('Slowest blocks' in format_report(report))
+
+
+if __name__ == '__main__':
+    unittest.main()
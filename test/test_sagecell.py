@@ -0,0 +1,346 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from pelicansage.evaluation import evaluate
+from pelicansage.managefiles import FileManager, ResultTypes
+from pelicansage.sagecell import (SageCell, IPythonNotebookClient, JupyterServerClient, LocalKernelClient,
+                                  KERNEL_WS_PROTOCOL, output_size)
+
+from fakekernel import FakeKernelServer, PNG
+
+try:
+    import ipykernel
+except ImportError:
+    ipykernel = None
+
+
+class TestOutputSize(unittest.TestCase):
+    def message(self, msg_type, content):
+        return {'header': {'msg_type': msg_type}, 'content': content}
+
+    def test_output_size(self):
+        self.assertEqual(output_size(self.message('stream', {'name': 'stdout', 'text': 'h\u00e9'})), 3)
+        self.assertEqual(output_size(self.message('execute_result', {'data': {'text/plain': '42'}})), 2)
+        self.assertEqual(output_size(self.message('error', {'ename': 'E', 'evalue': 'v', 'traceback': ['tb']})), 4)
+
+        # Protocol messages carry no output
+        self.assertEqual(output_size(self.message('execute_input', {'code': 'x' * 100})), 0)
+        self.assertEqual(output_size(self.message('status', {'execution_state': 'idle'})), 0)
+
+
+class TestSageCell(unittest.TestCase):
+    def setUp(self):
+        self.server = FakeKernelServer(output_size=100, stream_chunks=10, images=1).start()
+
+    def tearDown(self):
+        self.server.stop()
+
+    def test_sagecell_results(self):
+        cell = SageCell(self.server.url)
+        response = cell.execute_request('1+1')
+        results = cell.get_results_from_response(response)
+        cell.cleanup()
+
+        # The stream chunks are combined into a single result
+        self.assertEqual([(r.result_type, r.mimetype) for r in results],
+                         [(ResultTypes.Stream, 'text/plain'),
+                          (ResultTypes.Image, 'text/image-filename')])
+        self.assertEqual(len(results[0].data), 100)
+        self.assertTrue(results[1].data.startswith(self.server.url))
+
+        self.assertEqual(cell.stats['iopub_messages'], 13)
+        # The streamed text and the name of the image, not the protocol messages
+        self.assertEqual(cell.stats['output_bytes'], 100 + len(os.path.basename(results[1].data)))
+
+    def test_sagecell_language(self):
+        cell = SageCell(self.server.url, language='r')
+        cell.execute_request('x <- 1')
+        cell.execute_request('print(x)')
+        cell.cleanup()
+
+        # Evaluated through the R interface of Sage, after the keepalive
+        self.assertEqual([code for _, code, _ in self.server.executed],
+                         ["interact(lambda : None)\nprint(r.eval('x <- 1'))", "print(r.eval('print(x)'))"])
+
+    def test_sage_routes(self):
+        from pelicansage.pelicansage import _parse_routes
+
+        self.assertEqual(_parse_routes({'sage:GAP': {'url': self.server.url}}),
+                         {('sage', 'gap'): {'url': self.server.url}})
+
+        with self.assertRaises(ValueError):
+            _parse_routes({'sage:r': {'url': self.server.url, 'kernel': 'ir'}})
+        with self.assertRaises(ValueError):
+            _parse_routes({'sage:haskell': {'url': self.server.url}})
+
+    def test_notebook_client_error(self):
+        client = IPythonNotebookClient(self.server.url)
+        response = client.execute_request('raise Exception()')
+        results = client.get_results_from_response(response)
+        client.cleanup()
+
+        self.assertEqual([r.mimetype for r in results],
+                         ['text/plain', 'image/png', 'text/x-python-traceback'])
+        self.assertEqual(results[2].data.ename, 'Exception')
+
+    def test_evaluate(self):
+        manager = FileManager()
+        for order in range(3):
+            manager.create_code('print(%d)' % (order,), 'a.rst', order, platform='ipython', language='python')
+        manager.create_code('print(4)', 'b.rst', 0, platform='ipython', language='python')
+
+        evaluate(manager, lambda: {'ipython': IPythonNotebookClient(self.server.url)}, max_workers=2)
+
+        blocks, _ = manager.get_unevaluated_codeblocks()
+        self.assertEqual(blocks, [])
+
+        self.assertEqual(len(self.server.executed), 4)
+        self.assertEqual(len(self.server.kernels), 2)
+
+        for code_obj in manager.get_all_codeblocks():
+            self.assertEqual([r.mimetype for r in code_obj.results], ['text/plain', 'image/png'])
+
+        self.assertEqual(len(manager.get_stats()), 4)
+
+    def test_evaluate_routes_languages(self):
+        r_server = FakeKernelServer(output_size=10).start()
+        try:
+            manager = FileManager()
+            manager.create_code('x <- 1', 'a.rst', 0, platform='ipython', language='r')
+            manager.create_code('y <- 2', 'b.rst', 0, platform='ipython', language='r')
+            manager.create_code('z = 3', 'c.rst', 0, platform='ipython', language='python')
+
+            clients = lambda: {'ipython': IPythonNotebookClient(self.server.url),
+                               ('ipython', 'r'): IPythonNotebookClient(r_server.url, kernel_name='ir')}
+
+            evaluate(manager, clients, max_workers=4, limits={('ipython', 'r'): 1})
+
+            self.assertEqual(sorted(code for _, code, _ in r_server.executed), ['x <- 1', 'y <- 2'])
+            self.assertEqual([code for _, code, _ in self.server.executed], ['z = 3'])
+            self.assertEqual(manager.get_unevaluated_codeblocks()[0], [])
+        finally:
+            r_server.stop()
+
+    def test_evaluate_resumes_failing_block(self):
+        manager = FileManager()
+        for order, code in enumerate(('a = 1', 'b = 2', 'c = 3')):
+            manager.create_code(code, 'a.rst', order, platform='ipython', language='python')
+
+        self.server.drop_once.add('b = 2')
+
+        evaluate(manager, lambda: {'ipython': IPythonNotebookClient(self.server.url)}, retries=2, backoff=0)
+
+        # a new kernel replays the first block silently and resumes at the second
+        self.assertEqual([(code, silent) for _, code, silent in self.server.executed],
+                         [('a = 1', False), ('a = 1', True), ('b = 2', False), ('c = 3', False)])
+        self.assertEqual(len(self.server.kernels), 2)
+        # The session of the dropped kernel is deleted by the retry
+        self.assertEqual(self.server.sessions, {})
+
+        for code_obj in manager.get_all_codeblocks():
+            self.assertTrue(code_obj.last_evaluated is not None)
+            self.assertEqual(len(code_obj.results), 2)
+
+    def test_evaluate_replays_evaluated_prefix(self):
+        manager = FileManager()
+        for order, code in enumerate(('a = 1', 'b = 2')):
+            manager.create_code(code, 'a.rst', order, platform='ipython', language='python')
+
+        client = lambda: {'ipython': IPythonNotebookClient(self.server.url)}
+        evaluate(manager, client)
+
+        first = manager.get_code(code_id=1)
+        results = [(r.id, r.data) for r in first.results]
+
+        # Editing the second block keeps the results of the first one
+        manager.create_code('b = 3', 'a.rst', 1, platform='ipython', language='python')
+        evaluate(manager, client)
+
+        self.assertEqual([(code, silent) for _, code, silent in self.server.executed[2:]],
+                         [('a = 1', True), ('b = 3', False)])
+        self.assertEqual([(r.id, r.data) for r in manager.get_code(code_id=1).results], results)
+
+
+class TestJupyterServerClient(unittest.TestCase):
+    def setUp(self):
+        self.server = FakeKernelServer(output_size=100, stream_chunks=10, images=1).start()
+        self.server.token = 'secret'
+
+    def tearDown(self):
+        self.server.stop()
+
+    def execute(self, code, **kwargs):
+        client = JupyterServerClient(self.server.url, token='secret', **kwargs)
+        try:
+            response = client.execute_request(code)
+            return client, client.get_results_from_response(response)
+        finally:
+            client.cleanup()
+
+    def test_binary_protocol(self):
+        client, results = self.execute('raise Exception()', kernel_name='python3')
+
+        self.assertEqual(client.protocol, KERNEL_WS_PROTOCOL)
+        self.assertEqual([(r.result_type, r.mimetype) for r in results],
+                         [(ResultTypes.Stream, 'text/plain'),
+                          (ResultTypes.Image, 'image/png'),
+                          (ResultTypes.Error, 'text/x-python-traceback')])
+        self.assertEqual(len(results[0].data), 100)
+        self.assertEqual(results[1].data, PNG)
+        self.assertEqual(results[2].data.ename, 'Exception')
+
+        # Deleting the session shut the kernel down
+        self.assertEqual(self.server.sessions, {})
+
+    def test_json_fallback(self):
+        self.server.binary = False
+
+        client, results = self.execute('1+1')
+
+        self.assertEqual(client.protocol, None)
+        self.assertEqual([(r.result_type, r.mimetype) for r in results],
+                         [(ResultTypes.Stream, 'text/plain'), (ResultTypes.Image, 'image/png')])
+        self.assertEqual(results[1].data, PNG)
+
+        client, results = self.execute('1+1', binary=False)
+        self.assertEqual(client.protocol, None)
+
+    def test_token(self):
+        client = JupyterServerClient(self.server.url, token='wrong')
+        self.assertRaises(Exception, client.execute_request, '1+1')
+
+    def test_timeout(self):
+        self.server.hang['sleep'] = 30
+
+        client = JupyterServerClient(self.server.url, token='secret')
+        try:
+            response = client.execute_request('sleep()', timeout=0.2)
+            results = client.get_results_from_response(response)
+            self.assertTrue(client.timed_out)
+            self.assertEqual(self.server.interrupted, [client.kernel_id])
+
+            # The kernel is still usable
+            client.execute_request('1+1', timeout=5)
+            self.assertFalse(client.timed_out)
+        finally:
+            client.cleanup()
+
+        # Only the deadline error, not the KeyboardInterrupt of the kernel
+        self.assertEqual([(r.result_type, r.data.ename) for r in results], [(ResultTypes.Error, 'TimeoutError')])
+
+    def test_evaluate_timeouts(self):
+        self.server.hang['sleep'] = 30
+        client = lambda: {'ipython': JupyterServerClient(self.server.url, token='secret')}
+
+        for on_timeout in ('continue', 'skip'):
+            manager = FileManager()
+            for order, code in enumerate(('a = 1', 'sleep()', 'b = 2')):
+                manager.create_code(code, on_timeout + '.rst', order, platform='ipython', language='python',
+                                    timeout=0.2 if order == 1 else None)
+
+            evaluate(manager, client, timeout=5, on_timeout=on_timeout)
+
+            self.assertEqual(manager.get_unevaluated_codeblocks()[0], [])
+            errors = [[r.ename for r in code_obj.results if r.type == ResultTypes.Error]
+                      for code_obj in manager.get_all_codeblocks()]
+            if on_timeout == 'continue':
+                self.assertEqual(errors, [[], ['TimeoutError'], []])
+            else:
+                self.assertEqual(errors, [[], ['TimeoutError'], ['Skipped']])
+
+        self.assertEqual([code for _, code, _ in self.server.executed],
+                         ['a = 1', 'sleep()', 'b = 2', 'a = 1', 'sleep()'])
+
+    def test_evaluate_saves_images(self):
+        directory = tempfile.mkdtemp()
+        try:
+            manager = FileManager(base_path=directory)
+            code_obj = manager.create_code('plot()', 'a.rst', 0, platform='ipython', language='python')
+
+            evaluate(manager, lambda: {'ipython': JupyterServerClient(self.server.url, token='secret')})
+
+            image = manager.get_code(code_id=code_obj.id).results[1]
+            self.assertEqual(image.type, ResultTypes.Image)
+
+            with open(manager.file_location(code_obj.id, image.file_name), 'rb') as f:
+                self.assertEqual(f.read(), PNG)
+        finally:
+            shutil.rmtree(directory)
+
+
+@unittest.skipIf(ipykernel is None, 'ipykernel is not installed')
+class TestLocalKernelClient(unittest.TestCase):
+    def test_execute(self):
+        client = LocalKernelClient('python3', timeout=60)
+        try:
+            client.execute_request('x = 21')
+            response = client.execute_request('print(x * 2)\nraise ValueError("bad")')
+            results = client.get_results_from_response(response)
+        finally:
+            client.cleanup()
+
+        self.assertEqual([r.mimetype for r in results], ['text/plain', 'text/x-python-traceback'])
+        self.assertEqual(results[0].data, '42\n')
+        self.assertEqual(results[1].data.ename, 'ValueError')
+        self.assertEqual(client.stats['setup_time'], 0.0)
+        self.assertTrue(client.stats['output_bytes'] > 0)
+
+    def test_timeout(self):
+        client = LocalKernelClient('python3', timeout=60)
+        try:
+            client.execute_request('x = 21')
+            response = client.execute_request('import time\nprint(x)\ntime.sleep(60)', timeout=2)
+            results = client.get_results_from_response(response)
+            self.assertTrue(client.timed_out)
+
+            # The interrupted kernel keeps its namespace
+            response = client.execute_request('print(x * 2)', timeout=2)
+            self.assertFalse(client.timed_out)
+            self.assertEqual(client.get_results_from_response(response)[0].data, '42\n')
+        finally:
+            client.cleanup()
+
+        self.assertEqual([r.mimetype for r in results], ['text/plain', 'text/x-python-traceback'])
+        self.assertEqual(results[1].data.ename, 'TimeoutError')
+
+    def test_checkpoints(self):
+        directory = tempfile.mkdtemp()
+        try:
+            checkpoints = os.path.join(directory, 'checkpoints')
+            runs = os.path.join(directory, 'runs.txt')
+            client = lambda: {'ipython': LocalKernelClient('python3', timeout=60)}
+
+            manager = FileManager()
+            blocks = ('open(%r, "a").write("x")\nx = 1' % (runs,),
+                      'def f(y):\n    return x + y',
+                      'print(f(1))')
+            for order, code in enumerate(blocks):
+                manager.create_code(code, 'a.rst', order, platform='ipython', language='python')
+
+            evaluate(manager, client, checkpoints=checkpoints)
+            self.assertEqual(len(os.listdir(checkpoints)), 3)
+
+            # Only the edited block runs, on top of the restored namespace
+            code_obj = manager.create_code('print(f(10))', 'a.rst', 2, platform='ipython', language='python')
+            evaluate(manager, client, checkpoints=checkpoints)
+
+            self.assertEqual(manager.get_code(code_id=code_obj.id).results[0].data, '11\n')
+            with open(runs) as f:
+                self.assertEqual(f.read(), 'x')
+
+            # A namespace which can not be pickled falls back to replaying
+            code_obj = manager.create_code('g = (i for i in range(3))\nprint(f(100))', 'a.rst', 2,
+                                           platform='ipython', language='python')
+            code_obj = manager.create_code('print(f(1000))', 'a.rst', 3, platform='ipython', language='python')
+            evaluate(manager, client, checkpoints=checkpoints)
+
+            self.assertEqual(manager.get_code(code_id=code_obj.id).results[0].data, '1001\n')
+            self.assertEqual(len(os.listdir(checkpoints)), 4)
+        finally:
+            shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    unittest.main()
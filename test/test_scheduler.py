@@ -0,0 +1,99 @@
+import unittest
+
+from pelicansage.evaluation import BlockTask, plan
+from pelicansage.managefiles import FileManager
+from pelicansage.scheduler import SourceGraph, estimate_costs, simulate
+
+
+class TestSourceGraph(unittest.TestCase):
+    def test_dependents_wait_for_upstream(self):
+        # c embeds results of b, which embeds results of a, d is independent
+        graph = SourceGraph(['a', 'b', 'c', 'd'], [('b', 'a'), ('c', 'b'), ('c', 'x')])
+
+        self.assertEqual(graph.topological_order(), ['a', 'd', 'b', 'c'])
+
+        self.assertEqual(graph.pop_ready(), 'a')
+        self.assertEqual(graph.pop_ready(), 'd')
+        self.assertFalse(graph.has_ready())
+
+        self.assertEqual(graph.complete('d'), [])
+        self.assertEqual(graph.complete('a'), ['b'])
+        self.assertEqual(graph.pop_ready(), 'b')
+        self.assertEqual(graph.complete('b'), ['c'])
+
+    def test_multiple_upstreams(self):
+        graph = SourceGraph(['a', 'b', 'c'], [('c', 'a'), ('c', 'b')])
+
+        self.assertEqual(graph.upstream('c'), set(['a', 'b']))
+        self.assertEqual(graph.complete('a'), [])
+        self.assertEqual(graph.complete('b'), ['c'])
+
+    def test_cycles(self):
+        graph = SourceGraph(['a', 'b', 'c'], [('a', 'b'), ('b', 'a'), ('c', 'a')])
+
+        self.assertEqual(graph.pop_ready(), 'a')
+        self.assertEqual(graph.pop_ready(), 'b')
+        self.assertFalse(graph.has_ready())
+        self.assertEqual(graph.complete('a'), ['c'])
+
+    def test_longest_first(self):
+        # b is short but a long source waits on it
+        costs = {'a': 5.0, 'b': 1.0, 'c': 10.0, 'd': 2.0}
+        graph = SourceGraph(['a', 'b', 'c', 'd'], [('c', 'b')], costs)
+
+        self.assertEqual(graph.priority('b'), 11.0)
+        self.assertEqual([graph.pop_ready() for _ in range(3)], ['b', 'a', 'd'])
+
+        self.assertEqual(graph.complete('b'), ['c'])
+        self.assertEqual(graph.pop_ready(), 'c')
+
+    def test_simulate(self):
+        costs = {'a': 4.0, 'b': 1.0, 'c': 1.0, 'd': 2.0}
+
+        wall_time, started = simulate(SourceGraph(['a', 'b', 'c', 'd'], [], costs), 2)
+        self.assertEqual(wall_time, 4.0)
+        self.assertEqual(started, {'a': 0.0, 'd': 0.0, 'b': 2.0, 'c': 3.0})
+
+        wall_time, _ = simulate(SourceGraph(['a', 'b', 'c', 'd'], [('a', 'd')], costs), 2)
+        self.assertEqual(wall_time, 6.0)
+
+    def test_estimate_costs(self):
+        tasks = {'a': [BlockTask(1, 'a', 0, '', 'python', 'sage', True, ''),
+                       BlockTask(2, 'a', 1, '', 'python', 'sage', False, '')],
+                 'b': [BlockTask(3, 'b', 0, '', 'python', 'sage', False, '')],
+                 'c': [BlockTask(4, 'c', 0, '', 'python', 'sage', False, '')]}
+
+        durations = {('a', 0): 2.0, ('a', 2): 4.0, ('b', 0): 0.0}
+        costs, estimates = estimate_costs(tasks, durations)
+
+        # Unknown blocks take the mean of their source, then of all blocks
+        self.assertEqual(estimates[('a', 1)], 3.0)
+        self.assertEqual(costs, {'a': 5.0, 'b': 0.0, 'c': 2.0})
+
+        self.assertEqual(estimate_costs(tasks, {}, default=0.5)[0], {'a': 1.0, 'b': 0.5, 'c': 0.5})
+
+    def test_plan(self):
+        manager = FileManager()
+        first = manager.create_code('x = 1', 'a.rst', 0)
+        manager.create_code('print(x)', 'a.rst', 1)
+        cached = manager.create_code('y = 1', 'b.rst', 0)
+        manager.timestamp_code(first.id)
+        manager.timestamp_code(cached.id)
+        manager.record_stats(first.id, setup_time=1.0, exec_time=2.0)
+        manager.commit()
+
+        planned, wall_time = plan(manager, 2)
+
+        self.assertEqual([(x.src, x.order, x.action, x.estimate) for x in planned],
+                         [('a.rst', 0, 'replay', 3.0), ('a.rst', 1, 'run', 3.0), ('b.rst', 0, 'cached', 0.0)])
+        self.assertEqual(wall_time, 6.0)
+
+        planned, wall_time = plan(manager, 2, sources=set(['b.rst']))
+
+        self.assertEqual([(x.src, x.order, x.action) for x in planned],
+                         [('a.rst', 0, 'cached'), ('a.rst', 1, 'skipped'), ('b.rst', 0, 'cached')])
+        self.assertEqual(wall_time, 0.0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,118 @@
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+from unittest import mock
+
+import sitegen
+from fakekernel import FakeKernelServer
+
+from pelicansage import pelicansage as plugin
+from pelicansage.managefiles import CodeBlock, DataSrc, FileManager
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+class TestSelectiveEvaluation(unittest.TestCase):
+    def setUp(self):
+        self.server = FakeKernelServer().start()
+        self.location = tempfile.mkdtemp()
+
+        # Every article embeds results of the previous one
+        sitegen.generate(self.location, articles=4, notebooks=0, slides=0, blocks=2,
+                         cell_url=self.server.url, ipython_url=self.server.url)
+
+        for indx in (2, 3):
+            path = os.path.join(self.location, 'content', 'articles', sitegen.article_name(indx))
+            with open(path) as f:
+                content = f.read()
+            with open(path, 'w') as f:
+                f.write(content.replace(':category: bench', ':category: bench\n:status: draft'))
+
+        self.configure("SAGE['DRAFTS'] = 'lazy'\n")
+
+    def tearDown(self):
+        shutil.rmtree(self.location)
+        self.server.stop()
+
+    def configure(self, lines):
+        with open(os.path.join(self.location, 'pelicanconf.py'), 'a') as f:
+            f.write(lines)
+
+    def build(self):
+        env = dict(os.environ, PYTHONPATH=os.pathsep.join([ROOT_DIR, os.environ.get('PYTHONPATH', '')]))
+        subprocess.check_call([sys.executable, '-m', 'pelican', 'content', '-s', 'pelicanconf.py', '-q'],
+                              cwd=self.location, env=env)
+
+    def evaluated(self):
+        manager = FileManager(location=os.path.join(self.location, 'cache'))
+        evaluated = set(src for src, last_evaluated in
+                        manager.query(DataSrc.src, CodeBlock.last_evaluated)
+                               .join(CodeBlock, CodeBlock.src_id == DataSrc.id)
+                        if last_evaluated is not None)
+        manager._engine.dispose()
+        return evaluated
+
+    def test_lazy_drafts(self):
+        self.build()
+
+        self.assertEqual(self.evaluated(), set('/articles/' + sitegen.article_name(indx) for indx in (0, 1)))
+
+        # Selecting the last draft evaluates the draft it embeds results of,
+        # and only its page is written
+        os.remove(os.path.join(self.location, 'output', 'article-0.html'))
+        self.configure("WRITE_SELECTED = ['output/drafts/article-3.html']\n")
+        self.build()
+
+        self.assertEqual(self.evaluated(), set('/articles/' + sitegen.article_name(indx) for indx in range(4)))
+        self.assertFalse(os.path.exists(os.path.join(self.location, 'output', 'article-0.html')))
+        self.assertTrue(os.path.exists(os.path.join(self.location, 'output', 'drafts', 'article-3.html')))
+
+    def test_fresh_store(self):
+        # The first build is targeted, no output is known to the store yet
+        self.assertFalse(os.path.exists(os.path.join(self.location, 'cache')))
+        self.configure("WRITE_SELECTED = ['output/article-1.html']\n")
+        self.build()
+
+        self.assertEqual(self.evaluated(), set('/articles/' + sitegen.article_name(indx) for indx in (0, 1)))
+        self.assertTrue(os.path.exists(os.path.join(self.location, 'output', 'article-1.html')))
+        self.assertFalse(os.path.exists(os.path.join(self.location, 'output', 'article-0.html')))
+
+    def test_notebook_statuses(self):
+        notebooks = os.path.join(self.location, 'content', 'notebooks')
+        for indx in range(3):
+            sitegen.write_notebook(notebooks, indx, 2)
+
+        # Statuses from a .nbdata file and from the notebook metadata
+        with open(os.path.join(notebooks, 'notebook_0000.nbdata'), 'w') as f:
+            f.write('Title: First notebook\nStatus: draft\n')
+
+        path = os.path.join(notebooks, sitegen.notebook_name(1))
+        with open(path) as f:
+            notebook = json.load(f)
+        notebook['metadata']['status'] = 'skip'
+        with open(path, 'w') as f:
+            json.dump(notebook, f)
+
+        self.build()
+
+        manager = FileManager(location=os.path.join(self.location, 'cache'))
+        try:
+            statuses = manager.get_statuses()
+            self.assertEqual([statuses['/notebooks/' + sitegen.notebook_name(indx)] for indx in range(3)],
+                             ['draft', 'skip', 'published'])
+
+            with mock.patch.object(plugin, '_FILE_MANAGER', manager), \
+                    mock.patch.dict(plugin._SAGE_SETTINGS, {'DRAFTS': 'lazy', 'DRAFT_STATUSES': ('draft',)}):
+                self.assertEqual(plugin.evaluation_sources(),
+                                 set(['/articles/' + sitegen.article_name(0), '/articles/' + sitegen.article_name(1),
+                                      '/notebooks/' + sitegen.notebook_name(2)]))
+        finally:
+            manager._engine.dispose()
+
+
+if __name__ == '__main__':
+    unittest.main()
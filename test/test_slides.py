@@ -0,0 +1,91 @@
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+
+import sitegen
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+MARKER = '<!-- previous build -->'
+
+
+class TestSlidesGenerator(unittest.TestCase):
+    def setUp(self):
+        self.location = tempfile.mkdtemp()
+
+        sitegen.generate(self.location, articles=1, notebooks=0, slides=2, blocks=0)
+
+        # A theme of our own to edit
+        self.theme = os.path.join(self.location, 'theme')
+        shutil.copytree(sitegen.slides_theme(), self.theme)
+        self.configure('SLIDES_THEME = %r\n' % (self.theme,))
+
+        self.mathjax = 'https://mathjax.example.org/MathJax.js'
+
+    def tearDown(self):
+        shutil.rmtree(self.location)
+
+    def configure(self, lines):
+        with open(os.path.join(self.location, 'pelicanconf.py'), 'a') as f:
+            f.write(lines)
+
+    def build(self):
+        env = dict(os.environ, HOVERCRAFT_MATHJAX=self.mathjax,
+                   PYTHONPATH=os.pathsep.join([ROOT_DIR, os.environ.get('PYTHONPATH', '')]))
+        subprocess.check_call([sys.executable, '-m', 'pelican', 'content', '-s', 'pelicanconf.py', '-q'],
+                              cwd=self.location, env=env)
+
+    def deck(self, indx):
+        return os.path.join(self.location, 'output', 'slides', 'deck_%04d' % (indx,), 'index.html')
+
+    def mark(self):
+        for indx in range(2):
+            with open(self.deck(indx), 'a') as f:
+                f.write(MARKER)
+
+    def regenerated(self):
+        # A deck generated again no longer holds the marker of the previous build
+        generated = []
+        for indx in range(2):
+            with open(self.deck(indx)) as f:
+                generated.append(MARKER not in f.read())
+        return generated
+
+    def test_fingerprints(self):
+        self.build()
+        self.assertTrue(all(os.path.exists(self.deck(indx)) for indx in range(2)))
+
+        self.mark()
+        self.build()
+        self.assertEqual(self.regenerated(), [False, False])
+
+        sitegen.write_slides(os.path.join(self.location, 'content', 'slides'), 0, 3)
+        self.build()
+        self.assertEqual(self.regenerated(), [True, False])
+
+        self.mark()
+        with open(os.path.join(self.theme, 'css', 'extra.css'), 'w') as f:
+            f.write('body { color: black; }\n')
+        self.build()
+        self.assertEqual(self.regenerated(), [True, True])
+
+        self.mark()
+        self.mathjax = 'https://mathjax.example.org/v3/MathJax.js'
+        self.build()
+        self.assertEqual(self.regenerated(), [True, True])
+
+    def test_without_cache(self):
+        self.configure('SLIDES_CACHE = False\n')
+
+        self.build()
+        self.mark()
+        self.build()
+
+        self.assertEqual(self.regenerated(), [True, True])
+
+
+if __name__ == '__main__':
+    unittest.main()
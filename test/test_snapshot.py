@@ -0,0 +1,59 @@
+import unittest
+
+from pelicansage.managefiles import FileManager, ResultTypes
+from pelicansage.snapshot import RenderSnapshot
+
+
+class TestRenderSnapshot(unittest.TestCase):
+    def setUp(self):
+        self.manager = FileManager()
+
+        self.first = self.manager.create_code('print(1)', 'a.rst', 0, user_id='first')
+        self.second = self.manager.create_code('1/0', 'a.rst', 1)
+        self.other = self.manager.create_code('plot(x)', 'b.rst', 0, user_id='first')
+
+        self.manager.create_result(self.first.id, 'second', 1)
+        self.manager.create_result(self.first.id, 'first', 0)
+        self.manager.create_error(self.second.id, 'ZeroDivisionError', 'division by zero', 'Traceback', 0)
+        self.manager.create_file(self.other.id, 'http://localhost/x.png', 'x.png', 0, 'image/png')
+        self.manager.commit()
+
+        self.snapshot = RenderSnapshot(self.manager)
+
+    def test_lookups(self):
+        self.assertEqual(len(self.snapshot), 3)
+
+        self.assertEqual(self.snapshot.get_code(self.first.id).content, 'print(1)')
+        self.assertEqual(self.snapshot.get_code(src='a.rst', order=1).id, self.second.id)
+        self.assertEqual(self.snapshot.get_code(src='b.rst', user_id='first').id, self.other.id)
+        self.assertEqual(self.snapshot.get_code(src='b.rst', order=1), None)
+        self.assertEqual(self.snapshot.get_code(444), None)
+
+        code_obj = self.snapshot.get_code(self.first.id)
+        self.assertEqual(code_obj.src.src, 'a.rst')
+        self.assertEqual(code_obj.platform, 'sage')
+
+    def test_results(self):
+        code_obj = self.snapshot.get_code(self.first.id)
+        self.assertEqual([r.data for r in code_obj.results], ['first', 'second'])
+        self.assertEqual([r.type for r in code_obj.results], [ResultTypes.Stream] * 2)
+
+        error = self.snapshot.get_code(self.second.id).results[0]
+        self.assertEqual(error.type, ResultTypes.Error)
+        self.assertEqual(error.data.traceback, 'Traceback')
+
+        image = self.snapshot.get_code(self.other.id).file_results[0]
+        self.assertEqual(image.data.file_name, 'x.png')
+        self.assertEqual(image.mimetype, 'image/png')
+
+    def test_detached(self):
+        # Later writes do not show up in an existing snapshot
+        self.manager.create_result(self.second.id, 'late', 1)
+        self.manager.commit()
+
+        self.assertEqual(len(self.snapshot.get_code(self.second.id).results), 1)
+        self.assertEqual(len(RenderSnapshot(self.manager).get_code(self.second.id).results), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
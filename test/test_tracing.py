@@ -0,0 +1,90 @@
+import json
+import os
+import shutil
+import tempfile
+import threading
+import tracemalloc
+import unittest
+
+from pelicansage.tracing import Tracer, NULL_SPAN
+
+
+class TestTracer(unittest.TestCase):
+    def test_disabled(self):
+        tracer = Tracer()
+
+        self.assertIs(tracer.span('phase'), NULL_SPAN)
+        with tracer.span('phase', memory=True) as span:
+            span.args['x'] = 1
+        tracer.start('phase').finish()
+
+        self.assertEqual(tracer.events, [])
+        self.assertEqual(NULL_SPAN.args, {})
+
+    def test_spans(self):
+        tracer = Tracer(enabled=True)
+
+        with tracer.span('evaluation', 'phase', src='a.rst'):
+            worker = threading.Thread(target=lambda: tracer.span('evaluate block', 'block').__enter__().finish(),
+                                      name='worker')
+            worker.start()
+            worker.join()
+
+        span = tracer.start('render', 'phase')
+        span.finish()
+        span.finish()
+
+        events = [e for e in tracer.trace()['traceEvents'] if e['ph'] == 'X']
+        self.assertEqual([e['name'] for e in events], ['evaluation', 'evaluate block', 'render'])
+        self.assertEqual(events[0]['args'], {'src': 'a.rst'})
+        self.assertNotEqual(events[0]['tid'], events[1]['tid'])
+        self.assertTrue(events[0]['dur'] >= events[1]['dur'])
+
+        names = [e['args']['name'] for e in tracer.trace()['traceEvents'] if e['ph'] == 'M']
+        self.assertIn('worker', names)
+
+    def test_memory(self):
+        tracer = Tracer(enabled=True, memory=True)
+
+        with tracer.span('outer', 'phase', memory=True):
+            with tracer.span('inner', 'phase', memory=True):
+                data = [bytearray(1024) for _ in range(1024)]
+            del data
+
+        inner, outer = tracer.events
+        self.assertTrue(inner['args']['peak_memory'] >= 1 << 20)
+        self.assertTrue(outer['args']['peak_memory'] >= inner['args']['peak_memory'])
+        self.assertTrue(inner['args']['top_allocations'])
+        self.assertFalse(tracemalloc.is_tracing())
+
+    def test_memory_keeps_tracing(self):
+        # tracemalloc started by someone else keeps running
+        tracemalloc.start()
+        try:
+            tracer = Tracer(enabled=True, memory=True)
+            with tracer.span('phase', memory=True):
+                pass
+            self.assertTrue(tracemalloc.is_tracing())
+        finally:
+            tracemalloc.stop()
+
+    def test_write(self):
+        tracer = Tracer(enabled=True)
+        with tracer.span('phase'):
+            pass
+
+        location = tempfile.mkdtemp()
+        try:
+            path = os.path.join(location, 'trace', 'trace.json')
+            tracer.write(path)
+
+            with open(path) as f:
+                trace = json.load(f)
+        finally:
+            shutil.rmtree(location)
+
+        self.assertEqual(trace['traceEvents'][-1]['name'], 'phase')
+
+
+if __name__ == '__main__':
+    unittest.main()
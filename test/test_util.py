@@ -0,0 +1,63 @@
+import unittest
+
+from pelicansage.constants import ResultTypes
+from pelicansage.util import CellResult as CR, combine_results, truncate_output
+
+
+def stream(data, mimetype='text/plain'):
+    return CR(ResultTypes.Stream, None, data, mimetype)
+
+
+class TestCombineResults(unittest.TestCase):
+    def test_combine(self):
+        results = [stream('a'), stream('b'),
+                   stream('<b>c</b>', 'text/html'),
+                   CR(ResultTypes.Image, None, 'x.png', 'image/png'),
+                   stream('<i>d</i>', 'text/html'),
+                   stream('e'), stream('')]
+
+        self.assertEqual(combine_results(results),
+                         [CR(ResultTypes.Stream, 0, 'ab', 'text/plain'),
+                          CR(ResultTypes.Stream, 1, '<b>c</b><br/>', 'text/html'),
+                          CR(ResultTypes.Image, 2, 'x.png', 'image/png'),
+                          CR(ResultTypes.Stream, 3, '<i>d</i><br/>', 'text/html'),
+                          CR(ResultTypes.Stream, 4, 'e', 'text/plain')])
+
+    def test_other_mimetypes_keep_accumulating(self):
+        results = [stream('a'), CR(ResultTypes.Image, None, 'x.png', 'image/png'), stream('b')]
+
+        self.assertEqual([r.data for r in combine_results(results)], ['a', 'x.png', 'b'])
+        self.assertEqual(combine_results([]), [])
+        self.assertEqual(combine_results([stream(''), stream('')]), [])
+
+    def test_many_chunks(self):
+        results = [stream('x\n')] * 200000
+
+        combined = combine_results(results)
+
+        self.assertEqual(len(combined), 1)
+        self.assertEqual(len(combined[0].data), 400000)
+
+
+class TestTruncateOutput(unittest.TestCase):
+    def test_lines(self):
+        text = ''.join('%d\n' % (i,) for i in range(10))
+
+        self.assertEqual(truncate_output(text, lines=3), ('0\n1\n2\n', True))
+        self.assertEqual(truncate_output(text, lines=2, keep='tail'), ('8\n9\n', True))
+        self.assertEqual(truncate_output(text, lines=10), (text, False))
+        self.assertEqual(truncate_output(text), (text, False))
+
+    def test_bytes(self):
+        self.assertEqual(truncate_output('abcdef', bytes=4), ('abcd', True))
+        self.assertEqual(truncate_output('abcdef', bytes=2, keep='tail'), ('ef', True))
+        # Multi-byte characters cut in half are dropped
+        self.assertEqual(truncate_output('aéb', bytes=2), ('a', True))
+        self.assertEqual(truncate_output('ab', bytes=2), ('ab', False))
+
+    def test_lines_and_bytes(self):
+        self.assertEqual(truncate_output('aaaa\nbbbb\ncccc\n', lines=2, bytes=6), ('aaaa\nb', True))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,78 @@
+import logging
+import os
+import shutil
+import tempfile
+import time
+import unittest
+from unittest import mock
+
+import sitegen
+from fakekernel import FakeKernelServer
+
+
+class TestSiteWatcher(unittest.TestCase):
+    def setUp(self):
+        self.server = FakeKernelServer().start()
+        self.location = tempfile.mkdtemp()
+        self.cwd = os.getcwd()
+
+        sitegen.generate(self.location, articles=3, notebooks=0, slides=0, blocks=2,
+                         cell_url=self.server.url, ipython_url=self.server.url)
+        os.chdir(self.location)
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        shutil.rmtree(self.location)
+        self.server.stop()
+
+    def output(self, indx):
+        return os.path.join(self.location, 'output', 'article-%d.html' % (indx,))
+
+    def test_rebuild(self):
+        from pelican.settings import read_settings
+
+        from pelicansage.watch import SiteWatcher
+
+        watcher = SiteWatcher(read_settings('pelicanconf.py'))
+        try:
+            watcher.build()
+            self.assertEqual(len(self.server.executed), 6)
+            self.assertEqual(watcher.rebuild(), None)
+
+            written = [os.path.getmtime(self.output(indx)) for indx in range(3)]
+            kernels = len(self.server.kernels)
+
+            time.sleep(0.05)
+            sitegen.edit_article(self.location, 1, 2, 0)
+
+            # The edited article and the one embedding its results
+            selected = watcher.rebuild()
+            self.assertEqual(sorted(os.path.basename(path) for path in selected),
+                             ['article_0001.rst', 'article_0002.rst'])
+
+            # Only the edited block runs, in the kernel of the first build
+            self.assertEqual(len(self.server.executed), 7)
+            self.assertEqual(len(self.server.kernels), kernels)
+
+            self.assertEqual([os.path.getmtime(self.output(indx)) > written[indx] for indx in range(3)],
+                             [False, True, True])
+        finally:
+            watcher.close()
+
+    def test_command_reports_builds(self):
+        from pelicansage import commands
+
+        watch_logger = logging.getLogger('pelicansage.watch')
+        try:
+            with mock.patch('pelicansage.watch.watch') as watch:
+                commands.main(['watch', '-s', 'pelicanconf.py'])
+
+            self.assertTrue(watch.called)
+            # Builds are reported without -v
+            self.assertTrue(watch_logger.isEnabledFor(logging.INFO))
+        finally:
+            watch_logger.setLevel(logging.NOTSET)
+
+
+if __name__ == '__main__':
+    unittest.main()
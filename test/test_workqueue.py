@@ -0,0 +1,141 @@
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+from pelicansage import evaluation
+from pelicansage.evaluation import BlockTask, evaluate
+from pelicansage.managefiles import FileManager, ResultTypes
+from pelicansage.sagecell import IPythonNotebookClient
+from pelicansage.util import CellResult, SageError
+from pelicansage.workqueue import (SQLiteWorkQueue, DirectoryWorkQueue, decode_item, encode_item,
+                                   run_worker)
+
+from fakekernel import FakeKernelServer
+
+
+def tasks(src, count=2):
+    return [BlockTask(order + 1, src, order, 'print(%d)' % (order,), 'python', 'ipython', False, 'chain%d' % (order,))
+            for order in range(count)]
+
+
+class WorkQueueTests(object):
+    def setUp(self):
+        self.location = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.location)
+
+    def test_encode_item(self):
+        item = (3, [CellResult(ResultTypes.Stream, 0, 'out', 'text/plain'),
+                    CellResult(ResultTypes.Error, 1, SageError('E', 'v', ['tb']), 'text/x-python-traceback'),
+                    CellResult(ResultTypes.Image, 2, b'\x89PNG\0', 'image/png')],
+                {'execution_time': 0.5})
+
+        self.assertEqual(decode_item(encode_item(item)), item)
+        self.assertEqual(decode_item(encode_item(None)), None)
+
+    def test_claim_once(self):
+        queue = self.create()
+        unit_id = queue.publish('/a.rst', tasks('/a.rst'))
+
+        claimed_id, src, claimed = queue.claim('worker1')
+        self.assertEqual((claimed_id, src, claimed), (unit_id, '/a.rst', tasks('/a.rst')))
+        self.assertEqual(queue.claim('worker2'), None)
+
+        queue.post(unit_id, src, (1, [], {}))
+        queue.post(unit_id, src, None)
+
+        self.assertEqual(queue.collect([unit_id]), [('/a.rst', (1, [], {})), ('/a.rst', None)])
+        self.assertEqual(queue.collect([unit_id]), [])
+
+        queue.remove(unit_id)
+        self.assertEqual(queue.claim('worker2'), None)
+
+    def test_expired_lease(self):
+        queue = self.create(lease=0.2)
+        unit_id = queue.publish('/a.rst', tasks('/a.rst'))
+
+        queue.claim('worker1')
+        time.sleep(0.5)
+
+        # The first worker stopped renewing its lease
+        self.assertEqual(queue.claim('worker2')[0], unit_id)
+
+    def test_evaluate(self):
+        server = FakeKernelServer(output_size=10).start()
+        try:
+            manager = FileManager()
+            for order in range(3):
+                manager.create_code('print(%d)' % (order,), 'a.rst', order, platform='ipython', language='python')
+            manager.create_code('print(4)', 'b.rst', 0, platform='ipython', language='python')
+
+            queue = self.create()
+            create_clients = lambda: {'ipython': IPythonNotebookClient(server.url)}
+
+            stop = threading.Event()
+            workers = [threading.Thread(target=run_worker, args=(self.create(), create_clients),
+                                        kwargs={'poll': 0.05, 'stop': stop})
+                       for _ in range(2)]
+            for worker in workers:
+                worker.start()
+
+            try:
+                evaluate(manager, create_clients, work_queue=queue, poll=0.05)
+            finally:
+                stop.set()
+                for worker in workers:
+                    worker.join()
+
+            self.assertEqual(manager.get_unevaluated_codeblocks()[0], [])
+            self.assertEqual(len(server.executed), 4)
+
+            for code_obj in manager.get_all_codeblocks():
+                self.assertEqual([r.mimetype for r in code_obj.results], ['text/plain'])
+                self.assertTrue(code_obj.permalink)
+        finally:
+            server.stop()
+
+    def test_evaluate_without_workers(self):
+        # Pelican drops repeated warnings, each backend waits for sources of its own
+        first, second = ('%s/%s' % (type(self).__name__, name) for name in ('a.rst', 'b.rst'))
+
+        manager = FileManager()
+        manager.create_code('print(1)', first, 0, platform='ipython', language='python')
+        manager.create_code('print(2)', second, 0, platform='ipython', language='python')
+        manager.create_reference(second, first)
+
+        queue = self.create()
+        create_clients = lambda: {}
+
+        interval = evaluation.QUEUE_WARNING_INTERVAL
+        evaluation.QUEUE_WARNING_INTERVAL = 0.1
+        try:
+            with self.assertLogs('pelicansage.evaluation', 'WARNING') as logs:
+                evaluate(manager, create_clients, work_queue=queue, poll=0.05, queue_timeout=0.5)
+        finally:
+            evaluation.QUEUE_WARNING_INTERVAL = interval
+
+        self.assertTrue(any('waiting for %s' % (first,) in line for line in logs.output))
+        self.assertTrue(any('2 sources are left unevaluated: %s, %s' % (first, second) in line
+                            for line in logs.output))
+
+        # Given up units are no longer offered to workers
+        self.assertEqual(queue.claim('worker'), None)
+        self.assertEqual(len(manager.get_unevaluated_codeblocks()[0]), 2)
+
+
+class TestSQLiteWorkQueue(WorkQueueTests, unittest.TestCase):
+    def create(self, lease=60):
+        return SQLiteWorkQueue(os.path.join(self.location, 'queue.db'), lease=lease)
+
+
+class TestDirectoryWorkQueue(WorkQueueTests, unittest.TestCase):
+    def create(self, lease=60):
+        return DirectoryWorkQueue(os.path.join(self.location, 'queue'), lease=lease)
+
+
+if __name__ == '__main__':
+    unittest.main()